@@ -0,0 +1,118 @@
+import json
+import time
+import argparse
+import numpy as np
+import faiss
+from pathlib import Path
+from build_faiss_index import resolve_index_type, create_index
+from embedding_store import read_embedding_matrix
+
+# clustered unit vectors, closer to clip embeddings than uniform noise
+def synthetic_vectors(n, dim, clusters=256, spread=0.35, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32)
+    x = centers[rng.integers(0, clusters, n)] + spread * rng.standard_normal((n, dim), dtype=np.float32)
+    faiss.normalize_L2(x)
+    return x
+
+# load every embedding shard in a directory into one normalized matrix
+def load_vectors(input_dir, limit=None):
+    parts, total = [], 0
+    for path in sorted(Path(input_dir).glob("*.parquet")):
+        parts.append(read_embedding_matrix(path))
+        total += len(parts[-1])
+        if limit and total >= limit:
+            break
+    x = np.ascontiguousarray(np.concatenate(parts)[:limit], dtype=np.float32)
+    faiss.normalize_L2(x)
+    return x
+
+# fraction of the exact top-k found in the approximate top-k, averaged over queries
+def recall_at_k(approx, exact, k):
+    hits = sum(len(np.intersect1d(a[:k], e[:k])) for a, e in zip(approx, exact))
+    return hits / (len(exact) * k)
+
+# build, train and evaluate one index configuration against exact ground truth
+# config is a preset or factory string, optionally followed by |search params (e.g. ivf|nprobe=16)
+def evaluate(config, xb, xq, gt, k, train_samples, nlist, pq_m, seed=0):
+    index_type, _, params = config.partition("|")
+    spec = resolve_index_type(index_type, nlist, pq_m)
+    index = create_index(xb.shape[1], spec)
+
+    start = time.perf_counter()
+    if not index.is_trained:
+        rng = np.random.default_rng(seed)
+        sample = xb[rng.choice(len(xb), size=min(train_samples, len(xb)), replace=False)]
+        index.train(sample)
+    train_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index.add(xb)
+    add_s = time.perf_counter() - start
+
+    if params:
+        faiss.ParameterSpace().set_index_parameters(index, params)
+
+    start = time.perf_counter()
+    _, ids = index.search(xq, k)
+    search_s = time.perf_counter() - start
+
+    return {
+        "config": config,
+        "factory": spec,
+        "recall_at_k": round(recall_at_k(ids, gt, k), 4),
+        "qps": round(len(xq) / search_s, 1),
+        "index_mb": round(len(faiss.serialize_index(index)) / 2**20, 1),
+        "train_s": round(train_s, 2),
+        "add_s": round(add_s, 2),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # real embedding shards to evaluate on; synthetic clustered vectors when omitted
+    parser.add_argument("--input_dir", type=str, default=None)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=512)
+
+    # held-out query vectors (excluded from the indexed base)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--train_samples", type=int, default=100000)
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--pq_m", type=int, default=64)
+    parser.add_argument("--configs", type=str, nargs="+", default=[
+        "flat", "ivf|nprobe=16", "ivfpq|nprobe=16", "opq|nprobe=16", "hnsw|efSearch=64"])
+
+    # optional json report path
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.input_dir:
+        x = load_vectors(args.input_dir, args.rows + args.queries)
+    else:
+        x = synthetic_vectors(args.rows + args.queries, args.dim)
+
+    # hold out the last rows as queries
+    xb, xq = x[:-args.queries], x[-args.queries:]
+
+    # exact ground truth from the flat baseline
+    flat = faiss.IndexFlatIP(xb.shape[1])
+    flat.add(xb)
+    _, gt = flat.search(xq, args.top_k)
+
+    print(f"Base {xb.shape[0]} x {xb.shape[1]} | {len(xq)} held-out queries | recall@{args.top_k}")
+    print("-" * 90)
+    results = []
+    for config in args.configs:
+        r = evaluate(config, xb, xq, gt, args.top_k, args.train_samples, args.nlist, args.pq_m)
+        results.append(r)
+        print(f"{r['config']:22s} | recall {r['recall_at_k']:.3f} | {r['qps']:9.1f} qps | "
+              f"{r['index_mb']:8.1f} MB | train {r['train_s']:.1f}s add {r['add_s']:.1f}s")
+    print("-" * 90)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"rows": int(xb.shape[0]), "dim": int(xb.shape[1]), "queries": len(xq),
+                       "top_k": args.top_k, "results": results}, f, indent=2)
+        print(f"Report saved to: {args.output}")
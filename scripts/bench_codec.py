@@ -0,0 +1,139 @@
+import os
+import time
+import json
+import shutil
+import argparse
+import numpy as np
+import faiss
+from bench_pipeline import clustered_chunks
+from bench_ann_recall import recall_at_k
+from build_faiss_index import train_template
+from embedding_codec import make_codec
+from embedding_store import EmbeddingWriter, iter_embedding_chunks, read_metadata
+from merge_faiss_shards import codec_index
+
+# embedding storage codecs against float32, on synthetic shards or real embedding files (--files)
+#   file   the vectors are written with each parquet codec (embedding_codec.py), then read back:
+#          bytes per vector, write and decode throughput, mean cosine to the original vectors and
+#          recall@k of exact search over the decoded vectors against exact float32 search
+#   merge  the normalized vectors are added to each merged-index codec (merge_faiss_shards.py
+#          --codec): index bytes per vector, add throughput and recall@k of searching it
+# pq codebooks are trained on a sample of normalized vectors, as --train_template --index_type PQ<m> does
+# synthetic clusters with isotropic noise are the worst case for pq (neighbours differ only by noise
+# it cannot encode), so judge pq on real embedding files
+
+# synthetic raw embeddings: clustered unit vectors with clip-like norms
+def write_synthetic(path, rows, dim, chunk_rows):
+    rng = np.random.default_rng(2)
+    with EmbeddingWriter(path, dim) as writer:
+        start = 0
+        for x in clustered_chunks(rows, dim, chunk_rows):
+            ids = np.arange(start, start + len(x))
+            x *= rng.uniform(8, 12, (len(x), 1)).astype(np.float32)
+            writer.write_batch(ids, [f"http://bench.local/{i}.jpg" for i in ids], [f"synthetic caption {i}" for i in ids], x)
+            start += len(x)
+
+# rewrite an embedding file with a codec, returning seconds spent
+def transcode(path, out_path, dim, codec, chunk_rows):
+    start = time.perf_counter()
+    meta = read_metadata(path)
+    with EmbeddingWriter(out_path, dim, codec=codec) as writer:
+        offset = 0
+        for x in iter_embedding_chunks(path, chunk_rows):
+            rows = meta.iloc[offset:offset + len(x)]
+            writer.write_batch(rows["sample_id"].to_numpy(), list(rows["url"]), list(rows["text"]), x)
+            offset += len(x)
+    return time.perf_counter() - start
+
+def read_all(path, chunk_rows):
+    start = time.perf_counter()
+    x = np.concatenate(list(iter_embedding_chunks(path, chunk_rows)))
+    return x, time.perf_counter() - start
+
+def normalized(x):
+    x = np.array(x, dtype=np.float32)
+    faiss.normalize_L2(x)
+    return x
+
+def search(xb, xq, k):
+    index = faiss.IndexFlatIP(xb.shape[1])
+    index.add(xb)
+    return index.search(xq, k)[1]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", type=str, default="/tmp/bench_codec")
+    parser.add_argument("--files", type=str, nargs="*", default=None, help="real embedding files instead of synthetic")
+    parser.add_argument("--rows", type=int, default=200000, help="synthetic rows")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--pq_m", type=int, default=64)
+    parser.add_argument("--train_samples", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--chunk_rows", type=int, default=65536)
+    parser.add_argument("--output", type=str, default=None, help="append one json line per codec")
+    args = parser.parse_args()
+
+    shutil.rmtree(args.workdir, ignore_errors=True)
+    os.makedirs(args.workdir)
+    files = args.files
+    if not files:
+        files = [os.path.join(args.workdir, "synthetic.parquet")]
+        write_synthetic(files[0], args.rows, args.dim, args.chunk_rows)
+    x = np.concatenate([np.concatenate(list(iter_embedding_chunks(f, args.chunk_rows))) for f in files])
+    dim, source = x.shape[1], "synthetic" if not args.files else "files"
+    xn = normalized(x)
+    xq = xn[np.random.default_rng(0).choice(len(xn), args.queries, replace=False)]
+    gt = search(xn, xq, args.top_k)
+    codebook = os.path.join(args.workdir, f"pq{args.pq_m}.index")
+    train_template(files, f"PQ{args.pq_m}", codebook, args.train_samples, True, args.chunk_rows)
+    print(f"{len(x)} x {dim} {source} vectors | {args.queries} queries, recall@{args.top_k} against exact float32")
+
+    for spec in ["float32", "float16", "int8", f"pq:{codebook}"]:
+        codec = make_codec(spec, dim)
+        parts = []
+        write_s = read_s = 0.0
+        for i, f in enumerate(files):
+            out = os.path.join(args.workdir, f"{codec.name}_{i:03d}.parquet")
+            write_s += transcode(f, out, dim, codec, args.chunk_rows)
+            y, seconds = read_all(out, args.chunk_rows)
+            parts.append(y)
+            read_s += seconds
+        y = np.concatenate(parts)
+        size = sum(os.path.getsize(os.path.join(args.workdir, f"{codec.name}_{i:03d}.parquet")) for i in range(len(files)))
+        yn = normalized(y)
+        result = {
+            "source": source, "rows": len(x), "dim": dim, "stage": "file", "codec": codec.name,
+            "bytes_per_vector": round(size / len(x), 1), "write_vectors_per_s": round(len(x) / write_s),
+            "decode_vectors_per_s": round(len(x) / read_s), "mean_cosine": round(float(np.sum(xn * yn, axis=1).mean()), 5),
+            "norm_error": round(float(np.abs(np.linalg.norm(y, axis=1) / np.linalg.norm(x, axis=1) - 1).mean()), 5),
+            "recall": round(recall_at_k(search(yn, xq, args.top_k), gt, args.top_k), 4),
+        }
+        print(f"file  {codec.name:8s} | {result['bytes_per_vector']:7.1f} B/vector | write {result['write_vectors_per_s']:8d}/s "
+              f"| decode {result['decode_vectors_per_s']:9d}/s | cosine {result['mean_cosine']:.5f} "
+              f"| norm error {result['norm_error']:.5f} | recall {result['recall']:.4f}")
+        if args.output:
+            with open(args.output, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+    for codec in ["float32", "float16", "int8", "pq"]:
+        index = codec_index(dim, codec, args.pq_m)
+        start = time.perf_counter()
+        if not index.is_trained:
+            index.train(xn[np.random.default_rng(1).choice(len(xn), min(args.train_samples, len(xn)), replace=False)])
+        index.add(xn)
+        add_s = time.perf_counter() - start
+        start = time.perf_counter()
+        ids = index.search(xq, args.top_k)[1]
+        search_s = time.perf_counter() - start
+        result = {
+            "source": source, "rows": len(x), "dim": dim, "stage": "merge", "codec": codec,
+            "bytes_per_vector": round(faiss.serialize_index(index).nbytes / len(x), 1),
+            "add_vectors_per_s": round(len(x) / add_s), "ms_per_query": round(search_s * 1000 / len(xq), 3),
+            "recall": round(recall_at_k(ids, gt, args.top_k), 4),
+        }
+        print(f"merge {codec:8s} | {result['bytes_per_vector']:7.1f} B/vector | train+add {result['add_vectors_per_s']:8d}/s "
+              f"| {result['ms_per_query']:.3f} ms/query | recall {result['recall']:.4f}")
+        if args.output:
+            with open(args.output, "a") as f:
+                f.write(json.dumps(result) + "\n")
@@ -0,0 +1,59 @@
+import os
+import time
+import json
+import argparse
+import torch
+import clip
+from cpu_inference import CpuImageEncoder, configure_threads, load_gate_images, accuracy_gate
+
+# images/sec of clip encode_image on cpu for each precision, traced and eager, plus the
+# accuracy gate result against fp32 on the fixed test images
+
+# time encode_image on a random batch after a few warmup runs
+def throughput(encoder, batch, iters, warmup=2):
+    for _ in range(warmup):
+        encoder.encode_image(batch)
+    start = time.perf_counter()
+    for _ in range(iters):
+        encoder.encode_image(batch)
+    return iters * len(batch) / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gate_dir", type=str, default=os.path.join(os.path.dirname(__file__), "..", "test_inputs"))
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--min_cosine", type=float, default=0.99)
+    parser.add_argument("--precisions", nargs="+", default=["fp32", "int8", "bf16"])
+    parser.add_argument("--output", type=str, default=None, help="append one json line per setting")
+    args = parser.parse_args()
+
+    threads = configure_threads(args.threads)
+    model, preprocess = clip.load("ViT-B/32", device="cpu")
+    model = model.float().eval()
+    images = load_gate_images(args.gate_dir, preprocess)
+    size = model.visual.input_resolution
+    batch = torch.randn(args.batch_size, 3, size, size)
+    print(f"{threads} threads | batch {args.batch_size} | {len(images)} gate images")
+
+    print("-" * 70)
+    results = []
+    for precision in args.precisions:
+        for trace in (False, True):
+            # bf16 always runs eagerly
+            if precision == "bf16" and trace:
+                continue
+            encoder = CpuImageEncoder(model, precision, trace)
+            rate = throughput(encoder, batch, args.iters)
+            ok, stats = accuracy_gate(model, encoder, images, args.min_cosine)
+            results.append({"precision": precision, "traced": encoder.traced, "threads": threads,
+                            "batch_size": args.batch_size, "images_per_sec": round(rate, 2),
+                            "gate_passed": ok, **stats})
+            print(f"{encoder.describe():12s} | {rate:8.1f} img/s | min cos {stats['min_cosine']:.5f} | "
+                  f"{'pass' if ok else 'FAIL'}")
+
+    if args.output:
+        with open(args.output, "a") as f:
+            for r in results:
+                f.write(json.dumps(r) + "\n")
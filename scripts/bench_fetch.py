@@ -0,0 +1,107 @@
+import os
+import time
+import random
+import argparse
+import threading
+from torchvision import transforms
+from PIL import Image
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from image_fetch import ImageFetcher, Throughput
+
+# same preprocessing as clip, so decode cost matches the real pipeline
+preprocess = transforms.Compose([
+    transforms.Resize(224, interpolation=Image.BICUBIC),
+    transforms.CenterCrop(224),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=(0.48145466, 0.4578275, 0.40821073),
+                         std=(0.26862954, 0.26130258, 0.27577711))
+])
+
+# start a local http server that serves test images with injected delays and failures
+# urls look like /<name>?delay=<seconds>&fail=<0|1>; stats, when given, counts the requests served
+def serve_images(image_dir, host="127.0.0.1", port=0, stats=None):
+    images = {}
+    for f in os.listdir(image_dir):
+        if f.lower().endswith(('.png', '.jpg', '.jpeg')):
+            with open(os.path.join(image_dir, f), "rb") as fh:
+                images[f] = fh.read()
+
+    stats_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if stats is not None:
+                with stats_lock:
+                    stats["requests"] = stats.get("requests", 0) + 1
+            parts = urlsplit(self.path)
+            params = parse_qs(parts.query)
+            delay = float(params.get("delay", ["0"])[0])
+            if delay > 0:
+                time.sleep(delay)
+            if params.get("fail", ["0"])[0] == "1":
+                self.send_error(503)
+                return
+            data = images.get(os.path.basename(parts.path))
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        # keep benchmark output readable
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://{host}:{server.server_address[1]}"
+    return server, base_url, sorted(images)
+
+# build a list of (key, url) items with a fraction of slow and failing urls
+def make_urls(base_url, names, count, slow_rate, slow_delay, fail_rate, seed=0):
+    rng = random.Random(seed)
+    items = []
+    for i in range(count):
+        delay = slow_delay if rng.random() < slow_rate else 0.0
+        fail = 1 if rng.random() < fail_rate else 0
+        items.append((i, f"{base_url}/{names[i % len(names)]}?delay={delay}&fail={fail}"))
+    return items
+
+# fetch every url and report images/sec for the given fetcher settings
+def run(items, concurrency, per_host, queue_depth, batch_size, timeout):
+    fetcher = ImageFetcher(preprocess, concurrency=concurrency, per_host=per_host,
+                           queue_depth=queue_depth, timeout=timeout, retries=1)
+    meter = Throughput()
+    for batch_keys, batch in fetcher.batches(items, batch_size):
+        meter.add(len(batch))
+    return fetcher.fetched, fetcher.failed, meter.rate()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_dir", type=str, default=os.path.join(os.path.dirname(__file__), "..", "test_inputs"))
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--slow_rate", type=float, default=0.1)
+    parser.add_argument("--slow_delay", type=float, default=0.5)
+    parser.add_argument("--fail_rate", type=float, default=0.05)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--queue_depth", type=int, default=256)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32])
+    args = parser.parse_args()
+
+    server, base_url, names = serve_images(args.image_dir)
+    items = make_urls(base_url, names, args.count, args.slow_rate, args.slow_delay, args.fail_rate)
+
+    print(f"Serving {len(names)} images at {base_url} | {args.count} urls")
+    print("-" * 70)
+    for c in args.concurrency:
+        # a single local host, so allow every worker to hit it
+        fetched, failed, rate = run(items, c, c, args.queue_depth, args.batch_size, args.timeout)
+        print(f"concurrency={c:3d} | fetched={fetched} failed={failed} | {rate:.1f} images/sec")
+    print("-" * 70)
+    server.shutdown()
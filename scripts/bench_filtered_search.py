@@ -0,0 +1,124 @@
+import os
+import time
+import json
+import shutil
+import argparse
+import numpy as np
+from pathlib import Path
+from bench_pipeline import clustered_chunks
+from bench_ann_recall import recall_at_k
+from bench_incremental import merge_args, build_shards
+from build_faiss_index import resolve_index_type, create_index, train_template
+from embedding_store import EmbeddingWriter
+from merge_faiss_shards import merge
+from metadata_filter import parse_filters
+from search_faiss_index import load_index, load_filter_index, search_vectors, search_filtered
+
+# filtered search at several selectivities: captions carry tags held by 50% down to 0.01% of rows,
+# the pipeline builds and merges the index with its column index, then a text: filter on each tag
+# is searched two ways and compared with the exact top-k among the matching rows
+#   post-filter  search overfetch * top_k unfiltered, then drop the rows that do not match
+#   pushdown     FilterIndex.select the matching ids and search only them (search_filtered)
+
+tags = {"tag50": 0.5, "tag10": 0.1, "tag1": 0.01, "tag01": 0.001, "tag001": 0.0001}
+
+# embedding files whose captions carry each tag with its probability; returns every vector
+def make_embeddings(emb_dir, rows, dim, files, chunk_rows):
+    os.makedirs(emb_dir, exist_ok=True)
+    rng = np.random.default_rng(0)
+    per_file = -(-rows // files)
+    parts, start = [], 0
+    for s in range(files):
+        n = min(per_file, rows - start)
+        with EmbeddingWriter(os.path.join(emb_dir, f"clip_embeddings_task{s:03d}.parquet"), dim) as writer:
+            for x in clustered_chunks(n, dim, chunk_rows, sample_seed=s + 1):
+                ids = np.arange(start, start + len(x))
+                has = {t: rng.random(len(x)) < p for t, p in tags.items()}
+                texts = [" ".join(["synthetic caption", str(i)] + [t for t in tags if has[t][j]])
+                         for j, i in enumerate(ids)]
+                writer.write_batch(ids, [f"http://bench.local/{i}.jpg" for i in ids], texts, x)
+                parts.append(x)
+                start += len(x)
+    return np.concatenate(parts)
+
+# exact top-k among the allowed ids
+def filtered_ground_truth(xb, xq, allowed, top_k):
+    sims = xq @ xb[allowed].T
+    top = np.argsort(-sims, axis=1, kind="stable")[:, :top_k]
+    return allowed[top]
+
+def post_filter(index, xq, top_k, allowed, overfetch):
+    _, ids = search_vectors(index, xq, top_k * overfetch)
+    mask = np.zeros(index.ntotal, dtype=bool)
+    mask[allowed] = True
+    out = np.full((len(xq), top_k), -1, dtype=np.int64)
+    for q, row in enumerate(ids):
+        kept = row[(row >= 0) & mask[np.maximum(row, 0)]][:top_k]
+        out[q, :len(kept)] = kept
+    return out
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", type=str, default="/tmp/bench_filtered_search")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--index_type", type=str, default="flat")
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--search_params", type=str, default=None, help="faiss search parameters, e.g. nprobe=16")
+    parser.add_argument("--overfetch", type=int, default=10, help="post-filter searches overfetch * top_k")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--chunk_rows", type=int, default=65536)
+    parser.add_argument("--output", type=str, default=None, help="append one json line per tag")
+    args = parser.parse_args()
+
+    shutil.rmtree(args.workdir, ignore_errors=True)
+    xb = make_embeddings(os.path.join(args.workdir, "embeddings"), args.rows, args.dim, args.files, args.chunk_rows)
+    xq = next(clustered_chunks(args.queries, args.dim, args.queries, sample_seed=0))
+    files = sorted(Path(args.workdir, "embeddings").glob("*.parquet"))
+    spec = resolve_index_type(args.index_type, args.nlist)
+    template = None
+    if not create_index(args.dim, spec).is_trained:
+        template = os.path.join(args.workdir, "template.index")
+        train_template(files, spec, template, 50000, False, args.chunk_rows)
+
+    index_dir, out_dir = os.path.join(args.workdir, "index_shards"), os.path.join(args.workdir, "merged")
+    os.makedirs(out_dir)
+    build_shards(files, index_dir, spec, template, args.chunk_rows)
+    margs = merge_args(index_dir, out_dir)
+    _, merge_s = timed(merge, margs)
+    index = load_index(margs.output_index, search_params=args.search_params)
+    filter_index = load_filter_index(margs.output_index, margs.output_store)
+    print(f"{args.rows} vectors | {spec} {args.search_params or ''} | merge with column index {merge_s:.2f}s | "
+          f"{args.queries} queries, top-{args.top_k}, post-filter overfetch {args.overfetch}x")
+
+    for tag, p in tags.items():
+        allowed, select_s = timed(filter_index.select, parse_filters([f"text:{tag}"]), index.ntotal)
+        gt = filtered_ground_truth(xb, xq, allowed, args.top_k)
+        post_ids, post_s = timed(post_filter, index, xq, args.top_k, allowed, args.overfetch)
+        push = timed(search_filtered, index, xq, args.top_k, allowed)
+        push_ids, push_s = push[0][1], push[1]
+        result = {
+            "factory": spec, "search_params": args.search_params, "rows": args.rows, "tag": tag,
+            "selectivity": round(len(allowed) / args.rows, 6), "matches": len(allowed),
+            "select_ms": round(select_s * 1000, 2),
+            "post_filter_recall": round(recall_at_k(post_ids, gt, args.top_k), 4),
+            "post_filter_short": int((post_ids < 0).any(axis=1).sum()),
+            "post_filter_ms_per_query": round(post_s * 1000 / args.queries, 3),
+            "pushdown_recall": round(recall_at_k(push_ids, gt, args.top_k), 4),
+            "pushdown_short": int((push_ids < 0).any(axis=1).sum()),
+            "pushdown_ms_per_query": round((push_s + select_s) * 1000 / args.queries, 3),
+        }
+        print(f"{tag:7s} {result['selectivity']:8.4%} ({len(allowed):6d} rows, select {result['select_ms']:6.2f} ms) | "
+              f"post-filter recall {result['post_filter_recall']:.4f} short {result['post_filter_short']:3d} "
+              f"{result['post_filter_ms_per_query']:.3f} ms/q | pushdown recall {result['pushdown_recall']:.4f} "
+              f"short {result['pushdown_short']:3d} {result['pushdown_ms_per_query']:.3f} ms/q")
+        if args.output:
+            with open(args.output, "a") as f:
+                f.write(json.dumps(result) + "\n")
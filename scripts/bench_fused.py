@@ -0,0 +1,142 @@
+import os
+import time
+import json
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+import faiss
+from bench_pipeline import clustered_chunks, size_mb
+from build_faiss_index import (resolve_index_type, create_index, build_index, save_outputs, train_template,
+                               FusedShardWriter)
+from embedding_store import CheckpointWriter, EmbeddingWriter, iter_embedding_chunks, read_metadata
+
+# fused embed-and-index against the two-stage path, on synthetic batches as the embed loop would
+# produce them (no fetching or encoding, so only the storage work differs)
+#   two-stage    CheckpointWriter parts compacted into embedding parquet in output_dir, then read back,
+#                normalized and added into a shard, as build_faiss_index.py does
+#   fused        FusedShardWriter adds every batch to the shard as it arrives; its checkpoint parts go
+#                to scratch_dir and output_dir only receives the shard (fused+keep also writes the parquet)
+# shards must come out identical; a fused run killed halfway must resume to the same shard
+# output_dir can point at the nfs share to measure the traffic the fused mode saves
+
+# bytes this process has read and written through system calls
+def io_bytes():
+    counts = {}
+    with open("/proc/self/io") as f:
+        for line in f:
+            key, value = line.split(":")
+            counts[key] = int(value)
+    return counts["rchar"], counts["wchar"]
+
+# the embed loop's batches: ids, urls, captions and raw (unnormalized) vectors
+def batches(rows, dim, batch_size):
+    start = 0
+    for x in clustered_chunks(rows, dim, batch_size):
+        ids = np.arange(start, start + len(x))
+        yield ids, [f"http://bench.local/{i}.jpg" for i in ids], [f"synthetic caption {i}" for i in ids], x * 3.0
+        start += len(x)
+
+def timed_io(fn):
+    r0, w0 = io_bytes()
+    start = time.perf_counter()
+    fn()
+    r1, w1 = io_bytes()
+    return {"seconds": round(time.perf_counter() - start, 3), "read_mb": round((r1 - r0) / 2**20, 1),
+            "written_mb": round((w1 - w0) / 2**20, 1)}
+
+def two_stage(out_dir, args, spec, template):
+    path = os.path.join(out_dir, "clip_embeddings_task0.parquet")
+    writer = CheckpointWriter(path, args.dim, args.checkpoint_rows)
+    for ids, urls, texts, x in batches(args.rows, args.dim, args.batch_size):
+        writer.write_batch(ids, urls, texts, x)
+    writer.close()
+    index = build_index(iter_embedding_chunks(path, args.chunk_rows), True, spec, template)
+    save_outputs(index, read_metadata(path), os.path.join(out_dir, "index_shards"), "clip_embeddings_task0",
+                 "faiss_shard", os.path.basename(path))
+
+def fused(out_dir, scratch_dir, args, spec, template, keep=False, stop_after=None):
+    parts_path = os.path.join(out_dir if keep else scratch_dir, "clip_embeddings_task0.parquet")
+    writer = FusedShardWriter(parts_path, args.dim, os.path.join(out_dir, "index_shards"), "clip_embeddings_task0",
+                              "faiss_shard", spec, template, keep, args.checkpoint_rows, "clip_embeddings_task0.parquet")
+    done = writer.finished()
+    for n, (ids, urls, texts, x) in enumerate(batches(args.rows, args.dim, args.batch_size)):
+        if stop_after is not None and n == stop_after:
+            # a kill: only what was checkpointed survives
+            return
+        keep_rows = ~np.isin(ids, list(done))
+        if keep_rows.any():
+            writer.write_batch(ids[keep_rows], [u for u, k in zip(urls, keep_rows) if k],
+                               [t for t, k in zip(texts, keep_rows) if k], x[keep_rows])
+    writer.close()
+
+# vectors and metadata of a shard, for comparing runs
+def read_shard(out_dir):
+    index = faiss.read_index(os.path.join(out_dir, "index_shards", "faiss_shard_clip_embeddings_task0.index"))
+    meta = pd.read_parquet(os.path.join(out_dir, "index_shards", "faiss_shard_clip_embeddings_task0.meta.parquet"))
+    if not isinstance(index, faiss.IndexFlat):
+        return index.ntotal, meta
+    return index.reconstruct_n(0, index.ntotal), meta
+
+def same_shard(a, b):
+    (xa, ma), (xb, mb) = read_shard(a), read_shard(b)
+    return bool(np.array_equal(xa, xb) and ma.equals(mb))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", type=str, default="/tmp/bench_fused", help="scratch and template location")
+    parser.add_argument("--output_dir", type=str, default=None, help="where outputs go (e.g. nfs), default workdir")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--checkpoint_rows", type=int, default=8192)
+    parser.add_argument("--chunk_rows", type=int, default=65536)
+    parser.add_argument("--index_type", type=str, default="flat")
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--output", type=str, default=None, help="append one json line with the results")
+    args = parser.parse_args()
+
+    shutil.rmtree(args.workdir, ignore_errors=True)
+    output_dir = os.path.join(args.output_dir or args.workdir, "bench_fused_outputs")
+    shutil.rmtree(output_dir, ignore_errors=True)
+    scratch_dir = os.path.join(args.workdir, "scratch")
+    spec = resolve_index_type(args.index_type, args.nlist)
+    template = None
+    if not create_index(args.dim, spec).is_trained:
+        train_dir = os.path.join(args.workdir, "train")
+        os.makedirs(train_dir)
+        with EmbeddingWriter(os.path.join(train_dir, "train.parquet"), args.dim) as writer:
+            for ids, urls, texts, x in batches(min(args.rows, 50000), args.dim, 4096):
+                writer.write_batch(ids, urls, texts, x)
+        template = os.path.join(args.workdir, "template.index")
+        train_template([os.path.join(train_dir, "train.parquet")], spec, template, 50000, True, args.chunk_rows)
+
+    runs = {name: os.path.join(output_dir, name) for name in ("two_stage", "fused", "fused_keep", "fused_resumed")}
+    for d in runs.values():
+        os.makedirs(d)
+    os.makedirs(scratch_dir)
+    result = {"rows": args.rows, "dim": args.dim, "factory": spec}
+    result["two_stage"] = timed_io(lambda: two_stage(runs["two_stage"], args, spec, template))
+    result["fused"] = timed_io(lambda: fused(runs["fused"], scratch_dir, args, spec, template))
+    result["fused_keep"] = timed_io(lambda: fused(runs["fused_keep"], scratch_dir, args, spec, template, keep=True))
+    halfway = args.rows // args.batch_size // 2
+    fused(runs["fused_resumed"], scratch_dir, args, spec, template, stop_after=halfway)
+    fused(runs["fused_resumed"], scratch_dir, args, spec, template)
+    for name, d in runs.items():
+        result[name] = {**result.get(name, {}), "output_mb": round(size_mb(d), 1)}
+    result["fused_same_shard"] = same_shard(runs["two_stage"], runs["fused"])
+    result["keep_same_shard"] = same_shard(runs["two_stage"], runs["fused_keep"])
+    result["resumed_same_shard"] = same_shard(runs["two_stage"], runs["fused_resumed"])
+    result["scratch_left_mb"] = round(size_mb(scratch_dir), 1)
+
+    print(f"{args.rows} x {args.dim} vectors | {spec} | outputs in {output_dir}")
+    for name in ("two_stage", "fused", "fused_keep"):
+        r = result[name]
+        print(f"{name:10s} | {r['seconds']:7.2f}s | read {r['read_mb']:8.1f} MB written {r['written_mb']:8.1f} MB | "
+              f"{r['output_mb']:8.1f} MB left in output_dir")
+    print(f"shards identical to two-stage: fused {result['fused_same_shard']} | fused+keep {result['keep_same_shard']} | "
+          f"killed halfway and resumed {result['resumed_same_shard']} | {result['scratch_left_mb']} MB left on scratch")
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
@@ -0,0 +1,146 @@
+import os
+import time
+import json
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from bench_pipeline import prepare_vectors
+from bench_ann_recall import recall_at_k
+from build_faiss_index import resolve_index_type, create_index, train_template, index_file
+from merge_faiss_shards import merge
+from metadata_store import MetadataStore
+from index_manifest import load_manifest, load_tombstones, metadata_parts, index_parts
+from search_faiss_index import load_index, search_vectors, deleted_params
+
+# incremental merge against a full rebuild: embedding files arrive in two batches; after the
+# second batch the merged index is updated with --incremental and compared with a full merge of
+# every shard (same search results, or for hnsw the same recall, and the same metadata and store
+# rows), then a source and some urls are deleted and searches are checked never to return them,
+# also after a later full rebuild (which folds the incremental segments back into one index)
+
+def merge_args(index_dir, out_dir, incremental=False, delete_sources=None, delete_urls=None, codec=None,
+               rerank_vectors=False):
+    return argparse.Namespace(
+        index_dir=index_dir, output_index=os.path.join(out_dir, "merged.index"),
+        output_metadata=os.path.join(out_dir, "merged_metadata.parquet"),
+        output_store=os.path.join(out_dir, "merged_metadata.store"), normalize=False, ondisk_ivf=None,
+        incremental=incremental, delete_sources=delete_sources, delete_urls=delete_urls, codec=codec, pq_m=64,
+        codec_train_samples=100000, rerank_vectors=rerank_vectors)
+
+def timed_merge(args):
+    start = time.perf_counter()
+    merge(args)
+    return time.perf_counter() - start
+
+# build the shards of some embedding files, as the index array job would
+def build_shards(files, index_dir, spec, template, chunk_rows):
+    for path in files:
+        index_file(path, path.stem, index_dir, "faiss_shard", False, chunk_rows, False, spec, template, None)
+
+# merged metadata of an output directory, its incremental segments included
+def read_metadata_dir(out_dir):
+    manifest = load_manifest(os.path.join(out_dir, "merged.index"))
+    return pd.concat([pd.read_parquet(p) for p, _ in metadata_parts(os.path.join(out_dir, "merged_metadata.parquet"),
+                                                                    manifest)], ignore_index=True)
+
+# search an output directory the way search_faiss_index.py does, tombstones included
+def search_dir(out_dir, xq, top_k, search_params):
+    index_path = os.path.join(out_dir, "merged.index")
+    index = load_index(index_path, search_params=search_params)
+    return search_vectors(index, xq, top_k, deleted_params(index, index_path))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", type=str, default="/tmp/bench_incremental")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--new_files", type=int, default=1, help="embedding files arriving after the first merge")
+    parser.add_argument("--index_type", type=str, default="flat")
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--search_params", type=str, default=None, help="faiss search parameters, e.g. nprobe=16")
+    parser.add_argument("--delete_urls", type=int, default=100, help="urls to delete after the update")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--chunk_rows", type=int, default=65536)
+    parser.add_argument("--output", type=str, default=None, help="append one json line with the results")
+    args = parser.parse_args()
+
+    shutil.rmtree(args.workdir, ignore_errors=True)
+    prepare_vectors(args.workdir, args.rows, args.dim, args.files, args.queries, args.top_k, args.chunk_rows)
+    xq = np.load(os.path.join(args.workdir, "queries.npy"))
+    gt = np.load(os.path.join(args.workdir, "gt.npy"))
+    files = sorted(Path(args.workdir, "embeddings").glob("*.parquet"))
+    old, new = files[:-args.new_files], files[-args.new_files:]
+    spec = resolve_index_type(args.index_type, args.nlist)
+    template = None
+    if not create_index(args.dim, spec).is_trained:
+        template = os.path.join(args.workdir, "template.index")
+        train_template(old, spec, template, 50000, False, args.chunk_rows)
+
+    index_dir = os.path.join(args.workdir, "index_shards")
+    inc_dir, full_dir = os.path.join(args.workdir, "incremental"), os.path.join(args.workdir, "full")
+    os.makedirs(inc_dir)
+    os.makedirs(full_dir)
+    result = {"rows": args.rows, "files": args.files, "new_files": args.new_files, "factory": spec}
+
+    # first batch: full merge; second batch: incremental update, and a full merge for comparison
+    build_shards(old, index_dir, spec, template, args.chunk_rows)
+    result["first_full_merge_s"] = round(timed_merge(merge_args(index_dir, inc_dir)), 3)
+    build_shards(new, index_dir, spec, template, args.chunk_rows)
+    result["incremental_merge_s"] = round(timed_merge(merge_args(index_dir, inc_dir, incremental=True)), 3)
+    result["full_merge_s"] = round(timed_merge(merge_args(index_dir, full_dir)), 3)
+    result["noop_incremental_s"] = round(timed_merge(merge_args(index_dir, inc_dir, incremental=True)), 3)
+
+    inc_scores, inc_ids = search_dir(inc_dir, xq, args.top_k, args.search_params)
+    full_scores, full_ids = search_dir(full_dir, xq, args.top_k, args.search_params)
+    inc_meta, full_meta = read_metadata_dir(inc_dir), read_metadata_dir(full_dir)
+    inc_store = MetadataStore(os.path.join(inc_dir, "merged_metadata.store"))
+    full_store = MetadataStore(os.path.join(full_dir, "merged_metadata.store"))
+    sample = np.random.default_rng(0).choice(len(full_store), 1000)
+    result["same_ids"] = bool((inc_ids == full_ids).all())
+    result["incremental_recall"] = round(recall_at_k(inc_ids, gt, args.top_k), 4)
+    result["full_recall"] = round(recall_at_k(full_ids, gt, args.top_k), 4)
+    result["same_metadata"] = bool(inc_meta.equals(full_meta) and inc_store.take(sample) == full_store.take(sample))
+    manifest = load_manifest(os.path.join(inc_dir, "merged.index"))
+    print(f"{args.rows} vectors in {args.files} files, {args.new_files} new | {spec}")
+    print(f"first full merge {result['first_full_merge_s']:.2f}s | incremental {result['incremental_merge_s']:.2f}s | "
+          f"full rebuild {result['full_merge_s']:.2f}s | up-to-date check {result['noop_incremental_s']:.3f}s")
+    print(f"incremental matches full rebuild: ids {result['same_ids']} | recall@{args.top_k} "
+          f"{result['incremental_recall']:.4f} vs {result['full_recall']:.4f} | metadata {result['same_metadata']} | "
+          f"manifest version {manifest['version']}, {len(manifest['shards'])} shards, {manifest['ntotal']} vectors, "
+          f"{len(manifest['segments'])} segments")
+
+    # deletes: every row of the first embedding file, plus some urls of the others
+    urls = full_meta["url"].iloc[np.random.default_rng(1).choice(len(full_meta), args.delete_urls)]
+    url_file = os.path.join(args.workdir, "takedown.txt")
+    with open(url_file, "w") as f:
+        f.write("\n".join(urls) + "\n")
+    deleted_args = merge_args(index_dir, inc_dir, True, [files[0].name], url_file)
+    result["delete_s"] = round(timed_merge(deleted_args), 3)
+    deleted = set(load_tombstones(deleted_args.output_index).tolist())
+    _, ids = search_dir(inc_dir, xq, args.top_k, args.search_params)
+    result["tombstones"] = len(deleted)
+    result["deleted_returned"] = int(np.isin(ids, list(deleted)).sum())
+    result["short_results"] = int((ids < 0).any(axis=1).sum())
+
+    # a full rebuild keeps the deletions: the source is left out and the urls are tombstoned again
+    segment_files = index_parts(deleted_args.output_index, load_manifest(deleted_args.output_index))
+    timed_merge(merge_args(index_dir, inc_dir))
+    rebuilt = read_metadata_dir(inc_dir)
+    result["segment_files_left"] = sum(os.path.exists(p) for p in segment_files)
+    tomb = load_tombstones(os.path.join(inc_dir, "merged.index"))
+    _, ids = search_dir(inc_dir, xq, args.top_k, args.search_params)
+    returned = set(rebuilt["url"].to_numpy()[ids[ids >= 0]])
+    result["rebuild_deleted_returned"] = len(returned & set(urls))
+    print(f"deleted {files[0].name} and {args.delete_urls} urls in {result['delete_s']:.2f}s: "
+          f"{result['tombstones']} tombstones, {result['deleted_returned']} returned by search, "
+          f"{result['short_results']} queries short of top-{args.top_k}")
+    print(f"full rebuild after deletes: {len(rebuilt)} rows, {len(tomb)} tombstones, "
+          f"{result['rebuild_deleted_returned']} deleted urls returned, {result['segment_files_left']} segment files left")
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
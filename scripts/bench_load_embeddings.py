@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from embedding_store import EmbeddingWriter, iter_embedding_chunks, read_embedding_matrix, write_sidecar, sidecar_path
+
+# write a synthetic shard of random unit vectors in the embedding parquet layout
+def make_shard(path, rows, dim, batch_rows=8192, seed=0):
+    rng = np.random.default_rng(seed)
+    with EmbeddingWriter(path, dim) as writer:
+        for start in range(0, rows, batch_rows):
+            n = min(batch_rows, rows - start)
+            x = rng.standard_normal((n, dim), dtype=np.float32)
+            ids = np.arange(start, start + n)
+            writer.write_batch(ids, [f"http://example.com/{i}.jpg" for i in ids], [f"caption {i}" for i in ids], x)
+
+# the same shard in the format written before embedding_store.py: a variable-length list<double>
+# embedding column, one pq.write_table call per file
+def make_legacy_shard(path, rows, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = np.arange(rows)
+    x = rng.standard_normal((rows, dim))
+    pq.write_table(pa.table({
+        "sample_id": ids,
+        "url": [f"http://example.com/{i}.jpg" for i in ids],
+        "text": [f"caption {i}" for i in ids],
+        "embedding": pa.ListArray.from_arrays(pa.array(np.arange(0, rows * dim + 1, dim, dtype=np.int32)),
+                                              pa.array(x.reshape(-1))),
+    }), path)
+
+# every loader must return the same float32 matrix as the pandas reference
+def check_methods(path, chunk_rows):
+    expected = load_pandas(path)
+    chunked = np.concatenate(list(iter_embedding_chunks(path, chunk_rows)))
+    for name, x in (("arrow", read_embedding_matrix(path, chunk_rows)), ("arrow_chunked", chunked)):
+        if x.dtype != np.float32 or not np.array_equal(x, expected):
+            raise AssertionError(f"{name} does not match the pandas reference")
+    print(f"arrow and arrow_chunked match pandas on {len(expected)} rows")
+
+# peak resident memory of this process (vmhwm, which unlike ru_maxrss is reset on exec)
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# previous loader: pandas frame plus np.stack over per-row arrays
+def load_pandas(path):
+    df = pd.read_parquet(path)
+    return np.stack(df["embedding"].values).astype("float32")
+
+# run one loading method and return its result dict (called in a fresh process)
+def run_method(method, path, chunk_rows):
+    start = time.perf_counter()
+    rows = 0
+    if method == "pandas":
+        rows = len(load_pandas(path))
+    elif method == "arrow":
+        rows = len(read_embedding_matrix(path, chunk_rows))
+    elif method == "arrow_chunked":
+        for chunk in iter_embedding_chunks(path, chunk_rows):
+            rows += len(chunk)
+    elif method == "sidecar_chunked":
+        for chunk in iter_embedding_chunks(path, chunk_rows, sidecar_path(path)):
+            rows += len(chunk)
+    else:
+        raise ValueError(f"Unknown method: {method}")
+    elapsed = time.perf_counter() - start
+    peak_mb = peak_rss_mb()
+
+    return {"method": method, "rows": rows, "seconds": round(elapsed, 3), "peak_rss_mb": round(peak_mb, 1)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", type=str, default="/tmp/bench_embeddings.parquet")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--chunk_rows", type=int, default=65536)
+    parser.add_argument("--methods", type=str, nargs="+", default=["pandas", "arrow", "arrow_chunked", "sidecar_chunked"])
+    parser.add_argument("--keep", action="store_true")
+
+    # write the synthetic shard as a legacy list<double> file and check every loader reads it correctly
+    parser.add_argument("--legacy", action="store_true")
+
+    # internal: run a single method in this process and print json
+    parser.add_argument("--run", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_method(args.run, args.path, args.chunk_rows)))
+        sys.exit(0)
+
+    if not os.path.exists(args.path):
+        print(f"Writing synthetic shard {args.rows} x {args.dim} to {args.path}")
+        (make_legacy_shard if args.legacy else make_shard)(args.path, args.rows, args.dim)
+    if "sidecar_chunked" in args.methods and not os.path.exists(sidecar_path(args.path)):
+        write_sidecar(args.path)
+
+    # each method runs in its own process so peak rss is measured independently
+    print("-" * 70)
+    for method in args.methods:
+        out = subprocess.run([sys.executable, __file__, "--run", method, "--path", args.path,
+                              "--chunk_rows", str(args.chunk_rows)], capture_output=True, text=True, check=True)
+        r = json.loads(out.stdout.strip().splitlines()[-1])
+        print(f"{r['method']:16s} | rows={r['rows']} | {r['seconds']:.2f}s | peak rss {r['peak_rss_mb']:.0f} MB")
+    print("-" * 70)
+    if args.legacy:
+        check_methods(args.path, args.chunk_rows)
+
+    if not args.keep:
+        os.remove(args.path)
+        if os.path.exists(sidecar_path(args.path)):
+            os.remove(sidecar_path(args.path))
@@ -0,0 +1,137 @@
+import os
+import time
+import json
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+from bench_fetch import serve_images, preprocess
+from bench_pipeline import make_images, size_mb
+from image_fetch import ImageFetcher, Throughput
+from local_cache import FileStager, ImageCache
+
+# node-local caches against a local stand-in for the internet and the nfs share
+#   image cache  urls are served with a fixed latency and some failures; several urls share each image.
+#                the first pass with the cache downloads and stores them, the second (a re-embed with
+#                another model) should make no requests, failed urls are requested again once their
+#                markers are older than the ttl, and a cache smaller than the images evicts
+#   staging      input files are staged cold and warm, then work units are processed with and without
+#                prefetching the next unit's file, counting the time spent waiting for inputs
+
+# fetch every url once, returning images/sec, images loaded and requests made to the server
+def fetch_pass(items, stats, cache, concurrency, batch_size):
+    before = stats.get("requests", 0)
+    fetcher = ImageFetcher(preprocess, concurrency=concurrency, per_host=concurrency, timeout=5, retries=1,
+                           cache=cache)
+    meter = Throughput()
+    for _, batch in fetcher.batches(items, batch_size):
+        meter.add(len(batch))
+    return meter.rate(), fetcher.fetched, stats.get("requests", 0) - before
+
+# input files of about file_mb each, standing in for parquet files on nfs
+def make_inputs(input_dir, files, file_mb):
+    os.makedirs(input_dir, exist_ok=True)
+    rows = int(file_mb * 2**20 / 8 / 64)
+    paths = []
+    for i in range(files):
+        path = os.path.join(input_dir, f"part_{i:03d}.parquet")
+        pd.DataFrame(np.random.default_rng(i).random((rows, 64))).rename(columns=str).to_parquet(path)
+        paths.append(path)
+    return paths
+
+# stage the input of each unit, then work on it for unit_seconds; returns seconds spent waiting for inputs
+def process_units(stager, paths, unit_seconds, prefetch):
+    waited = 0.0
+    for i, path in enumerate(paths):
+        start = time.perf_counter()
+        stager.stage(path)
+        waited += time.perf_counter() - start
+        if prefetch and i + 1 < len(paths):
+            stager.prefetch(paths[i + 1])
+        time.sleep(unit_seconds)
+    return waited
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", type=str, default="/tmp/bench_local_cache")
+    parser.add_argument("--images", type=int, default=100, help="distinct images served")
+    parser.add_argument("--urls", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per image request")
+    parser.add_argument("--fail_rate", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--files", type=int, default=4, help="input files for the staging runs")
+    parser.add_argument("--file_mb", type=float, default=200)
+    parser.add_argument("--unit_seconds", type=float, default=1.0, help="work per unit in the staging runs")
+    parser.add_argument("--output", type=str, default=None, help="append one json line with the results")
+    args = parser.parse_args()
+
+    shutil.rmtree(args.workdir, ignore_errors=True)
+    image_dir = os.path.join(args.workdir, "images")
+    make_images(image_dir, args.images)
+    stats = {}
+    server, base_url, names = serve_images(image_dir, stats=stats)
+    rng = np.random.default_rng(0)
+    items = [(i, f"{base_url}/{names[i % len(names)]}?delay={args.latency}&fail={int(rng.random() < args.fail_rate)}&n={i}")
+             for i in range(args.urls)]
+    result = {"urls": args.urls, "images": args.images, "latency": args.latency}
+
+    cache_dir = os.path.join(args.workdir, "image_cache")
+    rate, fetched, requests = fetch_pass(items, stats, None, args.concurrency, args.batch_size)
+    print(f"{args.urls} urls over {args.images} images, {args.latency * 1000:.0f} ms per request")
+    print(f"no cache   : {rate:7.1f} images/sec | {fetched} images | {requests} requests")
+    cache = ImageCache(cache_dir)
+    cold = fetch_pass(items, stats, cache, args.concurrency, args.batch_size)
+    print(f"cold cache : {cold[0]:7.1f} images/sec | {cold[1]} images | {cold[2]} requests | "
+          f"{size_mb(os.path.join(cache_dir, 'blobs')):.1f} MB in "
+          f"{sum(len(f) for _, _, f in os.walk(os.path.join(cache_dir, 'blobs')))} blobs")
+    warm = fetch_pass(items, stats, ImageCache(cache_dir), args.concurrency, args.batch_size)
+    print(f"warm cache : {warm[0]:7.1f} images/sec | {warm[1]} images | {warm[2]} requests")
+    result.update({"no_cache_rate": round(rate, 1), "cold_rate": round(cold[0], 1), "cold_requests": cold[2],
+                   "warm_rate": round(warm[0], 1), "warm_requests": warm[2], "warm_images": warm[1]})
+
+    # failed urls whose markers are past the ttl are requested again, and the failed retry restarts it
+    markers = [os.path.join(root, f) for root, _, files in os.walk(os.path.join(cache_dir, "urls"))
+               for f in files if f.endswith(".failed")]
+    for m in markers:
+        os.utime(m, (time.time() - 7200, time.time() - 7200))
+    retried = fetch_pass(items, stats, ImageCache(cache_dir, failed_ttl_hours=1), args.concurrency, args.batch_size)
+    again = fetch_pass(items, stats, ImageCache(cache_dir, failed_ttl_hours=1), args.concurrency, args.batch_size)
+    print(f"expired    : {len(markers)} failed markers past the ttl | {retried[2]} requests, then {again[2]}")
+    if retried[2] != len(markers) or again[2] != 0:
+        raise AssertionError(f"expected {len(markers)} retries and then none, got {retried[2]} and {again[2]}")
+    result.update({"failed_markers": len(markers), "expired_requests": retried[2]})
+
+    # a cache holding about half the images stays under its limit
+    limit_mb = size_mb(os.path.join(cache_dir, "blobs")) / 2
+    small = ImageCache(os.path.join(args.workdir, "small_cache"), max_mb=limit_mb)
+    fetch_pass(items, stats, small, args.concurrency, args.batch_size)
+    result["evicted_cache_mb"] = round(size_mb(os.path.join(args.workdir, "small_cache", "blobs")), 2)
+    print(f"bounded    : {result['evicted_cache_mb']:.1f} MB cached with a {limit_mb:.1f} MB limit")
+    server.shutdown()
+
+    # staging: cold copies, up-to-date checks, and units with and without prefetch
+    paths = make_inputs(os.path.join(args.workdir, "nfs"), args.files, args.file_mb)
+    stager = FileStager(os.path.join(args.workdir, "scratch"), log=lambda msg: None)
+    start = time.perf_counter()
+    for p in paths:
+        stager.stage(p)
+    cold_s = time.perf_counter() - start
+    start = time.perf_counter()
+    for p in paths:
+        stager.stage(p)
+    warm_s = time.perf_counter() - start
+    shutil.rmtree(os.path.join(args.workdir, "scratch"))
+    no_prefetch = process_units(FileStager(os.path.join(args.workdir, "scratch"), log=lambda msg: None),
+                                paths, args.unit_seconds, False)
+    shutil.rmtree(os.path.join(args.workdir, "scratch"))
+    prefetched = process_units(FileStager(os.path.join(args.workdir, "scratch"), log=lambda msg: None),
+                               paths, args.unit_seconds, True)
+    result.update({"stage_cold_s": round(cold_s, 3), "stage_warm_s": round(warm_s, 4),
+                   "input_wait_s": round(no_prefetch, 3), "input_wait_prefetch_s": round(prefetched, 3)})
+    print(f"staging    : {args.files} files of {args.file_mb:.0f} MB | cold {cold_s:.2f}s | up to date {warm_s * 1000:.1f} ms | "
+          f"waiting for inputs over {args.files} units: {no_prefetch:.2f}s, {prefetched:.2f}s with prefetch")
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
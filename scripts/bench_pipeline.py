@@ -0,0 +1,328 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+from PIL import Image
+from pathlib import Path
+from datetime import datetime, timezone
+
+# offline end-to-end benchmark: embed, index, merge and search on synthetic laion-like data
+# every stage runs in its own process (peak rss is per stage) and appends one json line per
+# (stage, scale) to the results file, so runs on different commits can be compared directly
+#
+# layout of <workdir>/<rows>/:
+#   images/ laion.parquet         synthetic images and (URL, TEXT) input for the embed stage
+#   embeddings/                   synthetic clustered embedding shards
+#   queries.npy gt.npy            held-out queries and their exact top-k ids
+#   template/ index_shards/       trained template (ivf types) and per-shard indexes
+#   faiss_index/                  merged index, metadata parquet and metadata store
+
+stages = ["embed", "index", "merge", "search"]
+
+# clustered unit vectors generated chunk by chunk, closer to clip embeddings than uniform noise
+# the same seed always gives the same cluster centers; sample_seed picks the points around them
+def clustered_chunks(n, dim, chunk_rows=65536, clusters=256, spread=0.35, seed=0, sample_seed=1):
+    centers = np.random.default_rng(seed).standard_normal((clusters, dim), dtype=np.float32)
+    rng = np.random.default_rng(sample_seed)
+    for start in range(0, n, chunk_rows):
+        m = min(chunk_rows, n - start)
+        x = centers[rng.integers(0, clusters, m)] + spread * rng.standard_normal((m, dim), dtype=np.float32)
+        x /= np.linalg.norm(x, axis=1, keepdims=True)
+        yield x
+
+# write random-noise jpegs of varying size to stand in for downloaded laion images
+def make_images(image_dir, count=32, seed=0):
+    os.makedirs(image_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        w, h = rng.integers(160, 640, 2)
+        pixels = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(image_dir, f"img_{i:03d}.jpg"), quality=85)
+
+# synthetic input parquet in the laion schema, pointing at the local image server
+def make_laion_parquet(path, base_url, names, rows):
+    pd.DataFrame({
+        "URL": [f"{base_url}/{names[i % len(names)]}" for i in range(rows)],
+        "TEXT": [f"synthetic caption {i}" for i in range(rows)],
+    }).to_parquet(path, index=False)
+
+# synthetic embedding shards, held-out queries and exact ground truth for the index stages
+def prepare_vectors(workdir, rows, dim, shards, queries, top_k, chunk_rows=65536):
+    import faiss
+    from embedding_store import EmbeddingWriter
+
+    emb_dir = os.path.join(workdir, "embeddings")
+    os.makedirs(emb_dir, exist_ok=True)
+    exact = faiss.IndexFlatIP(dim)
+    per_shard = -(-rows // shards)
+    start = 0
+    for s in range(shards):
+        n = min(per_shard, rows - start)
+        if n <= 0:
+            break
+        with EmbeddingWriter(os.path.join(emb_dir, f"clip_embeddings_task{s:03d}.parquet"), dim) as writer:
+            for x in clustered_chunks(n, dim, chunk_rows, sample_seed=s + 1):
+                ids = np.arange(start, start + len(x))
+                writer.write_batch(ids, [f"http://bench.local/{i}.jpg" for i in ids],
+                                   [f"synthetic caption {i}" for i in ids], x)
+                exact.add(x)
+                start += len(x)
+
+    # queries come from the same clusters but are not part of the base
+    xq = next(clustered_chunks(queries, dim, queries, sample_seed=0))
+    _, gt = exact.search(xq, top_k)
+    np.save(os.path.join(workdir, "queries.npy"), xq)
+    np.save(os.path.join(workdir, "gt.npy"), gt)
+
+# stand-in image encoder: a fixed random projection of a pooled image, no weights to download
+class RandomProjectionEncoder:
+    def __init__(self, dim, seed=0):
+        import torch
+        g = torch.Generator().manual_seed(seed)
+        self.proj = torch.randn(3 * 32 * 32, dim, generator=g)
+
+    def encode_image(self, x):
+        import torch
+        pooled = torch.nn.functional.adaptive_avg_pool2d(x, 32).flatten(1)
+        return pooled @ self.proj
+
+# total size of a file or directory in mb
+def size_mb(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path) / 2**20
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file()) / 2**20
+
+# fetch, decode, encode and write embeddings the way embed_clip does, against the local server
+def run_embed(workdir, rows, args):
+    import torch
+    from bench_fetch import preprocess, serve_images
+    from image_fetch import ImageFetcher
+    from embedding_store import EmbeddingWriter
+
+    image_dir = os.path.join(workdir, "images")
+    make_images(image_dir)
+    server, base_url, names = serve_images(image_dir)
+    laion_path = os.path.join(workdir, "laion.parquet")
+    make_laion_parquet(laion_path, base_url, names, rows)
+
+    if args.encoder == "clip":
+        # only works offline when the weights are already in the clip download cache
+        import clip
+        model, _ = clip.load("ViT-B/32", device="cpu")
+        dim = model.visual.output_dim
+    else:
+        model, dim = RandomProjectionEncoder(args.dim), args.dim
+
+    out_path = os.path.join(workdir, "embed_output.parquet")
+    start = time.perf_counter()
+    df = pd.read_parquet(laion_path)
+    fetcher = ImageFetcher(preprocess, concurrency=args.fetch_concurrency, per_host=args.fetch_concurrency)
+    items = ((i, row["URL"]) for i, row in df.iterrows())
+    with EmbeddingWriter(out_path, dim) as writer:
+        for ids, batch in fetcher.batches(items, args.batch_size):
+            with torch.no_grad():
+                z = model.encode_image(torch.stack(batch)).float().numpy()
+            writer.write_batch(ids, [df.loc[i, "URL"] for i in ids], [df.loc[i, "TEXT"] for i in ids], z)
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    return {
+        "encoder": args.encoder,
+        "seconds": round(elapsed, 3),
+        "images_per_s": round(fetcher.fetched / elapsed, 1),
+        "fetched": fetcher.fetched,
+        "failed": fetcher.failed,
+        "output_mb": round(size_mb(out_path), 2),
+    }
+
+# build one index shard per embedding file, training a shared template first when needed
+def run_index(workdir, rows, args):
+    from build_faiss_index import resolve_index_type, create_index, train_template, build_index, save_outputs
+    from embedding_store import iter_embedding_chunks, read_metadata
+
+    files = sorted(Path(workdir, "embeddings").glob("*.parquet"))
+    spec = resolve_index_type(args.index_type, args.nlist, args.pq_m)
+    index_dir = os.path.join(workdir, "index_shards")
+    shutil.rmtree(index_dir, ignore_errors=True)
+
+    train_s, template = 0.0, None
+    if not create_index(args.dim, spec).is_trained:
+        template = os.path.join(workdir, "template", "template.index")
+        start = time.perf_counter()
+        train_template(files, spec, template, args.train_samples, False, args.chunk_rows)
+        train_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectors = 0
+    for path in files:
+        index = build_index(iter_embedding_chunks(path, args.chunk_rows), False, spec, template)
+        save_outputs(index, read_metadata(path), index_dir, path.stem, "faiss_shard")
+        vectors += index.ntotal
+        del index
+    elapsed = time.perf_counter() - start
+
+    return {
+        "factory": spec,
+        "shards": len(files),
+        "train_s": round(train_s, 3),
+        "seconds": round(elapsed, 3),
+        "vectors_per_s": round(vectors / elapsed, 1),
+        "index_mb": round(sum(size_mb(p) for p in Path(index_dir).glob("*.index")), 2),
+    }
+
+# merge the index shards and their metadata into faiss_index/
+def run_merge(workdir, rows, args):
+    import faiss
+    from merge_faiss_shards import merge_indexes, merge_metadata, publish
+
+    index_dir = os.path.join(workdir, "index_shards")
+    out_dir = os.path.join(workdir, "faiss_index")
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    index_path = os.path.join(out_dir, "merged.index")
+    meta_path = os.path.join(out_dir, "merged_metadata.parquet")
+    store_path = os.path.join(out_dir, "merged_metadata.store")
+
+    start = time.perf_counter()
+    merged = merge_indexes(index_dir, False)
+    faiss.write_index(merged, index_path)
+    vectors = merged.ntotal
+    del merged
+    index_s = time.perf_counter() - start
+    publish(merge_metadata(index_dir, meta_path, store_path)[2])
+    elapsed = time.perf_counter() - start
+
+    return {
+        "seconds": round(elapsed, 3),
+        "index_merge_s": round(index_s, 3),
+        "vectors_per_s": round(vectors / elapsed, 1),
+        "index_mb": round(size_mb(index_path), 2),
+        "metadata_mb": round(size_mb(meta_path) + size_mb(store_path), 2),
+    }
+
+# single-query latency, batched throughput and recall@k against the exact ground truth
+def run_search(workdir, rows, args):
+    from search_faiss_index import load_index, load_metadata, search_vectors, search_batch
+    from bench_ann_recall import recall_at_k
+
+    out_dir = os.path.join(workdir, "faiss_index")
+    index = load_index(os.path.join(out_dir, "merged.index"), search_params=args.search_params)
+    metadata = load_metadata(os.path.join(out_dir, "merged_metadata.parquet"))
+    xq = np.load(os.path.join(workdir, "queries.npy"))
+    gt = np.load(os.path.join(workdir, "gt.npy"))
+
+    # one query at a time, including the metadata lookup, as an interactive user would
+    latencies = []
+    for q in xq[:args.latency_queries]:
+        start = time.perf_counter()
+        search_batch(index, metadata, q.reshape(1, -1), args.top_k)
+        latencies.append(time.perf_counter() - start)
+    lat = np.array(latencies) * 1000
+
+    start = time.perf_counter()
+    _, ids = search_vectors(index, xq, args.top_k)
+    batch_s = time.perf_counter() - start
+
+    return {
+        "search_params": args.search_params,
+        "p50_ms": round(float(np.percentile(lat, 50)), 3),
+        "p99_ms": round(float(np.percentile(lat, 99)), 3),
+        "batch_qps": round(len(xq) / batch_s, 1),
+        f"recall_at_{args.top_k}": round(recall_at_k(ids, gt, args.top_k), 4),
+    }
+
+# run one stage in this process and return its result dict (called in a fresh process)
+def run_stage(stage, workdir, rows, args):
+    from bench_load_embeddings import peak_rss_mb
+    runners = {"embed": run_embed, "index": run_index, "merge": run_merge, "search": run_search}
+    if stage not in runners:
+        raise ValueError(f"Unknown stage: {stage}")
+    result = runners[stage](workdir, rows, args)
+    return {"stage": stage, "rows": rows, **result, "peak_rss_mb": round(peak_rss_mb(), 1)}
+
+# current git commit, so results can be lined up with the change that produced them
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", type=str, default="/tmp/bench_pipeline")
+    parser.add_argument("--output", type=str, default="bench_results.jsonl", help="json lines file results are appended to")
+    parser.add_argument("--stages", type=str, nargs="+", default=stages, choices=stages)
+
+    # vectors per run for the index, merge and search stages, and images per run for embed
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--embed_scales", type=int, nargs="+", default=[200, 1000])
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--shards", type=int, default=4)
+
+    # embed stage: random projection stand-in, or clip when its weights are cached locally
+    parser.add_argument("--encoder", type=str, default="random", choices=["random", "clip"])
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--fetch_concurrency", type=int, default=16)
+
+    # index stage settings, as in build_faiss_index
+    parser.add_argument("--index_type", type=str, default="flat")
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--pq_m", type=int, default=64)
+    parser.add_argument("--train_samples", type=int, default=50000)
+    parser.add_argument("--chunk_rows", type=int, default=65536)
+
+    # search stage settings
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--latency_queries", type=int, default=200)
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--search_params", type=str, default=None, help="faiss search parameters, e.g. nprobe=16")
+    parser.add_argument("--keep", action="store_true", help="keep the generated data in the workdir")
+
+    # internal: run a single stage in this process and print json
+    parser.add_argument("--run", type=str, default=None)
+    parser.add_argument("--rows", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_stage(args.run, os.path.join(args.workdir, str(args.rows)), args.rows, args)))
+        sys.exit(0)
+
+    # every run shares one timestamp and commit so its lines can be grouped later
+    run_info = {"timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"), "commit": git_commit(),
+                "dim": args.dim, "index_type": args.index_type}
+    plan = []
+    if "embed" in args.stages:
+        plan += [("embed", rows) for rows in args.embed_scales]
+    for rows in args.scales:
+        plan += [(stage, rows) for stage in stages[1:] if stage in args.stages]
+
+    print("-" * 90)
+    for stage, rows in plan:
+        workdir = os.path.join(args.workdir, str(rows))
+        if stage in ("index", "merge", "search") and not os.path.exists(os.path.join(workdir, "gt.npy")):
+            print(f"Generating {rows} x {args.dim} synthetic embeddings in {args.shards} shards")
+            prepare_vectors(workdir, rows, args.dim, args.shards, args.queries, args.top_k, args.chunk_rows)
+        os.makedirs(workdir, exist_ok=True)
+
+        # forward every option so the stage process sees the same settings
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:],
+                              "--run", stage, "--rows", str(rows)],
+                             capture_output=True, text=True, check=True)
+        r = json.loads(out.stdout.strip().splitlines()[-1])
+        with open(args.output, "a") as f:
+            f.write(json.dumps({**run_info, **r}) + "\n")
+
+        metrics = " | ".join(f"{k}={v}" for k, v in r.items() if k not in ("stage", "rows"))
+        print(f"{stage:7s} rows={rows:<9d} | {metrics}")
+    print("-" * 90)
+    print(f"Results appended to: {args.output}")
+
+    if not args.keep:
+        shutil.rmtree(args.workdir, ignore_errors=True)
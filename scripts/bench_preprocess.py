@@ -0,0 +1,98 @@
+import io
+import os
+import time
+import json
+import argparse
+import numpy as np
+import torch
+from PIL import Image
+from search_faiss_index import preprocess
+from image_preprocess import DecodePool, decode_uint8, to_model_input
+
+# images/sec of clip preprocessing from jpeg bytes: the current full-resolution decode plus
+# torchvision transform, draft-mode decode inline, and draft-mode decode in a process pool;
+# then checks that clip embeddings of draft-decoded images stay within tolerance of the current ones
+
+# synthetic multi-megapixel jpegs: smooth gradients plus noise, closer to photos than pure noise
+def make_images(image_dir, count, min_side, max_side, seed=0):
+    os.makedirs(image_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(count):
+        w, h = rng.integers(min_side, max_side, 2)
+        yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+        base = np.stack([np.sin(xx / rng.uniform(20, 200) + c) * np.cos(yy / rng.uniform(20, 200) - c)
+                         for c in range(3)], axis=2)
+        pixels = np.clip(127 + 100 * base + rng.normal(0, 12, (h, w, 3)), 0, 255).astype(np.uint8)
+        path = os.path.join(image_dir, f"img_{i:03d}.jpg")
+        Image.fromarray(pixels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+# the current path: full decode and the torchvision transform on the calling thread
+def baseline(data):
+    return preprocess(Image.open(io.BytesIO(data)).convert("RGB"))
+
+def rate(fn, blobs, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(blobs)
+    return repeat * len(blobs) / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", type=str, default="/tmp/bench_preprocess")
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--min_side", type=int, default=1200)
+    parser.add_argument("--max_side", type=int, default=4000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--gate_dir", type=str, default=os.path.join(os.path.dirname(__file__), "..", "test_inputs"))
+    parser.add_argument("--min_cosine", type=float, default=0.99)
+    parser.add_argument("--no_embed", action="store_true", help="skip the clip embedding check")
+    parser.add_argument("--output", type=str, default=None, help="append one json line per setting")
+    args = parser.parse_args()
+
+    paths = make_images(os.path.join(args.workdir, "images"), args.images, args.min_side, args.max_side)
+    blobs = [open(p, "rb").read() for p in paths]
+    mpix = np.mean([np.prod(Image.open(p).size) for p in paths]) / 1e6
+    print(f"{len(blobs)} jpegs, {mpix:.1f} megapixels on average")
+
+    print("-" * 70)
+    results = []
+    settings = [("full decode + transform", lambda b: [baseline(x) for x in b]),
+                ("draft decode, inline", lambda b: to_model_input([decode_uint8(x) for x in b]))]
+    for name, fn in settings:
+        results.append({"setting": name, "workers": 0, "images_per_sec": round(rate(fn, blobs, args.repeat), 2)})
+    for workers in args.workers:
+        with DecodePool(workers) as pool:
+            pool.map(blobs[:workers])
+            fn = lambda b: to_model_input(pool.map(b))
+            results.append({"setting": "draft decode, process pool", "workers": workers,
+                            "images_per_sec": round(rate(fn, blobs, args.repeat), 2)})
+    for r in results:
+        print(f"{r['setting']:28s} | workers {r['workers']} | {r['images_per_sec']:8.1f} img/s")
+
+    if not args.no_embed:
+        import clip
+        model, _ = clip.load("ViT-B/32", device="cpu")
+        gate = sorted(os.path.join(args.gate_dir, f) for f in os.listdir(args.gate_dir)
+                      if f.lower().endswith((".png", ".jpg", ".jpeg")))
+        check = [open(p, "rb").read() for p in gate] + blobs
+        with torch.no_grad():
+            ref = model.encode_image(torch.stack([baseline(b) for b in check])).float().numpy()
+            out = model.encode_image(to_model_input([decode_uint8(b) for b in check])).float().numpy()
+        ref /= np.linalg.norm(ref, axis=1, keepdims=True)
+        out /= np.linalg.norm(out, axis=1, keepdims=True)
+        cos = (ref * out).sum(axis=1)
+        ok = bool(cos.min() >= args.min_cosine)
+        print("-" * 70)
+        print(f"embedding check on {len(check)} images: min cos {cos.min():.5f} | mean cos {cos.mean():.5f} | "
+              f"{'pass' if ok else 'FAIL'} (threshold {args.min_cosine})")
+        for r in results:
+            r.update({"min_cosine": round(float(cos.min()), 5), "gate_passed": ok})
+
+    if args.output:
+        with open(args.output, "a") as f:
+            for r in results:
+                f.write(json.dumps(r) + "\n")
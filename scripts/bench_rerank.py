@@ -0,0 +1,92 @@
+import os
+import time
+import json
+import shutil
+import argparse
+import numpy as np
+from pathlib import Path
+import build_faiss_index
+from bench_pipeline import prepare_vectors, size_mb
+from bench_ann_recall import recall_at_k
+from bench_incremental import merge_args, build_shards
+from build_faiss_index import resolve_index_type, create_index, train_template
+from merge_faiss_shards import merge
+from index_manifest import vectors_path_for
+from search_faiss_index import load_index, load_rerank_vectors, search_ids, deleted_params
+
+# two-stage retrieval on a compressed merged index: shards are built with --rerank_vectors and merged
+# with --rerank_vectors, then queries are searched with the index alone and with the top N candidates
+# re-ranked exactly from the memory-mapped vector file, for each N. reported per N: recall@k against
+# exact float32 search and ms per query, both one query per call (as the interactive search does) and
+# all queries in one call (batch mode and the server's micro-batches)
+# --codec merges flat shards into a compressed flat index instead of building compressed shards
+
+def timed_search(index, xq, top_k, params, vectors, candidates, batched):
+    start = time.perf_counter()
+    if batched:
+        ids = search_ids(index, xq, top_k, params, None, vectors, candidates)[1]
+    else:
+        ids = np.concatenate([search_ids(index, xq[i:i + 1], top_k, params, None, vectors, candidates)[1]
+                              for i in range(len(xq))])
+    return ids, (time.perf_counter() - start) * 1000 / len(xq)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", type=str, default="/tmp/bench_rerank")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--index_type", type=str, default="ivfpq")
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--pq_m", type=int, default=32)
+    parser.add_argument("--codec", type=str, default=None, help="merge flat shards with this codec (int8, pq)")
+    parser.add_argument("--search_params", type=str, default="nprobe=16", help="faiss search parameters")
+    parser.add_argument("--candidates", type=int, nargs="+", default=[10, 20, 50, 100, 200, 500, 1000])
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--chunk_rows", type=int, default=65536)
+    parser.add_argument("--output", type=str, default=None, help="append one json line per configuration")
+    args = parser.parse_args()
+
+    shutil.rmtree(args.workdir, ignore_errors=True)
+    prepare_vectors(args.workdir, args.rows, args.dim, args.files, args.queries, args.top_k, args.chunk_rows)
+    xq = np.load(os.path.join(args.workdir, "queries.npy"))
+    gt = np.load(os.path.join(args.workdir, "gt.npy"))
+    files = sorted(Path(args.workdir, "embeddings").glob("*.parquet"))
+    spec = resolve_index_type("flat" if args.codec else args.index_type, args.nlist, args.pq_m)
+    template = None
+    if not create_index(args.dim, spec).is_trained:
+        template = os.path.join(args.workdir, "template.index")
+        train_template(files, spec, template, 50000, False, args.chunk_rows)
+
+    index_dir, out_dir = os.path.join(args.workdir, "index_shards"), os.path.join(args.workdir, "merged")
+    os.makedirs(out_dir)
+    build_faiss_index.rerank_vectors = True
+    build_shards(files, index_dir, spec, template, args.chunk_rows)
+    merge_opts = merge_args(index_dir, out_dir, codec=args.codec, rerank_vectors=True)
+    merge_opts.pq_m = args.pq_m
+    merge(merge_opts)
+
+    index_path = os.path.join(out_dir, "merged.index")
+    index = load_index(index_path, search_params=args.search_params if template else None)
+    params = deleted_params(index, index_path)
+    vectors = load_rerank_vectors(index_path, index)
+    name = f"flat+{args.codec}" if args.codec else spec
+    print(f"{index.ntotal} x {args.dim} vectors | {name} {args.search_params if template else ''} | "
+          f"index {size_mb(index_path):.1f} MB, vector file {os.path.getsize(vectors_path_for(index_path)) / 2**20:.1f} MB")
+    print(f"{len(xq)} queries, recall@{args.top_k} against exact float32 search")
+
+    for candidates in [0] + args.candidates:
+        result = {"rows": index.ntotal, "dim": args.dim, "index": name, "search_params": args.search_params,
+                  "top_k": args.top_k, "candidates": candidates}
+        for batched in (False, True):
+            ids, ms = timed_search(index, xq, args.top_k, params, vectors if candidates else None, candidates, batched)
+            mode = "batched" if batched else "single"
+            result[f"{mode}_recall"] = round(recall_at_k(ids, gt, args.top_k), 4)
+            result[f"{mode}_ms_per_query"] = round(ms, 3)
+        label = f"rerank {candidates:5d}" if candidates else "no rerank   "
+        print(f"{label} | recall {result['batched_recall']:.4f} | single {result['single_ms_per_query']:7.3f} ms/query "
+              f"| batched {result['batched_ms_per_query']:7.3f} ms/query")
+        if args.output:
+            with open(args.output, "a") as f:
+                f.write(json.dumps(result) + "\n")
@@ -0,0 +1,138 @@
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+import faiss
+from bench_pipeline import clustered_chunks
+from shard_search import ScatterGather, read_registry
+
+# local stand-in for one shard worker per node: several worker processes serve the shards of a
+# synthetic index directory; scatter-gather results are compared against one flat index over every
+# shard, then one worker is killed and one made slow to check partial results and timeouts
+
+# flat shards and metadata in the layout build_faiss_index.py writes
+def make_shards(index_dir, rows, dim, shards):
+    os.makedirs(index_dir, exist_ok=True)
+    exact = faiss.IndexFlatIP(dim)
+    per_shard = -(-rows // shards)
+    start = 0
+    for s in range(shards):
+        n = min(per_shard, rows - start)
+        x = np.concatenate(list(clustered_chunks(n, dim, sample_seed=s + 1)))
+        index = faiss.IndexFlatIP(dim)
+        index.add(x)
+        exact.add(x)
+        faiss.write_index(index, os.path.join(index_dir, f"faiss_shard_task{s:03d}.index"))
+        ids = np.arange(start, start + n)
+        pd.DataFrame({"sample_id": ids, "url": [f"http://bench.local/{i}.jpg" for i in ids],
+                      "text": [f"synthetic caption {i}" for i in ids]}).to_parquet(
+            os.path.join(index_dir, f"faiss_shard_task{s:03d}.meta.parquet"), index=False)
+        start += n
+    return exact
+
+# start worker processes and wait until all of them are registered
+def start_workers(index_dir, registry_dir, workers, delay_ms=None):
+    os.makedirs(registry_dir, exist_ok=True)
+    procs = []
+    for w in range(workers):
+        cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "shard_search.py"),
+               "--index_dir", index_dir, "--worker_id", str(w), "--num_workers", str(workers),
+               "--host", "127.0.0.1", "--registry_dir", registry_dir]
+        if delay_ms and w == workers - 1:
+            cmd += ["--delay_ms", str(delay_ms)]
+        procs.append(subprocess.Popen(cmd, stdout=subprocess.DEVNULL))
+    while len(read_registry(registry_dir)) < workers:
+        if any(p.poll() is not None for p in procs):
+            raise RuntimeError("a shard worker exited during startup")
+        time.sleep(0.1)
+    return procs
+
+def stop_workers(procs):
+    for p in procs:
+        p.terminate()
+    for p in procs:
+        p.wait()
+
+# search the queries in batches, returning every hit list and the p50/p99 latency per batch in ms
+def search_all(sg, xq, top_k, batch):
+    hits, times, partial = [], [], 0
+    for start in range(0, len(xq), batch):
+        t = time.perf_counter()
+        batch_hits, status = sg.search(xq[start:start + batch], top_k)
+        times.append(time.perf_counter() - t)
+        hits.extend(batch_hits)
+        partial += status["partial"]
+    return hits, np.percentile(times, 50) * 1000, np.percentile(times, 99) * 1000, partial
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", type=str, default="/tmp/bench_shard_search")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("--batch", type=int, default=8, help="queries per scatter-gather call")
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=2.0)
+    parser.add_argument("--output", type=str, default=None, help="append one json line with the results")
+    args = parser.parse_args()
+
+    shutil.rmtree(args.workdir, ignore_errors=True)
+    index_dir = os.path.join(args.workdir, "index_shards")
+    exact = make_shards(index_dir, args.rows, args.dim, args.shards)
+    xq = next(clustered_chunks(args.queries, args.dim, args.queries, sample_seed=0))
+    faiss.normalize_L2(xq)
+    gt_scores, gt_ids = exact.search(xq, args.top_k)
+    print(f"{args.rows} vectors in {args.shards} shards | {args.workers} workers | {args.queries} queries")
+
+    registry_dir = os.path.join(args.workdir, "registry")
+    procs = start_workers(index_dir, registry_dir, args.workers)
+    result = {"rows": args.rows, "shards": args.shards, "workers": args.workers, "top_k": args.top_k}
+    try:
+        sg = ScatterGather(read_registry(registry_dir), args.timeout)
+        hits, p50, p99, partial = search_all(sg, xq, args.top_k, args.batch)
+        ids = np.array([[h["id"] for h in q] + [-1] * (args.top_k - len(q)) for q in hits])
+        scores = np.array([[h["score"] for h in q] + [0.0] * (args.top_k - len(q)) for q in hits])
+        # ids can only differ where two candidates tie on score
+        result["id_overlap"] = float(np.mean([len(set(a) & set(b)) / args.top_k for a, b in zip(ids, gt_ids)]))
+        result["max_score_diff"] = float(np.abs(scores - gt_scores).max())
+        result["p50_ms"], result["p99_ms"], result["partial_batches"] = round(p50, 2), round(p99, 2), partial
+        print(f"all workers : {result['id_overlap']:.2%} of ids match the merged flat index | "
+              f"max score diff {result['max_score_diff']:.2e} | p50 {p50:.1f} ms p99 {p99:.1f} ms "
+              f"per batch of {args.batch} | {partial} partial batches")
+
+        # a failed worker: its shards drop out, the rest still answer
+        procs[0].terminate()
+        procs[0].wait()
+        hits, status = sg.search(xq[:args.batch], args.top_k)
+        found = np.mean([len(q) == args.top_k for q in hits])
+        result["failed_worker_status"] = status
+        print(f"one killed  : partial={status['partial']} answered {status['answered']}/{status['workers']} "
+              f"failed {len(status['failed'])} | {found:.0%} of queries still have top-{args.top_k}")
+    finally:
+        stop_workers(procs)
+
+    # a slow worker: the coordinator returns at the deadline without it
+    shutil.rmtree(registry_dir)
+    procs = start_workers(index_dir, registry_dir, args.workers, delay_ms=args.timeout * 2000)
+    try:
+        sg = ScatterGather(read_registry(registry_dir), args.timeout)
+        t = time.perf_counter()
+        hits, status = sg.search(xq[:args.batch], args.top_k)
+        elapsed = time.perf_counter() - t
+        result["slow_worker_status"] = status
+        result["slow_worker_seconds"] = round(elapsed, 3)
+        print(f"one slow    : partial={status['partial']} timed out {len(status['timed_out'])} | "
+              f"returned after {elapsed:.2f}s (timeout {args.timeout}s)")
+    finally:
+        stop_workers(procs)
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import subprocess
+import pyarrow as pa
+import pyarrow.parquet as pq
+from work_queue import WorkQueue, plan_units
+
+# local stand-in for a slurm array: several worker processes on one machine share a queue
+# directory, with skewed input file sizes and optionally one worker that crashes mid-unit
+
+# synthetic input files in the laion schema, sizes skewed so one file dominates
+def make_inputs(input_dir, files, base_rows, skew, row_group_rows):
+    os.makedirs(input_dir, exist_ok=True)
+    paths = []
+    for i in range(files):
+        rows = int(base_rows * (skew if i == 0 else 1))
+        table = pa.table({"URL": [f"http://example.com/{i}/{j}.jpg" for j in range(rows)],
+                          "TEXT": [f"caption {j}" for j in range(rows)]})
+        path = os.path.join(input_dir, f"part_{i:03d}.parquet")
+        pq.write_table(table, path, row_group_size=row_group_rows)
+        paths.append(path)
+    return paths
+
+# one worker process: lease units and "process" them by sleeping per row
+def run_worker(queue_dir, worker, row_cost, lease_seconds, crash):
+    queue = WorkQueue(queue_dir, worker, lease_seconds)
+    with open(os.path.join(queue_dir, "units.json")) as f:
+        queue.units = json.load(f)
+    start = time.perf_counter()
+    rows = 0
+
+    def process(unit):
+        nonlocal rows
+        if crash:
+            # die while holding the lease, so the unit is only recovered through expiry
+            os._exit(1)
+        time.sleep((unit["stop"] - unit["start"]) * row_cost)
+        rows += unit["stop"] - unit["start"]
+
+    done, failed = queue.run(process, log=lambda msg: None)
+    print(json.dumps({"worker": worker, "units": done, "failed": failed, "rows": rows,
+                      "seconds": round(time.perf_counter() - start, 3)}))
+
+# the old scheme: worker i takes whole files i, i + workers, ...
+def run_static(paths, workers, row_cost):
+    finish = []
+    for w in range(workers):
+        rows = sum(pq.ParquetFile(p).metadata.num_rows for p in paths[w::workers])
+        finish.append(rows * row_cost)
+    return finish
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workdir", type=str, default="/tmp/bench_work_queue")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--base_rows", type=int, default=2000)
+    parser.add_argument("--skew", type=float, default=8, help="size multiplier of the first file")
+    parser.add_argument("--row_group_rows", type=int, default=250)
+    parser.add_argument("--unit_rows", type=int, default=500)
+    parser.add_argument("--row_cost", type=float, default=0.0005, help="simulated seconds per row")
+    parser.add_argument("--lease_seconds", type=float, default=2)
+    parser.add_argument("--crash", action="store_true", help="make one extra worker crash while holding a lease")
+
+    # internal: run a single worker in this process
+    parser.add_argument("--worker", type=str, default=None)
+    parser.add_argument("--crash_worker", action="store_true")
+    args = parser.parse_args()
+
+    queue_dir = os.path.join(args.workdir, "queue")
+    if args.worker:
+        run_worker(queue_dir, args.worker, args.row_cost, args.lease_seconds, args.crash_worker)
+        sys.exit(0)
+
+    shutil.rmtree(args.workdir, ignore_errors=True)
+    paths = make_inputs(os.path.join(args.workdir, "inputs"), args.files, args.base_rows, args.skew, args.row_group_rows)
+    units = WorkQueue(queue_dir).init(plan_units(paths, args.unit_rows))
+    total_rows = sum(u["stop"] - u["start"] for u in units)
+    print(f"{len(paths)} files, {total_rows} rows, {len(units)} units | {args.workers} workers")
+
+    # the crashing worker starts first so it is guaranteed to hold a lease when it dies
+    base = [sys.executable, os.path.abspath(__file__), "--workdir", args.workdir,
+            "--row_cost", str(args.row_cost), "--lease_seconds", str(args.lease_seconds)]
+    procs = []
+    if args.crash:
+        subprocess.run(base + ["--worker", "crash", "--crash_worker"])
+    start = time.perf_counter()
+    for w in range(args.workers):
+        procs.append(subprocess.Popen(base + ["--worker", f"w{w}"], stdout=subprocess.PIPE, text=True))
+    results = [json.loads(p.communicate()[0].strip().splitlines()[-1]) for p in procs]
+    makespan = time.perf_counter() - start
+
+    static = run_static(paths, args.workers, args.row_cost)
+    print("-" * 70)
+    for r in results:
+        print(f"{r['worker']:4s} | units={r['units']:3d} rows={r['rows']:7d} | finished after {r['seconds']:.2f}s")
+    finish = [r["seconds"] for r in results]
+    print("-" * 70)
+    print(f"queue : makespan {makespan:.2f}s | finish spread {max(finish) - min(finish):.2f}s")
+    print(f"static: makespan {max(static):.2f}s | finish spread {max(static) - min(static):.2f}s (simulated)")
+
+    status = WorkQueue(queue_dir)
+    status.units = units
+    print(f"queue status: {status.status()}")
+    rows_done = sum(r["rows"] for r in results)
+    if rows_done != total_rows:
+        print(f"WARNING: {rows_done} rows processed, expected {total_rows}")
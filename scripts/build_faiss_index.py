@@ -1,14 +1,36 @@
 import os
+import time
 import faiss
+import shutil
 import argparse
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pathlib import Path
 from datetime import datetime
+from embedding_store import (shard_metadata_schema, iter_embedding_chunks, read_embedding_matrix, read_metadata,
+                             sidecar_path, CheckpointWriter)
+from work_queue import WorkQueue, plan_units
+from dedup import load_near_duplicates, duplicates_total
+from index_manifest import indexed_sources
+from local_cache import FileStager
+from pipeline_metrics import counter, gauge, histogram, timed, start_textfile, default_textfile_dir
 
 # get slurm array task id for parallel file indexing
 task_id = int(os.environ.get("SLURM_ARRAY_TASK_ID", -1))
 
+# indexing metrics, exported through the node exporter textfile collector
+add_seconds = histogram("laion_index_add_seconds", "index.add time per chunk")
+vectors_indexed = counter("laion_vectors_indexed_total", "Vectors added to the index")
+index_rate = gauge("laion_index_vectors_per_second", "Vectors added per second of index.add time")
+
+# node-local staging of embedding files, set up by main when a scratch directory is given
+stager = None
+
+# whether shards also get a full-precision vector file for re-ranking, set by main
+rerank_vectors = False
+
 # logging helper to print and optionally save messages to a file
 def log(msg, log_file=None):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -18,66 +40,348 @@ def log(msg, log_file=None):
         with open(log_file, "a") as f:
             f.write(full_msg + "\n")
 
-# load clip embeddings and metadata from a parquet file
-def load_embeddings(path):
-    df = pd.read_parquet(path)
-    
-    # convert list of vectors to numpy array
-    x = np.stack(df["embedding"].values).astype("float32")  
-    # extract metadata fields
-    meta = df[["sample_id", "url", "text"]]  
-                   
-    return x, meta
-
-# build faiss index from numpy matrix (optionally l2-normalize)
-def build_index(x, normalize):
+# shorthand names for common index types, expanded into faiss factory strings
+index_presets = {
+    "flat": "Flat",
+    "ivf": "IVF{nlist},Flat",
+    "ivfpq": "IVF{nlist},PQ{pq_m}",
+    "opq": "OPQ{pq_m},IVF{nlist},PQ{pq_m}",
+    "hnsw": "HNSW32",
+}
+
+# resolve a preset name or a raw faiss factory string
+def resolve_index_type(index_type, nlist=1024, pq_m=64):
+    spec = index_presets.get(index_type.lower(), index_type)
+    return spec.format(nlist=nlist, pq_m=pq_m)
+
+# create an empty inner product index from a factory string
+def create_index(dim, spec):
+    # keep the plain flat index for the default, as before
+    if spec == "Flat":
+        return faiss.IndexFlatIP(dim)
+    return faiss.index_factory(dim, spec, faiss.METRIC_INNER_PRODUCT)
+
+# draw a random training sample spread evenly across the embedding shards
+def sample_training_vectors(files, n, chunk_rows=65536, seed=0):
+    rng = np.random.default_rng(seed)
+    per_file = max(1, n // len(files))
+    parts = []
+    for path in files:
+        rows = pq.ParquetFile(path).metadata.num_rows
+        keep = np.sort(rng.choice(rows, size=min(per_file, rows), replace=False))
+        start = 0
+        for x in iter_embedding_chunks(path, chunk_rows):
+            # pick sampled rows that fall inside this chunk
+            lo, hi = np.searchsorted(keep, [start, start + len(x)])
+            if hi > lo:
+                parts.append(x[keep[lo:hi] - start])
+            start += len(x)
+    return np.ascontiguousarray(np.concatenate(parts), dtype=np.float32)
+
+# train an empty template index on a sample of all shards so every task shares one quantizer
+def train_template(files, spec, template_path, train_samples, normalize, chunk_rows, log_file=None):
+    x = sample_training_vectors(files, train_samples, chunk_rows)
     if normalize:
         faiss.normalize_L2(x)
-    
-    # use inner product for similarity
-    index = faiss.IndexFlatIP(x.shape[1])  
-    index.add(x)
-    
+    log(f"[TRAIN] Sampled {x.shape[0]} training vectors from {len(files)} files", log_file)
+
+    index = create_index(x.shape[1], spec)
+    if not index.is_trained:
+        index.train(x)
+    log(f"[TRAIN] Trained {spec} index", log_file)
+
+    os.makedirs(os.path.dirname(os.path.abspath(template_path)), exist_ok=True)
+    faiss.write_index(index, template_path)
+    log(f"[TRAIN] Saved template index to {template_path}", log_file)
+
+# build faiss index from float32 chunks (optionally l2-normalize), adding incrementally
+# adds into a copy of the trained template when one is given, and writes the added vectors to
+# vectors (a VectorFileWriter) when one is given
+def build_index(chunks, normalize, spec="Flat", template=None, vectors=None):
+    index = faiss.read_index(template) if template else None
+    busy = 0.0
+    for x in chunks:
+        if normalize:
+            faiss.normalize_L2(x)
+
+        # use inner product for similarity
+        if index is None:
+            index = create_index(x.shape[1], spec)
+        if not index.is_trained:
+            raise ValueError(f"{spec} index needs training, build a template with --train_template first")
+        if vectors is not None:
+            vectors.write(x)
+        start = time.perf_counter()
+        index.add(x)
+        elapsed = time.perf_counter() - start
+        add_seconds.observe(elapsed)
+        vectors_indexed.inc(len(x))
+        busy += elapsed
+        index_rate.set(round(index.ntotal / busy, 1) if busy > 0 else 0)
+
     return index
 
+# leave near duplicates (from dedup.py embeddings) out of one embedding file's metadata and
+# vectors, recording on each kept row the sample ids and urls of the rows that collapsed into it
+def drop_near_duplicates(meta, chunks, duplicates, name):
+    drop, collapsed = duplicates
+    keep = ~meta["sample_id"].isin(drop.get(name, ())).to_numpy()
+    merged_into = collapsed.get(name, {})
+    meta = meta[keep].reset_index(drop=True)
+    meta["collapsed_sample_ids"] = [merged_into[s][0] if s in merged_into else None for s in meta["sample_id"]]
+    meta["collapsed_urls"] = [merged_into[s][1] if s in merged_into else None for s in meta["sample_id"]]
+    duplicates_total.labels(kind="near").inc(int((~keep).sum()))
+
+    def kept_chunks():
+        start = 0
+        for x in chunks:
+            k = keep[start:start + len(x)]
+            start += len(x)
+            if k.any():
+                yield np.ascontiguousarray(x[k])
+
+    return meta, kept_chunks(), int((~keep).sum())
+
 # save faiss index and metadata to output directory
-def save_outputs(index, meta, output_dir, base_name, prefix):
+# each file is renamed into place once written, so the merge never picks up a partial shard
+# the metadata records the embedding file it came from, for the merged index's manifest, and is
+# always in shard_metadata_schema (collapsed columns null without dedup), so a shard with no rows still merges
+def save_outputs(index, meta, output_dir, base_name, prefix, source=None):
     os.makedirs(output_dir, exist_ok=True)
     index_file = os.path.join(output_dir, f"{prefix}_{base_name}.index")
     meta_file = os.path.join(output_dir, f"{prefix}_{base_name}.meta.parquet")
-    faiss.write_index(index, index_file)
-    meta.to_parquet(meta_file, index=False)
+    schema = shard_metadata_schema()
+    meta = meta.assign(**{f.name: None for f in schema if f.name not in meta.columns})
+    table = pa.Table.from_pandas(meta[schema.names], schema=schema, preserve_index=False)
+    if source:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"source": source})
+    pq.write_table(table, f"{meta_file}.tmp")
+    os.replace(f"{meta_file}.tmp", meta_file)
+    faiss.write_index(index, f"{index_file}.tmp")
+    os.replace(f"{index_file}.tmp", index_file)
+
+# full-precision copy of the vectors added to a shard, as <prefix>_<base_name>.vectors.f32 next to it
+# (raw float32 rows in faiss id order): merge_faiss_shards.py --rerank_vectors needs one for every shard
+# whose index holds lossy codes, to build the merged vector file search re-ranks candidates from
+# the file is written to .tmp and renamed into place before the shard, so a merge sees both or neither
+class VectorFileWriter:
+    def __init__(self, output_dir, base_name, prefix):
+        os.makedirs(output_dir, exist_ok=True)
+        self.path = os.path.join(output_dir, f"{prefix}_{base_name}.vectors.f32")
+        self.file = open(f"{self.path}.tmp", "wb")
+
+    def write(self, x):
+        self.file.write(np.ascontiguousarray(x, dtype=np.float32).tobytes())
+
+    def close(self):
+        self.file.close()
+        os.replace(f"{self.path}.tmp", self.path)
+
+# one shard built batch by batch, for the fused embed-and-index mode of embed_clip.py: each batch
+# is l2-normalized and added as it arrives (into a copy of the template when one is given), and the
+# shard is saved in the layout index_file writes (with its vector file when vectors is a VectorFileWriter)
+class ShardBuilder:
+    def __init__(self, dim, spec="Flat", template=None, vectors=None):
+        self.index = faiss.read_index(template) if template else create_index(dim, spec)
+        if not self.index.is_trained:
+            raise ValueError(f"{spec} index needs training, build a template with --train_template first")
+        self.ids, self.urls, self.texts = [], [], []
+        self.busy = 0.0
+        self.vectors = vectors
+
+    def add(self, ids, urls, texts, x):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        faiss.normalize_L2(x)
+        if self.vectors is not None:
+            self.vectors.write(x)
+        start = time.perf_counter()
+        self.index.add(x)
+        elapsed = time.perf_counter() - start
+        add_seconds.observe(elapsed)
+        vectors_indexed.inc(len(x))
+        self.busy += elapsed
+        index_rate.set(round(self.index.ntotal / self.busy, 1) if self.busy > 0 else 0)
+        self.ids.extend(int(i) for i in ids)
+        self.urls.extend(urls)
+        self.texts.extend(texts)
+
+    def save(self, output_dir, base_name, prefix, source=None):
+        meta = pd.DataFrame({"sample_id": np.array(self.ids, dtype=np.int64), "url": self.urls, "text": self.texts})
+        if self.vectors is not None:
+            self.vectors.close()
+        save_outputs(self.index, meta, output_dir, base_name, prefix, source)
+
+# checkpointed writer for the fused mode of embed_clip.py, with CheckpointWriter's interface: every
+# batch is also added to a ShardBuilder, and close() saves the shard <prefix>_<base_name> into
+# index_dir. checkpoint parts (vectors and metadata) live in <parts_path>.parts and a restarted task
+# re-adds them instead of embedding them again; with keep_embeddings they are compacted into the
+# embedding parquet at parts_path as a side output, otherwise dropped once the shard is saved.
+# parts always hold the exact float32 vectors, so a restarted task re-adds what an uninterrupted one
+# added; codec applies to the kept parquet only, when the parts are compacted into it
+# with rerank_vectors the shard's vector file is written too (rewritten from the parts on restart)
+class FusedShardWriter(CheckpointWriter):
+    def __init__(self, parts_path, dim, index_dir, base_name, prefix="faiss_shard", spec="Flat", template=None,
+                 keep_embeddings=False, checkpoint_rows=1024, source=None, codec=None, rerank_vectors=False):
+        vectors = VectorFileWriter(index_dir, base_name, prefix) if rerank_vectors else None
+        self.shard = ShardBuilder(dim, spec, template, vectors)
+        super().__init__(parts_path, dim, checkpoint_rows, codec if keep_embeddings else None, exact_parts=True)
+        self.index_dir, self.base_name, self.prefix = index_dir, base_name, prefix
+        self.keep, self.source = keep_embeddings, source
+        for part in self.parts:
+            path = os.path.join(self.parts_dir, part)
+            meta = read_metadata(path)
+            self.shard.add(meta["sample_id"], list(meta["url"]), list(meta["text"]), read_embedding_matrix(path))
+
+    def write_batch(self, ids, urls, texts, x):
+        super().write_batch(ids, urls, texts, x)
+        self.shard.add(ids, urls, texts, x)
+
+    # save the shard, then the embedding parquet when it is kept, then drop the checkpoint
+    def close(self):
+        self.checkpoint()
+        self.shard.save(self.index_dir, self.base_name, self.prefix, self.source)
+        if self.keep:
+            super().close()
+        else:
+            shutil.rmtree(self.parts_dir)
+        self.path = os.path.join(self.index_dir, f"{self.prefix}_{self.base_name}.index")
+
+# node-local copies of an embedding file and its sidecar when staging is enabled
+def stage_input(file_path, sidecar):
+    if stager is None:
+        return file_path, sidecar
+    return Path(stager.stage(file_path)), (stager.stage(sidecar) if sidecar else None)
+
+# build and save the index shard for one file, or for rows=(start, stop) of it
+def index_file(file_path, base_name, output_dir, prefix, normalize, chunk_rows, use_sidecar,
+               spec, template, log_path, rows=None, duplicates=None):
+    # use a memory-mapped sidecar next to the parquet file when requested and present
+    sidecar = sidecar_path(file_path) if use_sidecar else None
+    if sidecar is not None and not os.path.exists(sidecar):
+        log(f"[TASK {task_id}] No sidecar at {sidecar}, reading parquet", log_path)
+        sidecar = None
 
-# main entrypoint for indexing a single parquet file
-def main(input_dir, output_dir, prefix, normalize, logs_dir):
+    # load metadata, then stream embeddings into the index chunk by chunk
+    with timed("load_metadata"):
+        local_path, sidecar = stage_input(file_path, sidecar)
+        meta = read_metadata(local_path, rows)
+    chunks = iter_embedding_chunks(local_path, chunk_rows, sidecar, rows)
+    if duplicates is not None:
+        meta, chunks, dropped = drop_near_duplicates(meta, chunks, duplicates, file_path.name)
+        log(f"[TASK {task_id}] Left out {dropped} near duplicates of {base_name}", log_path)
+        if meta.empty:
+            log(f"[TASK {task_id}] Every row of {base_name} is a near duplicate, no shard written", log_path)
+            return
+
+    # build the faiss index, keeping a full-precision copy of the vectors when re-ranking needs one
+    vectors = VectorFileWriter(output_dir, base_name, prefix) if rerank_vectors else None
+    with timed("build"):
+        index = build_index(chunks, normalize, spec, template, vectors)
+    if index is None or index.ntotal == 0:
+        raise RuntimeError(f"No embeddings found in {base_name}")
+    log(f"[TASK {task_id}] Built {template or spec} FAISS index for {base_name} from {index.ntotal} vectors (normalize={normalize})", log_path)
+
+    # save index and metadata
+    with timed("save"):
+        if vectors is not None:
+            vectors.close()
+        save_outputs(index, meta, output_dir, base_name, prefix, file_path.name)
+    log(f"[TASK {task_id}] Saved index and metadata to {output_dir}", log_path)
+
+# main entrypoint for indexing a single parquet file, publishing metrics while it runs
+def main(input_dir, output_dir, prefix, normalize, logs_dir, chunk_rows, use_sidecar,
+         spec, template, train_template_path, train_samples, metrics_dir=default_textfile_dir,
+         queue_dir=None, unit_rows=262144, lease_seconds=600, duplicates_path=None, manifest_index=None,
+         scratch_dir=None, stage_max_mb=50000, keep_vectors=False):
+    global stager, rerank_vectors
+    rerank_vectors = keep_vectors
+    if train_template_path:
+        metrics = start_textfile("train", None, metrics_dir)
+    else:
+        metrics = start_textfile("index", task_id, metrics_dir)
+    ok = False
+    try:
+        duplicates = load_near_duplicates(duplicates_path) if duplicates_path else None
+        skip = indexed_sources(manifest_index) if manifest_index and not train_template_path else set()
+        if scratch_dir and not train_template_path:
+            stager = FileStager(scratch_dir, stage_max_mb, log)
+        if queue_dir and not train_template_path:
+            index_queue(input_dir, output_dir, prefix, normalize, logs_dir, chunk_rows, use_sidecar,
+                        spec, template, queue_dir, unit_rows, lease_seconds, duplicates, skip)
+        else:
+            index_task(input_dir, output_dir, prefix, normalize, logs_dir, chunk_rows, use_sidecar,
+                       spec, template, train_template_path, train_samples, duplicates, skip)
+        ok = True
+    finally:
+        if stager is not None:
+            stager.close()
+        if metrics is not None:
+            metrics.stop(ok)
+
+# train the shared template, or index the single parquet file assigned to this task
+# files named in skip (already in the merged index) get no task
+def index_task(input_dir, output_dir, prefix, normalize, logs_dir, chunk_rows, use_sidecar,
+               spec, template, train_template_path, train_samples, duplicates=None, skip=()):
     os.makedirs(logs_dir, exist_ok=True)
-    log_path = os.path.join(logs_dir, f"build_index_task{task_id}.log")
 
-    # collect all input parquet files and validate task id
+    # collect all input parquet files (the template is still trained on all of them)
     files = sorted(Path(input_dir).glob("*.parquet"))
+
+    # training mode runs once before the array job and writes the shared template
+    if train_template_path:
+        log_path = os.path.join(logs_dir, "train_template.log")
+        try:
+            with timed("train"):
+                train_template(files, spec, train_template_path, train_samples, normalize, chunk_rows, log_path)
+        except Exception as e:
+            log(f"[ERROR] Template training failed: {str(e)}", log_path)
+            exit(1)
+        return
+
+    # validate task id
+    files = [f for f in files if f.name not in skip]
+    log_path = os.path.join(logs_dir, f"build_index_task{task_id}.log")
     if task_id < 0 or task_id >= len(files):
         log(f"[SKIP] Invalid SLURM_ARRAY_TASK_ID: {task_id}", log_path)
         exit(1)
 
     file_path = files[task_id]
-    base_name = file_path.stem
     log(f"[TASK {task_id}] Starting FAISS index for {file_path.name}", log_path)
 
     try:
-        # load embeddings and metadata
-        x, meta = load_embeddings(file_path)
-        log(f"[TASK {task_id}] Loaded embeddings: shape={x.shape}", log_path)
+        index_file(file_path, file_path.stem, output_dir, prefix, normalize, chunk_rows, use_sidecar,
+                   spec, template, log_path, duplicates=duplicates)
+    except Exception as e:
+        log(f"[ERROR] Task {task_id} failed: {str(e)}", log_path)
+        exit(1)
 
-        # build the faiss index
-        index = build_index(x, normalize)
-        log(f"[TASK {task_id}] Built FAISS index (normalize={normalize})", log_path)
+# lease row ranges of the embedding files from the shared queue, one index shard per unit
+# unit ids sort in file then row order, so the merged ids still follow the embedding order
+# files named in skip (already in the merged index) are not planned
+def index_queue(input_dir, output_dir, prefix, normalize, logs_dir, chunk_rows, use_sidecar,
+                spec, template, queue_dir, unit_rows, lease_seconds, duplicates=None, skip=()):
+    os.makedirs(logs_dir, exist_ok=True)
+    log_path = os.path.join(logs_dir, f"build_index_task{task_id}.log")
+    files = [f for f in sorted(Path(input_dir).glob("*.parquet")) if f.name not in skip]
+    if skip:
+        log(f"[TASK {task_id}] {len(files)} embedding files not yet in the merged index", log_path)
+    queue = WorkQueue(queue_dir, f"index_task{task_id}", lease_seconds)
+    units = queue.init(plan_units(files, unit_rows))
+    log(f"[TASK {task_id}] Started with {len(units)} work units of up to {unit_rows} rows in {queue_dir}", log_path)
 
-        # save index and metadata
-        save_outputs(index, meta, output_dir, base_name, prefix)
-        log(f"[TASK {task_id}] Saved index and metadata to {output_dir}", log_path)
+    def process(unit):
+        # copy the input of the unit likely to come next while this one is indexed
+        upcoming = queue.peek() if stager is not None else None
+        if upcoming is not None:
+            stager.prefetch(upcoming["path"])
+            if use_sidecar and os.path.exists(sidecar_path(upcoming["path"])):
+                stager.prefetch(sidecar_path(upcoming["path"]))
+        index_file(Path(unit["path"]), unit["id"], output_dir, prefix, normalize, chunk_rows, use_sidecar,
+                   spec, template, log_path, (unit["start"], unit["stop"]), duplicates)
 
-    except Exception as e:
-        log(f"[ERROR] Task {task_id} failed: {str(e)}", log_path)
+    done, failed = queue.run(process, lambda msg: log(msg, log_path))
+    log(f"[TASK {task_id}] Finished: {done} units indexed, {failed} failed | queue {queue.status()}", log_path)
+    if failed:
         exit(1)
 
 # parse command-line arguments and run main
@@ -98,7 +402,56 @@ if __name__ == "__main__":
     
     # path for logs         
     parser.add_argument("--logs_dir", type=str, default="/home/almalinux/nfs/logs/faiss") 
+
+    # number of vectors read and added to the index at a time
+    parser.add_argument("--chunk_rows", type=int, default=65536)
+
+    # read vectors from a memory-mapped .npy sidecar next to each parquet file when present
+    parser.add_argument("--use_sidecar", action="store_true")
+
+    # index type: flat, ivf, ivfpq, opq, hnsw or any faiss factory string
+    parser.add_argument("--index_type", type=str, default="flat")
+
+    # number of ivf lists and pq sub-quantizers used by the presets
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--pq_m", type=int, default=64)
+
+    # trained empty index that every array task adds into
+    parser.add_argument("--template", type=str, default=None)
+
+    # train a template on a sample of all input files and exit
+    parser.add_argument("--train_template", type=str, default=None)
+
+    # number of vectors sampled across all files for training
+    parser.add_argument("--train_samples", type=int, default=100000)
+
+    # node exporter textfile collector directory for prometheus metrics
+    parser.add_argument("--metrics_dir", type=str, default=default_textfile_dir)
+
+    # shared work queue directory; when set, tasks lease row ranges instead of one file each
+    parser.add_argument("--queue_dir", type=str, default=None)
+
+    # rows per work unit and seconds before a crashed worker's unit is re-leased
+    parser.add_argument("--unit_rows", type=int, default=262144)
+    parser.add_argument("--lease_seconds", type=int, default=600)
+
+    # near duplicates file from dedup.py; those rows are left out of the shards
+    parser.add_argument("--duplicates", type=str, default=None)
+
+    # merged index whose manifest lists the embedding files already indexed; only new files get shards
+    parser.add_argument("--manifest_index", type=str, default=None)
+
+    # node-local directory embedding files are copied to before reading, and its size limit
+    parser.add_argument("--scratch_dir", type=str, default=None)
+    parser.add_argument("--stage_max_mb", type=float, default=50000)
+
+    # also write each shard's normalized vectors to <shard>.vectors.f32, for merging with --rerank_vectors
+    parser.add_argument("--rerank_vectors", action="store_true")
      
     args = parser.parse_args()
     
-    main(args.input_dir, args.output_dir, args.prefix, args.normalize, args.logs_dir)
\ No newline at end of file
+    main(args.input_dir, args.output_dir, args.prefix, args.normalize, args.logs_dir,
+         args.chunk_rows, args.use_sidecar, resolve_index_type(args.index_type, args.nlist, args.pq_m),
+         args.template, args.train_template, args.train_samples, args.metrics_dir,
+         args.queue_dir, args.unit_rows, args.lease_seconds, args.duplicates, args.manifest_index,
+         args.scratch_dir, args.stage_max_mb, args.rerank_vectors)
\ No newline at end of file
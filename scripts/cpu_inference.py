@@ -0,0 +1,97 @@
+import os
+import torch
+import numpy as np
+from PIL import Image
+
+# cpu inference path for clip encode_image on the cpu-only worker nodes
+#   threads  intra-op threads from SLURM_CPUS_PER_TASK instead of torch's default
+#   trace    torch.jit.trace + freeze of the vision tower (fp32 and int8)
+#   int8     dynamic int8 quantization of the linear layers
+#   bf16     bfloat16 autocast (only worth it on cpus with avx512-bf16 / amx)
+# every optimized encoder is checked against fp32 embeddings on a fixed image set
+
+precisions = ("fp32", "int8", "bf16")
+
+# use the cpus slurm allocated to this task, falling back to every visible core
+def configure_threads(threads=None):
+    threads = threads or int(os.environ.get("SLURM_CPUS_PER_TASK", 0)) or len(os.sched_getaffinity(0))
+    torch.set_num_threads(threads)
+    try:
+        # one inter-op thread: the vision tower is a single chain of ops
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set before the first parallel op runs
+        pass
+    return threads
+
+# drop-in replacement for the clip model in the embed loop: encode_image plus visual.output_dim
+class CpuImageEncoder:
+    def __init__(self, model, precision="fp32", trace=True, example_batch=8):
+        if precision not in precisions:
+            raise ValueError(f"Unknown precision: {precision}")
+        self.visual = model.visual
+        self.precision = precision
+        self.traced = False
+
+        visual = model.visual.float().eval()
+        if precision == "int8":
+            visual = torch.ao.quantization.quantize_dynamic(visual, {torch.nn.Linear}, dtype=torch.qint8)
+
+        # autocast does not survive tracing, so bf16 runs eagerly
+        if trace and precision != "bf16":
+            size = model.visual.input_resolution
+            example = torch.randn(example_batch, 3, size, size)
+            with torch.inference_mode():
+                visual = torch.jit.freeze(torch.jit.trace(visual, example, check_trace=False))
+            self.traced = True
+        self.fn = visual
+
+    def encode_image(self, x):
+        with torch.inference_mode():
+            if self.precision == "bf16":
+                with torch.autocast("cpu", dtype=torch.bfloat16):
+                    return self.fn(x.float()).float()
+            return self.fn(x.float()).float()
+
+    def describe(self):
+        return f"{self.precision}{' traced' if self.traced else ''}"
+
+# preprocess every image in a directory into one batch, in sorted order
+def load_gate_images(image_dir, preprocess):
+    if not os.path.isdir(image_dir):
+        raise ValueError(f"No gate image directory at {image_dir}")
+    files = sorted(f for f in os.listdir(image_dir) if f.lower().endswith((".png", ".jpg", ".jpeg")))
+    if not files:
+        raise ValueError(f"No gate images in {image_dir}")
+    return torch.stack([preprocess(Image.open(os.path.join(image_dir, f)).convert("RGB")) for f in files])
+
+# cosine similarity of each image's embedding under the encoder versus the fp32 model
+def cosine_to_reference(model, encoder, images):
+    with torch.inference_mode():
+        ref = model.visual.float()(images.float()).float().numpy()
+    out = encoder.encode_image(images).numpy()
+    ref /= np.linalg.norm(ref, axis=1, keepdims=True)
+    out /= np.linalg.norm(out, axis=1, keepdims=True)
+    return (ref * out).sum(axis=1)
+
+# accuracy gate: passes when every gate image keeps at least min_cosine similarity to fp32
+def accuracy_gate(model, encoder, images, min_cosine=0.99):
+    cos = cosine_to_reference(model, encoder, images)
+    return bool(cos.min() >= min_cosine), {"min_cosine": round(float(cos.min()), 5),
+                                           "mean_cosine": round(float(cos.mean()), 5)}
+
+# build the requested encoder, falling back to fp32 (traced as requested) when it fails the gate
+# precisions below fp32 are never used ungated: without gate images they are refused up front
+def build_encoder(model, preprocess, precision="fp32", trace=True, gate_dir=None, min_cosine=0.99, log=print):
+    if precision != "fp32" and gate_dir is None:
+        raise ValueError(f"{precision} inference needs gate images (--gate_dir) to check it against fp32")
+    encoder = CpuImageEncoder(model, precision, trace)
+    if gate_dir is None or (precision == "fp32" and not trace):
+        return encoder
+    images = load_gate_images(gate_dir, preprocess)
+    ok, stats = accuracy_gate(model, encoder, images, min_cosine)
+    log(f"Accuracy gate for {encoder.describe()} on {len(images)} images: {stats} (threshold {min_cosine})")
+    if ok or precision == "fp32":
+        return encoder
+    log(f"{encoder.describe()} failed the accuracy gate, falling back to fp32")
+    return build_encoder(model, preprocess, "fp32", trace, gate_dir, min_cosine, log)
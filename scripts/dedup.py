@@ -0,0 +1,336 @@
+import os
+import time
+import faiss
+import shutil
+import hashlib
+import tempfile
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from array import array
+from pathlib import Path
+from datetime import datetime
+from urllib.parse import urlsplit, urlunsplit
+from embedding_store import iter_embedding_chunks, read_metadata
+from pipeline_metrics import counter, timed, start_textfile, default_textfile_dir
+
+# duplicate removal in two places, each keeping the first occurrence in (file, row) order
+#   urls        one pass over the laion input files before embedding writes every row whose
+#               normalized url was already seen, so no task downloads or embeds it again
+#   content     while embedding, the sha1 of each downloaded image is claimed in a shared
+#               directory on nfs; identical bytes behind different urls are embedded once
+#   near        one pass over the embedding files before indexing writes every vector within
+#               the cosine threshold of an earlier kept vector, found through a coarse ann index;
+#               shards leave those rows out and record them on the row they collapsed into
+
+# rows dropped as duplicates, by kind (url, content, near)
+duplicates_total = counter("laion_duplicates_total", "Rows dropped as duplicates, by kind", ["kind"])
+
+def log(msg, log_file=None):
+    full_msg = f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}"
+    print(full_msg)
+    if log_file:
+        with open(log_file, "a") as f:
+            f.write(full_msg + "\n")
+
+# lowercase scheme and host and drop the fragment, so trivially different spellings match
+def normalize_url(url):
+    url = (url or "").strip()
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ""))
+
+# 128-bit digests of normalized urls, as two uint64 halves from differently keyed pandas hashes
+def url_digests(urls):
+    normalized = pd.Series([normalize_url(u) for u in urls])
+    return tuple(pd.util.hash_pandas_object(normalized, index=False, hash_key=key).to_numpy()
+                 for key in ("laion-url-hash-1", "laion-url-hash-2"))
+
+# one (digest, file, row) record per input row, as written to the bucket files
+url_record = np.dtype([("hi", "<u8"), ("lo", "<u8"), ("file", "<i4"), ("row", "<i8")])
+
+# exact url duplicates across files: every row whose url already occurred earlier
+# returns a dataframe of (file, row, url, kept_file, kept_row); max_rows caps the rows used per file
+# memory stays bounded by one bucket: records are streamed batch by batch into 2**bucket_bits files
+# under work_dir, split on the digest's leading bits, so equal urls land in the same bucket, and
+# each bucket is sorted on its own; only the duplicates' urls are read back at the end
+def find_url_duplicates(files, max_rows=None, work_dir=None, bucket_bits=8, batch_rows=65536):
+    names = [Path(p).name for p in files]
+    tmp = tempfile.mkdtemp(prefix="url_dedup_", dir=work_dir)
+    try:
+        buckets = [open(os.path.join(tmp, f"bucket_{b:05d}.bin"), "wb") for b in range(1 << bucket_bits)]
+        try:
+            for i, path in enumerate(files):
+                start = 0
+                for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows, columns=["URL"]):
+                    if max_rows:
+                        batch = batch.slice(0, max_rows - start)
+                    rec = np.empty(batch.num_rows, dtype=url_record)
+                    rec["hi"], rec["lo"] = url_digests(batch.column(0).to_pylist())
+                    rec["file"], rec["row"] = i, np.arange(start, start + batch.num_rows)
+                    start += batch.num_rows
+                    bucket = (rec["hi"] >> np.uint64(64 - bucket_bits)).astype(np.int64)
+                    order = np.argsort(bucket, kind="stable")
+                    bounds = np.searchsorted(bucket[order], np.arange(len(buckets) + 1))
+                    for b in np.flatnonzero(np.diff(bounds)):
+                        buckets[b].write(rec[order[bounds[b]:bounds[b + 1]]].tobytes())
+                    if max_rows and start >= max_rows:
+                        break
+        finally:
+            for f in buckets:
+                f.close()
+
+        # within a bucket, sorting on (digest, file, row) puts each url's first occurrence ahead of its repeats
+        dup_file, dup_row, kept_file, kept_row = [], [], [], []
+        for f in buckets:
+            rec = np.fromfile(f.name, dtype=url_record)
+            rec = rec[np.lexsort((rec["row"], rec["file"], rec["lo"], rec["hi"]))]
+            first = np.ones(len(rec), dtype=bool)
+            first[1:] = (rec["hi"][1:] != rec["hi"][:-1]) | (rec["lo"][1:] != rec["lo"][:-1])
+            kept = np.maximum.accumulate(np.where(first, np.arange(len(rec)), 0))
+            dup = np.flatnonzero(~first)
+            dup_file.append(rec["file"][dup])
+            dup_row.append(rec["row"][dup])
+            kept_file.append(rec["file"][kept[dup]])
+            kept_row.append(rec["row"][kept[dup]])
+            os.remove(f.name)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    dup_file, dup_row = np.concatenate(dup_file), np.concatenate(dup_row)
+    kept_file, kept_row = np.concatenate(kept_file), np.concatenate(kept_row)
+    order = np.lexsort((dup_row, dup_file))
+    dup_file, dup_row, kept_file, kept_row = dup_file[order], dup_row[order], kept_file[order], kept_row[order]
+
+    # read back the url of every duplicate row, one file at a time
+    urls = []
+    for i in np.unique(dup_file):
+        rows = dup_row[dup_file == i]
+        column = pq.read_table(files[i], columns=["URL"]).slice(0, int(rows[-1]) + 1).column("URL")
+        urls.extend(column.take(pa.array(rows)).to_pylist())
+    return pd.DataFrame({
+        "file": [names[i] for i in dup_file],
+        "row": dup_row,
+        "url": urls,
+        "kept_file": [names[i] for i in kept_file],
+        "kept_row": kept_row,
+    })
+
+# rows of one input file to skip, from a url duplicates file
+def load_url_duplicates(path):
+    df = pd.read_parquet(path, columns=["file", "row"])
+    return {name: set(group["row"].tolist()) for name, group in df.groupby("file")}
+
+# per embedding file: sample ids to leave out of the index, and for each kept sample id the
+# (sample ids, urls) of the near duplicates that collapsed into it, the urls newline separated
+def load_near_duplicates(path):
+    df = pd.read_parquet(path, columns=["file", "sample_id", "url", "kept_file", "kept_sample_id"])
+    drop = {name: set(group["sample_id"].tolist()) for name, group in df.groupby("file")}
+    collapsed = {name: {kept: (g["sample_id"].tolist(), "\n".join(g["url"]))
+                        for kept, g in group.groupby("kept_sample_id")}
+                 for name, group in df.groupby("kept_file")}
+    return drop, collapsed
+
+# sha1 of downloaded image bytes
+def content_key(data):
+    return hashlib.sha1(data).hexdigest()
+
+# first-come claims on image content hashes, shared by every task through files on nfs
+# a claim is a file created with O_EXCL holding its owner (output shard and sample id),
+# so a task resuming after a crash still owns the images it claimed before
+class ContentClaims:
+    def __init__(self, claims_dir):
+        self.claims_dir = claims_dir
+        os.makedirs(claims_dir, exist_ok=True)
+
+    # true when the content is new or already belongs to this owner
+    def claim(self, key, owner):
+        subdir = os.path.join(self.claims_dir, key[:2])
+        os.makedirs(subdir, exist_ok=True)
+        path = os.path.join(subdir, key)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            try:
+                with open(path) as f:
+                    return f.read() == owner
+            except OSError:
+                return False
+        with os.fdopen(fd, "w") as f:
+            f.write(owner)
+        return True
+
+    # filter for ImageFetcher: keep an image unless another row claimed the same bytes first
+    def filter_for(self, shard):
+        def keep(key, data):
+            if self.claim(content_key(data), f"{shard}:{key}"):
+                return True
+            duplicates_total.labels(kind="content").inc()
+            return False
+        return keep
+
+# coarse ann index of kept vectors: ivf when there are enough vectors to train it, else flat
+# it holds every kept vector for the whole run, stored with codec (merge_faiss_shards.merge_codecs):
+# float32 keeps 4 * dim bytes per vector, float16 2 * dim and int8 dim. only scalar quantizers are
+# offered: their cosine error is far below the threshold's margin, where pq's would collapse rows
+# that are not near duplicates
+def coarse_index(train, nlist, nprobe, codec="float32"):
+    from merge_faiss_shards import merge_codecs
+
+    dim = train.shape[1]
+    nlist = min(nlist, len(train) // 39)
+    if nlist < 16:
+        return faiss.IndexFlatIP(dim)
+    index = faiss.index_factory(dim, f"IVF{nlist},{merge_codecs[codec]}", faiss.METRIC_INNER_PRODUCT)
+    index.train(train)
+    index.nprobe = nprobe
+    return index
+
+# near duplicates in embedding order: a vector whose cosine to an earlier kept vector is at
+# least threshold is dropped in favour of it; returns a dataframe of
+# (file, sample_id, url, kept_file, kept_sample_id, cosine)
+# memory grows with the kept rows: their vectors in the coarse index (see coarse_index for the
+# bytes per vector of each codec) plus 12 bytes each for their file and sample id
+def find_near_duplicates(files, threshold=0.95, chunk_rows=4096, nlist=1024, nprobe=8,
+                         train_samples=100000, log_file=None, codec="float32"):
+    from build_faiss_index import sample_training_vectors
+
+    train = sample_training_vectors(files, train_samples, chunk_rows)
+    faiss.normalize_L2(train)
+    index = coarse_index(train, nlist, nprobe, codec)
+    log(f"[NEAR] Coarse index {type(index).__name__} ({codec}) trained on {len(train)} vectors", log_file)
+    del train
+
+    names = [Path(p).name for p in files]
+    kept_file, kept_sid = array("i"), array("q")
+    found = []
+    for i, path in enumerate(files):
+        meta = read_metadata(path)
+        sids, urls = meta["sample_id"].to_numpy(), meta["url"].tolist()
+        start = 0
+        for x in iter_embedding_chunks(path, chunk_rows):
+            faiss.normalize_L2(x)
+            n = len(x)
+            match = np.full(n, -1, dtype=np.int64)
+            score = np.zeros(n, dtype=np.float32)
+
+            # against vectors kept from earlier chunks
+            if index.ntotal:
+                D, I = index.search(x, 1)
+                hit = D[:, 0] >= threshold
+                match[hit], score[hit] = I[hit, 0], D[hit, 0]
+
+            # within the chunk, in row order, a row collapses into the most similar earlier kept row
+            sims = x @ x.T
+            earlier = np.tril(sims >= threshold, -1)
+            keep = match < 0
+            for r in np.flatnonzero(earlier.any(axis=1) & keep):
+                cands = np.flatnonzero(earlier[r, :r] & keep[:r])
+                if len(cands):
+                    best = cands[np.argmax(sims[r, cands])]
+                    keep[r] = False
+                    # kept rows of this chunk get the next ids in order
+                    match[r], score[r] = index.ntotal + keep[:best].sum(), sims[r, best]
+
+            for r in np.flatnonzero(~keep):
+                found.append((names[i], int(sids[start + r]), urls[start + r], int(match[r]), float(score[r])))
+            index.add(np.ascontiguousarray(x[keep]))
+            kept_file.extend([i] * int(keep.sum()))
+            kept_sid.extend(sids[start:start + n][keep].tolist())
+            start += n
+        log(f"[NEAR] {names[i]}: {len(meta)} rows, {len(found)} near duplicates so far", log_file)
+
+    kept_file, kept_sid = np.frombuffer(kept_file, dtype=np.int32), np.frombuffer(kept_sid, dtype=np.int64)
+    ids = np.array([f[3] for f in found], dtype=np.int64)
+    return pd.DataFrame({
+        "file": [f[0] for f in found],
+        "sample_id": np.array([f[1] for f in found], dtype=np.int64),
+        "url": [f[2] for f in found],
+        "kept_file": [names[i] for i in kept_file[ids]],
+        "kept_sample_id": kept_sid[ids],
+        "cosine": np.array([f[4] for f in found], dtype=np.float32),
+    })
+
+# write a duplicates file atomically, so a task never reads a half-written plan
+def save_duplicates(df, output):
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    df.to_parquet(f"{output}.tmp", index=False)
+    os.replace(f"{output}.tmp", output)
+
+# run one dedup pass, publishing metrics while it runs
+def main(mode, input_dir, output, max_rows, threshold, chunk_rows, nlist, nprobe, train_samples,
+         logs_dir, metrics_dir=default_textfile_dir, work_dir=None, codec="float32"):
+    metrics = start_textfile(f"dedup_{mode}", None, metrics_dir)
+    ok = False
+    try:
+        os.makedirs(logs_dir, exist_ok=True)
+        log_path = os.path.join(logs_dir, f"dedup_{mode}.log")
+        files = sorted(Path(input_dir).glob("*.parquet"))
+        if not files:
+            raise RuntimeError(f"No parquet files in {input_dir}")
+
+        start = time.perf_counter()
+        with timed(mode):
+            if mode == "urls":
+                dups = find_url_duplicates(files, max_rows, work_dir)
+            else:
+                dups = find_near_duplicates(files, threshold, chunk_rows, nlist, nprobe, train_samples, log_path,
+                                            codec)
+        duplicates_total.labels(kind="url" if mode == "urls" else "near").inc(len(dups))
+        save_duplicates(dups, output)
+        log(f"[{mode.upper()}] {len(dups)} duplicates in {len(files)} files written to {output} "
+            f"({time.perf_counter() - start:.1f}s)", log_path)
+        ok = True
+    finally:
+        if metrics is not None:
+            metrics.stop(ok)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # urls: laion input files before embedding; embeddings: embedding files before indexing
+    parser.add_argument("mode", choices=["urls", "embeddings"])
+
+    # directory with the input parquet files
+    parser.add_argument("--input_dir", type=str, required=True)
+
+    # duplicates file to write
+    parser.add_argument("--output", type=str, required=True)
+
+    # rows used per input file in url mode (match the embedding job's --sample_count)
+    parser.add_argument("--max_rows", type=int, default=None)
+
+    # local directory for the url mode's on-disk buckets (the system temp dir by default)
+    parser.add_argument("--work_dir", type=str, default=None)
+
+    # cosine similarity at or above which two embeddings are near duplicates
+    parser.add_argument("--threshold", type=float, default=0.95)
+
+    # vectors compared per step, and ivf lists and probes of the coarse index
+    parser.add_argument("--chunk_rows", type=int, default=4096)
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--nprobe", type=int, default=8)
+
+    # storage of the kept vectors in the coarse index, which holds all of them until the end:
+    # float32 (4 * dim bytes per kept row), float16 (2 * dim) or int8 (dim), e.g. for 100M kept
+    # 512-d rows about 200 GB, 100 GB or 50 GB
+    parser.add_argument("--codec", type=str, default="float32", choices=["float32", "float16", "int8"])
+
+    # vectors sampled across all files to train the coarse index
+    parser.add_argument("--train_samples", type=int, default=100000)
+
+    # path for logs
+    parser.add_argument("--logs_dir", type=str, default="/home/almalinux/nfs/logs/dedup")
+
+    # node exporter textfile collector directory for prometheus metrics
+    parser.add_argument("--metrics_dir", type=str, default=default_textfile_dir)
+
+    args = parser.parse_args()
+
+    main(args.mode, args.input_dir, args.output, args.max_rows, args.threshold, args.chunk_rows,
+         args.nlist, args.nprobe, args.train_samples, args.logs_dir, args.metrics_dir, args.work_dir,
+         args.codec)
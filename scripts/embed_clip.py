@@ -1,18 +1,27 @@
 #!/usr/bin/env python3
 
 import os
-import io
+import sys
 import clip
+import signal
 import torch
+import shutil
 import logging
 import argparse
 import pandas as pd
-import pyarrow as pa
 from PIL import Image
 from tqdm import tqdm
-import pyarrow.parquet as pq
 from torchvision import transforms
-from urllib.request import urlopen, Request
+from image_fetch import ImageFetcher, Throughput
+from embedding_store import CheckpointWriter, read_row_range
+from embedding_codec import make_codec
+from build_faiss_index import FusedShardWriter, resolve_index_type
+from work_queue import WorkQueue, plan_units
+from cpu_inference import configure_threads, build_encoder
+from image_preprocess import DecodePool, to_model_input
+from local_cache import FileStager, ImageCache
+from dedup import ContentClaims, load_url_duplicates, duplicates_total
+from pipeline_metrics import counter, gauge, histogram, timed, start_textfile, default_textfile_dir
 
 # get slurm array task id (used to select the specific parquet file)
 task_id = int(os.environ.get("SLURM_ARRAY_TASK_ID", -1))
@@ -31,6 +40,31 @@ log = logging.getLogger()
 # detect gpu if available, fallback to cpu
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+# embedding metrics, exported through the node exporter textfile collector
+inference_seconds = histogram("laion_embed_batch_seconds", "encode_image time per batch")
+images_embedded = counter("laion_images_embedded_total", "Images embedded and written")
+embed_rate = gauge("laion_embed_images_per_second", "Embedding throughput since the task started")
+
+# process pool decoding images at reduced scale, set up by main (none: preprocess on the fetch threads)
+decoder = None
+
+# rows per input file whose url occurred earlier, and shared claims on image content hashes,
+# both set up by main when deduplication is enabled
+url_duplicates = None
+content_claims = None
+
+# node-local staging of input files and cache of downloaded images, set up by main when
+# a scratch directory and an image cache directory are given
+stager = None
+image_cache = None
+
+# fused embed-and-index mode, set up by main when an index directory is given: index_dir, prefix,
+# spec, template, keep_embeddings, checkpoint_dir and rerank_vectors
+index_options = None
+
+# storage codec of the embedding parquet (embedding_codec.py): float32, float16, int8 or pq:<codebook>
+codec_spec = "float32"
+
 # define a manual transform in case clip's default fails
 transform = transforms.Compose([
     transforms.Resize(224, interpolation=Image.BICUBIC),
@@ -40,63 +74,203 @@ transform = transforms.Compose([
                          std=(0.26862954, 0.26130258, 0.27577711))
 ])
 
-# load and preprocess image from url with retry mechanism
-def load_image(url, preprocess, retries=2):
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    for _ in range(retries):
-        try:
-            with urlopen(Request(url, headers=headers), timeout=10) as r:
-                img_data = r.read()
-            return preprocess(Image.open(io.BytesIO(img_data)).convert("RGB"))
-        except Exception:
-            continue
-    return None
-
-# embed all images in the dataframe using clip model
-def embed_images(df, batch_size, model, preprocess):
-    embeddings, ids = [], []
-    batch, batch_ids = [], []
-
-    for i, row in tqdm(df.iterrows(), total=len(df), desc=f"Embedding task {task_id}"):
-        img = load_image(row["URL"], preprocess)
-        if img is not None:
-            batch.append(img)
-            batch_ids.append(i)
-
-        # when batch is ready or end of data, run embedding
-        if len(batch) >= batch_size or (i == len(df) - 1 and batch):
+# embed all images in the dataframe using clip model, yielding (ids, float32 matrix) per batch
+# keys of rows whose image could not be fetched or decoded are appended to failed when given
+# dedup, when given, drops images whose content another row already claimed (also appended to failed)
+def embed_images(df, batch_size, model, preprocess, concurrency=16, per_host=4, queue_depth=256, failed=None,
+                 dedup=None):
+    # fetch and preprocess images concurrently while the model consumes full batches
+    fetcher = ImageFetcher(preprocess, concurrency=concurrency, per_host=per_host, queue_depth=queue_depth,
+                           decoder=decoder, dedup=dedup, cache=image_cache)
+    items = ((i, row["URL"]) for i, row in df.iterrows())
+    meter = Throughput()
+
+    with tqdm(total=len(df), desc=f"Embedding task {task_id}") as pbar:
+        for batch_ids, batch in fetcher.batches(items, batch_size, failed):
             log.info(f"Embedding batch of {len(batch)} images (task {task_id})")
             try:
-                x = torch.stack(batch).to(device)
-                with torch.no_grad():
-                    z = model.encode_image(x).cpu()
-                embeddings.extend(z)
-                ids.extend(batch_ids)
-                log.info(f"Successfully embedded batch of {len(batch)} images")
+                x = to_model_input(batch).to(device)
+                with inference_seconds.time(), torch.no_grad():
+                    z = model.encode_image(x).float().cpu().numpy()
+                meter.add(len(batch))
+                images_embedded.inc(len(batch))
+                embed_rate.set(round(meter.rate(), 2))
+                log.info(f"Successfully embedded batch of {len(batch)} images ({meter.rate():.1f} images/sec)")
             except Exception as e:
-                log.warning(f"Error embedding batch ending at row {i}: {e}")
-            batch, batch_ids = [], []
-            torch.cuda.empty_cache()
+                log.warning(f"Error embedding batch ending at row {batch_ids[-1]}: {e}")
+                z = None
+            if device == "cuda":
+                torch.cuda.empty_cache()
+            pbar.n = fetcher.fetched + fetcher.failed + fetcher.duplicates
+            pbar.refresh()
+            if z is not None:
+                yield batch_ids, z
 
-    return embeddings, ids
+    log.info(f"Fetched {fetcher.fetched} images, {fetcher.failed} failed ({fetcher.duplicates} duplicate content) | "
+             f"{meter.rate():.1f} images/sec")
 
-# save embeddings and metadata to parquet format
-def save_embeddings(embs, df, ids, output_dir, prefix):
+# stream embedded batches into checkpointed parts, one row group per batch, and compact them at the end
+# if the task stops early, everything written so far is checkpointed before the error propagates
+def save_embeddings(batches, df, writer, failed):
     try:
-        table = pa.Table.from_pydict({
-            "sample_id": [i for i in ids],
-            "url": [df.loc[i, "URL"] for i in ids],
-            "text": [df.loc[i, "TEXT"] for i in ids],
-            "embedding": [e.numpy().tolist() for e in embs]
-        })
-        out_path = os.path.join(output_dir, f"{prefix}_task{task_id}.parquet")
-        pq.write_table(table, out_path)
-        log.info(f"💾 saved {len(embs)} embeddings to {out_path}")
-    except Exception as e:
-        log.error(f"Failed to save parquet file: {e}")
+        for ids, z in batches:
+            writer.write_batch(
+                ids,
+                [df.loc[i, "URL"] for i in ids],
+                [df.loc[i, "TEXT"] for i in ids],
+                z
+            )
+            writer.mark_failed(failed)
+            failed.clear()
+        writer.mark_failed(failed)
+    except BaseException as e:
+        writer.checkpoint()
+        log.error(f"Embedding stopped early, {len(writer.done)} rows checkpointed in {writer.parts_dir}, rerun to resume: {e!r}")
+        raise
+    writer.close()
+    log.info(f"💾 saved {writer.rows} embeddings to {writer.path}")
+    return writer.rows
+
+# where the checkpoint of out_path is written: next to it, or in fused mode (build_faiss_index.FusedShardWriter)
+# without the embedding parquet in the checkpoint directory when one is given
+def checkpoint_path(out_path):
+    if index_options is None or index_options["keep_embeddings"] or not index_options["checkpoint_dir"]:
+        return out_path
+    return os.path.join(index_options["checkpoint_dir"], os.path.basename(out_path))
+
+# index and metadata shard that fused mode writes for out_path, and its vector file when re-ranking needs one
+def shard_paths(out_path):
+    name = f"{index_options['prefix']}_{os.path.splitext(os.path.basename(out_path))[0]}"
+    paths = [os.path.join(index_options["index_dir"], f"{name}.index"),
+             os.path.join(index_options["index_dir"], f"{name}.meta.parquet")]
+    if index_options["rerank_vectors"]:
+        paths.append(os.path.join(index_options["index_dir"], f"{name}.vectors.f32"))
+    return paths
+
+# outputs of out_path: the embedding parquet, and in fused mode the shard instead of (or with) it
+def output_paths(out_path):
+    if index_options is None:
+        return [out_path]
+    return shard_paths(out_path) + ([out_path] if index_options["keep_embeddings"] else [])
+
+# embed the rows of df into the shard at out_path, resuming from its checkpoint when there is one
+def embed_to_shard(df, out_path, model, preprocess, batch_size, concurrency, per_host, queue_depth,
+                   checkpoint_rows=1024, restart=False):
+    outputs = output_paths(out_path)
+    if restart:
+        shutil.rmtree(f"{checkpoint_path(out_path)}.parts", ignore_errors=True)
+        for path in outputs:
+            if os.path.exists(path):
+                os.remove(path)
+    if all(os.path.exists(path) for path in outputs):
+        log.info(f"Skipping {out_path}: already complete")
+        return 0
+
+    codec = make_codec(codec_spec, model.visual.output_dim)
+    if index_options is not None:
+        o = index_options
+        writer = FusedShardWriter(checkpoint_path(out_path), model.visual.output_dim, o["index_dir"],
+                                  os.path.splitext(os.path.basename(out_path))[0], o["prefix"], o["spec"],
+                                  o["template"], o["keep_embeddings"], checkpoint_rows, os.path.basename(out_path),
+                                  codec, o["rerank_vectors"])
+        if writer.parts:
+            log.info(f"Re-added {writer.shard.index.ntotal} checkpointed vectors of {out_path} to its shard")
+    else:
+        writer = CheckpointWriter(out_path, model.visual.output_dim, checkpoint_rows, codec)
+    todo = df[~df.index.isin(writer.finished())]
+    if len(todo) < len(df):
+        log.info(f"Resuming {out_path}: {len(writer.done)} rows embedded, {len(writer.failed)} failed, {len(todo)} left")
+
+    # duplicates are recorded like failed rows, so a resumed task does not fetch them again
+    failed = []
+    dedup = content_claims.filter_for(os.path.basename(out_path)) if content_claims is not None else None
+    batches = embed_images(todo, batch_size, model, preprocess, concurrency, per_host, queue_depth, failed, dedup)
+    return save_embeddings(batches, todo, writer, failed)
+
+# drop rows whose url already occurred earlier in the input, by row number within the source file
+def drop_duplicate_urls(df, source):
+    if url_duplicates is None:
+        return df
+    dup = df.index.isin(url_duplicates.get(os.path.basename(source), ()))
+    if dup.any():
+        duplicates_total.labels(kind="url").inc(int(dup.sum()))
+        log.info(f"Skipping {int(dup.sum())} rows of {os.path.basename(source)} with duplicate urls")
+    return df[~dup]
+
+# load clip; on cpu, wrap it in the optimized encoder that passed the accuracy gate
+def load_model(precision="fp32", trace=True, threads=None, gate_dir=None, min_cosine=0.99):
+    if device == "cpu":
+        log.info(f"Using {configure_threads(threads)} intra-op threads")
+    model, preprocess = clip.load("ViT-B/32", device=device)
+    if device == "cpu":
+        model = build_encoder(model, preprocess, precision, trace, gate_dir, min_cosine, log.info)
+        log.info(f"Loaded CLIP model ViT-B/32 on cpu ({model.describe()})")
+    else:
+        log.info(f"Loaded CLIP model ViT-B/32 on device: {device}")
+    return model, preprocess
 
 # main function to coordinate loading, embedding, and saving
-def main(parquet_dir, output_dir, prefix, sample_count, batch_size):
+def main(parquet_dir, output_dir, prefix, sample_count, batch_size, concurrency, per_host, queue_depth,
+         metrics_dir=default_textfile_dir, queue_dir=None, unit_rows=1000, lease_seconds=600,
+         checkpoint_rows=1024, restart=False, model_options=None, decode_workers=2, draft=True,
+         url_duplicates_path=None, claims_dir=None, cache_options=None, fused_options=None, codec="float32"):
+    global decoder, url_duplicates, content_claims, stager, image_cache, index_options, codec_spec
+
+    # slurm sends sigterm at the time limit or on preemption; exit through the checkpointing path
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    # publish metrics while the task runs, marking success only when it completes
+    metrics = start_textfile("embed", task_id, metrics_dir)
+    ok = False
+
+    if url_duplicates_path:
+        url_duplicates = load_url_duplicates(url_duplicates_path)
+        log.info(f"Loaded url duplicates of {len(url_duplicates)} files from {url_duplicates_path}")
+    if claims_dir:
+        content_claims = ContentClaims(claims_dir)
+    cache_options = cache_options or {}
+    if cache_options.get("scratch_dir"):
+        stager = FileStager(cache_options["scratch_dir"], cache_options.get("stage_max_mb", 50000), log.info)
+    if cache_options.get("image_cache_dir"):
+        image_cache = ImageCache(cache_options["image_cache_dir"], cache_options.get("image_cache_max_mb", 100000),
+                                 cache_options.get("refetch_failed", False), cache_options.get("failed_ttl_hours", 24))
+        log.info(f"Caching images in {cache_options['image_cache_dir']} "
+                 f"({image_cache.disk_bytes / 2**20:.0f} MB cached)")
+
+    codec_spec = codec
+    if codec != "float32":
+        log.info(f"Storing embeddings with the {codec} codec")
+    if fused_options and fused_options.get("index_dir"):
+        index_options = dict(fused_options)
+        os.makedirs(index_options["index_dir"], exist_ok=True)
+        if index_options["checkpoint_dir"]:
+            os.makedirs(index_options["checkpoint_dir"], exist_ok=True)
+        log.info(f"Fused mode: adding embeddings to {index_options['template'] or index_options['spec']} shards "
+                 f"in {index_options['index_dir']} (embedding parquet {'kept' if index_options['keep_embeddings'] else 'not written'})")
+
+    # start the decode processes before the model spins up its thread pools
+    if decode_workers > 0:
+        decoder = DecodePool(decode_workers, draft=draft)
+        log.info(f"Decoding images in {decode_workers} processes (draft mode {'on' if draft else 'off'})")
+    try:
+        if queue_dir:
+            embed_queue(parquet_dir, output_dir, prefix, sample_count, batch_size, concurrency, per_host,
+                        queue_depth, queue_dir, unit_rows, lease_seconds, checkpoint_rows, restart, model_options)
+        else:
+            embed_task(parquet_dir, output_dir, prefix, sample_count, batch_size, concurrency, per_host, queue_depth,
+                       checkpoint_rows, restart, model_options)
+        ok = True
+    finally:
+        if decoder is not None:
+            decoder.close()
+        if stager is not None:
+            stager.close()
+        if metrics is not None:
+            metrics.stop(ok)
+
+# embed the sampled rows of the parquet file assigned to this task
+def embed_task(parquet_dir, output_dir, prefix, sample_count, batch_size, concurrency, per_host, queue_depth,
+               checkpoint_rows=1024, restart=False, model_options=None):
     # collect all available parquet files
     files = sorted([f for f in os.listdir(parquet_dir) if f.endswith(".parquet")])
 
@@ -107,22 +281,59 @@ def main(parquet_dir, output_dir, prefix, sample_count, batch_size):
     # select parquet file assigned to this task
     file_path = os.path.join(parquet_dir, files[task_id])
     log.info(f"Task {task_id} started: Processing file {file_path}")
-    log.info(f"Sampling up to {sample_count} rows | batch size = {batch_size}")
+    log.info(f"Sampling up to {sample_count} rows | batch size = {batch_size} | fetch concurrency = {concurrency}")
 
     # load and sample the dataframe
-    df = pd.read_parquet(file_path).head(sample_count)
+    with timed("load_input"):
+        df = pd.read_parquet(stager.stage(file_path) if stager is not None else file_path).head(sample_count)
+    df = drop_duplicate_urls(df, file_path)
 
     # load clip model and preprocessing pipeline
-    model, preprocess = clip.load("ViT-B/32", device=device)
-    log.info(f"Loaded CLIP model ViT-B/32 on device: {device}")
+    with timed("load_model"):
+        model, preprocess = load_model(**(model_options or {}))
+
+    # embed all sampled images, writing each batch to parquet as soon as it is ready
+    out_path = os.path.join(output_dir, f"{prefix}_task{task_id}.parquet")
+    with timed("embed"):
+        count = embed_to_shard(df, out_path, model, preprocess, batch_size, concurrency, per_host, queue_depth,
+                               checkpoint_rows, restart)
+
+    log.info(f"Task {task_id} completed: {count} images embedded")
+
+# lease row ranges of every input file from the shared queue until none are left
+# each unit is written to its own output file named after the unit
+def embed_queue(parquet_dir, output_dir, prefix, sample_count, batch_size, concurrency, per_host,
+                queue_depth, queue_dir, unit_rows, lease_seconds, checkpoint_rows=1024, restart=False,
+                model_options=None):
+    files = sorted(os.path.join(parquet_dir, f) for f in os.listdir(parquet_dir) if f.endswith(".parquet"))
+    queue = WorkQueue(queue_dir, f"embed_task{task_id}", lease_seconds)
+    units = queue.init(plan_units(files, unit_rows, sample_count))
+    log.info(f"Task {task_id} started: {len(units)} work units of up to {unit_rows} rows in {queue_dir}")
 
-    # run embedding for all sampled images
-    embs, ids = embed_images(df, batch_size, model, preprocess)
+    # the model is loaded once and reused for every leased unit
+    with timed("load_model"):
+        model, preprocess = load_model(**(model_options or {}))
 
-    # save final outputs to parquet
-    save_embeddings(embs, df, ids, output_dir, prefix)
+    def process(unit):
+        # read the unit from a local copy, and start copying the input of the unit likely to come next
+        path = unit["path"]
+        if stager is not None:
+            path = stager.stage(path)
+            upcoming = queue.peek()
+            if upcoming is not None:
+                stager.prefetch(upcoming["path"])
 
-    log.info(f"Task {task_id} completed: {len(embs)} images embedded")
+        # keep row numbers within the source file as sample ids, as in per-file mode
+        df = read_row_range(path, unit["start"], unit["stop"]).to_pandas()
+        df.index = range(unit["start"], unit["stop"])
+        df = drop_duplicate_urls(df, unit["path"])
+        out_path = os.path.join(output_dir, f"{prefix}_{unit['id']}.parquet")
+        embed_to_shard(df, out_path, model, preprocess, batch_size, concurrency, per_host, queue_depth,
+                       checkpoint_rows, restart)
+
+    with timed("embed"):
+        done, failed = queue.run(process, log.info)
+    log.info(f"Task {task_id} completed: {done} units embedded, {failed} failed | queue {queue.status()}")
 
 # entry point for slurm array job
 if __name__ == "__main__":
@@ -142,7 +353,107 @@ if __name__ == "__main__":
       
     # image embedding batch size
     parser.add_argument("--batch_size", type=int, default=64)   
+
+    # number of concurrent image downloads
+    parser.add_argument("--fetch_concurrency", type=int, default=16)
+
+    # maximum concurrent downloads from a single host
+    parser.add_argument("--per_host", type=int, default=4)
+
+    # number of preprocessed images buffered ahead of the model
+    parser.add_argument("--queue_depth", type=int, default=256)
+
+    # node exporter textfile collector directory for prometheus metrics
+    parser.add_argument("--metrics_dir", type=str, default=default_textfile_dir)
+
+    # shared work queue directory; when set, tasks lease row ranges instead of one file each
+    parser.add_argument("--queue_dir", type=str, default=None)
+
+    # rows per work unit and seconds before a crashed worker's unit is re-leased
+    parser.add_argument("--unit_rows", type=int, default=1000)
+    parser.add_argument("--lease_seconds", type=int, default=600)
+
+    # rows between durable checkpoints of partial output
+    parser.add_argument("--checkpoint_rows", type=int, default=1024)
+
+    # discard existing checkpoints and outputs instead of resuming
+    parser.add_argument("--restart", action="store_true")
+
+    # cpu inference: fp32, int8 (dynamic quantization of linear layers) or bf16 (autocast)
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "int8", "bf16"])
+
+    # run the vision tower eagerly instead of as a traced, frozen graph
+    parser.add_argument("--no_trace", action="store_true")
+
+    # intra-op threads (defaults to SLURM_CPUS_PER_TASK)
+    parser.add_argument("--threads", type=int, default=None)
+
+    # fixed images whose embeddings must stay within min_cosine of fp32, else fp32 is used;
+    # required for int8 and bf16
+    parser.add_argument("--gate_dir", type=str, default=None)
+    parser.add_argument("--min_cosine", type=float, default=0.99)
+
+    # processes decoding and resizing images off the inference thread (0: decode on the fetch threads)
+    parser.add_argument("--decode_workers", type=int, default=2)
+
+    # decode jpegs at full resolution instead of the smallest dct scale still >= 224
+    parser.add_argument("--no_draft", action="store_true")
+
+    # url duplicates file from dedup.py; rows listed there are not fetched
+    parser.add_argument("--url_duplicates", type=str, default=None)
+
+    # shared directory of image content hash claims; identical images are embedded once across tasks
+    parser.add_argument("--dedup_dir", type=str, default=None)
+
+    # node-local directory input parquet files are copied to before reading, and its size limit
+    parser.add_argument("--scratch_dir", type=str, default=None)
+    parser.add_argument("--stage_max_mb", type=float, default=50000)
+
+    # node-local cache of downloaded images keyed by url; re-runs and other models skip the network
+    parser.add_argument("--image_cache_dir", type=str, default=None)
+    parser.add_argument("--image_cache_max_mb", type=float, default=100000)
+
+    # download urls again that failed on an earlier run instead of skipping them
+    parser.add_argument("--refetch_failed", action="store_true")
+
+    # hours a failed url is skipped before it is downloaded again
+    parser.add_argument("--failed_ttl_hours", type=float, default=24)
+
+    # fused mode: add embeddings straight into faiss shards in this directory, in the layout
+    # build_faiss_index.py writes, instead of writing embedding parquet for a separate index job
+    parser.add_argument("--index_dir", type=str, default=None)
+    parser.add_argument("--index_prefix", type=str, default="faiss_shard")
+
+    # fused mode index: flat, or a trained template from build_faiss_index.py --train_template
+    parser.add_argument("--index_type", type=str, default="flat")
+    parser.add_argument("--template", type=str, default=None)
+
+    # fused mode: also write the embedding parquet (needed for near-duplicate dedup and template training)
+    parser.add_argument("--keep_embeddings", action="store_true")
+
+    # fused mode: node-local directory for checkpoints when the embedding parquet is not kept
+    parser.add_argument("--checkpoint_dir", type=str, default=None)
+
+    # fused mode: also write each shard's normalized vectors, for merging with --rerank_vectors
+    parser.add_argument("--rerank_vectors", action="store_true")
+
+    # storage codec of the embedding parquet: float32, float16, int8 or pq:<codebook index>
+    parser.add_argument("--codec", type=str, default="float32")
            
     args = parser.parse_args()
+    if args.precision != "fp32" and not args.gate_dir:
+        parser.error(f"--precision {args.precision} needs --gate_dir images to check it against fp32")
 
-    main(args.parquet_dir, args.output_dir, args.output_prefix, args.sample_count, args.batch_size)
\ No newline at end of file
+    main(args.parquet_dir, args.output_dir, args.output_prefix, args.sample_count, args.batch_size,
+         args.fetch_concurrency, args.per_host, args.queue_depth, args.metrics_dir,
+         args.queue_dir, args.unit_rows, args.lease_seconds, args.checkpoint_rows, args.restart,
+         {"precision": args.precision, "trace": not args.no_trace, "threads": args.threads,
+          "gate_dir": args.gate_dir, "min_cosine": args.min_cosine},
+         args.decode_workers, not args.no_draft, args.url_duplicates, args.dedup_dir,
+         {"scratch_dir": args.scratch_dir, "stage_max_mb": args.stage_max_mb,
+          "image_cache_dir": args.image_cache_dir, "image_cache_max_mb": args.image_cache_max_mb,
+          "refetch_failed": args.refetch_failed, "failed_ttl_hours": args.failed_ttl_hours},
+         {"index_dir": args.index_dir, "prefix": args.index_prefix, "spec": resolve_index_type(args.index_type),
+          "template": args.template, "keep_embeddings": args.keep_embeddings, "checkpoint_dir": args.checkpoint_dir,
+          "rerank_vectors": args.rerank_vectors},
+         args.codec)
\ No newline at end of file
@@ -0,0 +1,176 @@
+import json
+import numpy as np
+import pyarrow as pa
+import faiss
+
+# storage codecs for the embedding column of embedding parquet files (used by embedding_store.py)
+#   float32  fixed-size list of float32, 4 bytes per dimension; the default, and what files
+#            without codec metadata hold
+#   float16  fixed-size list of float16, 2 bytes per dimension
+#   int8     dim-byte fixed-size binary plus a float32 embedding_scale column: each vector is divided
+#            by max|x| / 127 and rounded, about 1 byte per dimension and no training
+#   pq       m-byte fixed-size binary of faiss product quantizer codes of the l2-normalized vector,
+#            plus its norm in embedding_scale. codebooks come from an IndexPQ trained on normalized
+#            vectors: build_faiss_index.py --train_template pq.index --index_type PQ64 --normalize
+# the codec and its parameters are stored as json in the parquet schema metadata under
+# b"embedding_codec" (pq codebooks under b"embedding_codec_pq"), so files decode on their own
+# every codec decodes a whole arrow record batch at once into a (n, dim) float32 matrix
+# (byte codes are fixed-size binary, not lists of int8: parquet would widen those to int32)
+
+codec_key = b"embedding_codec"
+codebook_key = b"embedding_codec_pq"
+
+# codec names accepted by --codec; pq takes the codebook index as pq:<path>
+codec_names = ["float32", "float16", "int8", "pq"]
+
+# values of a list array chunk as an (n, dim) numpy matrix of its own dtype
+# fixed-size lists are viewed in place; variable-length lists must all have the same length
+def list_matrix(chunk, dim=None):
+    if dim is None:
+        if pa.types.is_fixed_size_list(chunk.type):
+            dim = chunk.type.list_size
+        else:
+            offsets = chunk.offsets.to_numpy()
+            dim = int(offsets[1] - offsets[0]) if len(chunk) else 0
+    return chunk.flatten().to_numpy(zero_copy_only=False).reshape(-1, dim)
+
+# wrap an (n, dim) matrix as a fixed-size-list arrow array of the given numpy dtype
+def fixed_size_list(x, dtype):
+    x = np.ascontiguousarray(x, dtype=dtype)
+    return pa.FixedSizeListArray.from_arrays(pa.array(x.reshape(-1)), x.shape[1])
+
+# wrap an (n, width) matrix of one-byte codes as fixed-size binary, one value per row
+def fixed_size_binary(codes):
+    codes = np.ascontiguousarray(codes)
+    return pa.FixedSizeBinaryArray.from_buffers(pa.binary(codes.shape[1]), len(codes),
+                                                [None, pa.py_buffer(codes.tobytes())])
+
+# the codes of a fixed-size binary chunk as an (n, width) matrix, viewed in place
+def binary_matrix(chunk, dtype):
+    width = chunk.type.byte_width
+    data = np.frombuffer(chunk.buffers()[1], dtype=dtype)
+    return data[chunk.offset * width:(chunk.offset + len(chunk)) * width].reshape(-1, width)
+
+class Float32Codec:
+    name = "float32"
+    value_type = pa.float32()
+
+    def __init__(self, dim):
+        self.dim = dim
+
+    # arrow fields holding the encoded vectors; a variable-length list when dim is unknown (legacy files)
+    def fields(self):
+        return [pa.field("embedding", pa.list_(self.value_type, -1 if self.dim is None else self.dim))]
+
+    @property
+    def columns(self):
+        return [f.name for f in self.fields()]
+
+    # schema metadata describing the codec; float32 files carry none, as before
+    def metadata(self):
+        return {}
+
+    def params(self):
+        return {"codec": self.name, "dim": self.dim}
+
+    # encoded arrays, one per field, of an (n, dim) matrix
+    def encode(self, x):
+        return [fixed_size_list(x, np.float32)]
+
+    # (n, dim) float32 matrix from a record batch holding the codec's columns
+    def decode(self, batch):
+        x = list_matrix(batch.column(0))
+        return x if x.dtype == np.float32 else x.astype(np.float32)
+
+class Float16Codec(Float32Codec):
+    name = "float16"
+    value_type = pa.float16()
+
+    def metadata(self):
+        return {codec_key: json.dumps(self.params()).encode()}
+
+    def encode(self, x):
+        return [fixed_size_list(x, np.float16)]
+
+    def decode(self, batch):
+        return list_matrix(batch.column(0), self.dim).astype(np.float32)
+
+class Int8Codec(Float16Codec):
+    name = "int8"
+
+    def fields(self):
+        return [pa.field("embedding", pa.binary(self.dim)), pa.field("embedding_scale", pa.float32())]
+
+    def encode(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        scale = np.abs(x).max(axis=1) / 127
+        scale[scale == 0] = 1
+        codes = np.rint(x / scale[:, None])
+        return [fixed_size_binary(codes.astype(np.int8)), pa.array(scale.astype(np.float32))]
+
+    def decode(self, batch):
+        scale = batch.column(1).to_numpy(zero_copy_only=False)
+        return binary_matrix(batch.column(0), np.int8).astype(np.float32) * scale[:, None]
+
+class PQCodec(Float16Codec):
+    name = "pq"
+
+    def __init__(self, dim, index):
+        if not isinstance(index, faiss.IndexPQ) or not index.is_trained or index.d != dim:
+            raise ValueError(f"pq codec needs a trained {dim}-d IndexPQ, e.g. --index_type PQ64 --train_template")
+        super().__init__(dim)
+        self.index = index
+
+    def fields(self):
+        return [pa.field("embedding", pa.binary(self.index.sa_code_size())),
+                pa.field("embedding_scale", pa.float32())]
+
+    def params(self):
+        return {**super().params(), "m": self.index.pq.M, "nbits": self.index.pq.nbits}
+
+    def metadata(self):
+        return {**super().metadata(), codebook_key: faiss.serialize_index(self.index).tobytes()}
+
+    def encode(self, x):
+        x = np.array(x, dtype=np.float32)
+        norms = np.linalg.norm(x, axis=1).astype(np.float32)
+        faiss.normalize_L2(x)
+        return [fixed_size_binary(self.index.sa_encode(x)), pa.array(norms)]
+
+    def decode(self, batch):
+        codes = np.ascontiguousarray(binary_matrix(batch.column(0), np.uint8))
+        norms = batch.column(1).to_numpy(zero_copy_only=False)
+        return self.index.sa_decode(codes) * norms[:, None]
+
+codecs = {c.name: c for c in (Float32Codec, Float16Codec, Int8Codec)}
+
+# codec from a --codec value: float32, float16, int8 or pq:<codebook index path>
+def make_codec(spec, dim):
+    name, _, path = (spec or "float32").partition(":")
+    if name == "pq":
+        if not path:
+            raise ValueError("pq codec needs its codebook index, e.g. pq:/path/to/pq.index")
+        return PQCodec(dim, faiss.read_index(path))
+    if name not in codecs:
+        raise ValueError(f"Unknown embedding codec {spec!r}, expected one of {', '.join(codec_names)}")
+    return codecs[name](dim)
+
+# pq codebooks already deserialized, by their bytes, so reading many files loads each once
+loaded_codebooks = {}
+
+# codec of an embedding file from its arrow schema; files without codec metadata are float32
+# (dim is none for legacy variable-length list columns)
+def codec_from_schema(schema):
+    meta = schema.metadata or {}
+    if codec_key not in meta:
+        field = schema.field("embedding")
+        return Float32Codec(field.type.list_size if pa.types.is_fixed_size_list(field.type) else None)
+    params = json.loads(meta[codec_key])
+    if params["codec"] == "pq":
+        data = meta[codebook_key]
+        if data not in loaded_codebooks:
+            loaded_codebooks[data] = faiss.deserialize_index(np.frombuffer(data, dtype=np.uint8))
+        return PQCodec(params["dim"], loaded_codebooks[data])
+    if params["codec"] not in codecs:
+        raise ValueError(f"Unknown embedding codec {params['codec']!r} in file metadata")
+    return codecs[params["codec"]](params["dim"])
@@ -0,0 +1,291 @@
+import os
+import json
+import shutil
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from embedding_codec import Float32Codec, codec_from_schema
+
+# arrow schema for embedding shards: metadata plus the vector column(s) of the storage codec
+# (embedding_codec.py), a fixed-size float32 list by default
+def embedding_schema(dim, codec=None):
+    codec = codec or Float32Codec(dim)
+    return pa.schema([
+        ("sample_id", pa.int64()),
+        ("url", pa.string()),
+        ("text", pa.string()),
+    ] + codec.fields(), metadata=codec.metadata() or None)
+
+# arrow schema for index shard metadata and the merged metadata: the embedding metadata plus, on
+# rows that near duplicates (dedup.py) collapsed into, their sample ids and urls (one per line)
+# the collapsed columns are always present and null elsewhere, so deduped and plain shards merge
+def shard_metadata_schema():
+    return pa.schema([
+        ("sample_id", pa.int64()),
+        ("url", pa.string()),
+        ("text", pa.string()),
+        ("collapsed_sample_ids", pa.list_(pa.int64())),
+        ("collapsed_urls", pa.string()),
+    ])
+
+# a metadata table in shard_metadata_schema, with the columns it lacks (older shards) as nulls
+def conform_metadata(table):
+    schema = shard_metadata_schema()
+    for field in schema:
+        if field.name not in table.column_names:
+            table = table.append_column(field, pa.nulls(table.num_rows, field.type))
+    return table.select(schema.names).cast(schema)
+
+# streaming parquet writer that appends each embedded batch as its own row group
+class EmbeddingWriter:
+    def __init__(self, path, dim, compression="snappy", codec=None):
+        self.path = path
+        self.codec = codec or Float32Codec(dim)
+        self.schema = embedding_schema(dim, self.codec)
+        # dictionary encoding never pays off for float vectors and inflates decode memory
+        self.writer = pq.ParquetWriter(path, self.schema, compression=compression,
+                                       use_dictionary=["sample_id", "url", "text"])
+        self.rows = 0
+
+    # write one batch of ids, urls, captions and a (n, dim) embedding matrix
+    def write_batch(self, ids, urls, texts, x):
+        table = pa.Table.from_arrays([
+            pa.array(ids, pa.int64()),
+            pa.array(urls, pa.string()),
+            pa.array(texts, pa.string()),
+        ] + self.codec.encode(x), schema=self.schema)
+        self.writer.write_table(table)
+        self.rows += len(ids)
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# flush a file (or a directory's entries, after a rename into it) to disk
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# checkpointed writer for long embedding tasks that may be killed and restarted
+# batches go into small closed part files under <path>.parts/, and progress.jsonl records,
+# once each part is durable, which sample ids it holds and which ids failed for good.
+# a restarted task reads the log, skips finished ids and keeps appending parts;
+# close() compacts the parts into the single shard file at path, stored with codec; with exact_parts
+# the parts themselves hold float32 vectors and are only encoded with codec when compacted
+class CheckpointWriter:
+    def __init__(self, path, dim, checkpoint_rows=1024, codec=None, exact_parts=False):
+        self.path = path
+        self.dim = dim
+        self.codec = codec
+        self.part_codec = None if exact_parts else codec
+        self.checkpoint_rows = checkpoint_rows
+        self.parts_dir = f"{path}.parts"
+        self.progress_path = os.path.join(self.parts_dir, "progress.jsonl")
+        self.parts, self.done, self.failed = [], set(), set()
+        self.rows = 0
+        self.writer, self.writer_name = None, None
+        self.pending_ids, self.pending_failed = [], []
+        os.makedirs(self.parts_dir, exist_ok=True)
+        self._load_progress()
+
+    # replay the progress log; parts that never made it into the log are discarded
+    def _load_progress(self):
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a torn last line from a kill mid-write
+                        continue
+                    if entry.get("part"):
+                        self.parts.append(entry["part"])
+                    self.done.update(entry.get("done", []))
+                    self.failed.update(entry.get("failed", []))
+        for f in os.listdir(self.parts_dir):
+            if f.startswith("part_") and f not in self.parts:
+                os.remove(os.path.join(self.parts_dir, f))
+        self.rows = len(self.done)
+
+    # sample ids that need no more work: embedded or permanently failed
+    def finished(self):
+        return self.done | self.failed
+
+    def write_batch(self, ids, urls, texts, x):
+        if self.writer is None:
+            name = f"part_{len(self.parts):05d}.parquet"
+            self.writer = EmbeddingWriter(os.path.join(self.parts_dir, f"{name}.tmp"), self.dim, codec=self.part_codec)
+            self.writer_name = name
+        self.writer.write_batch(ids, urls, texts, x)
+        self.pending_ids.extend(int(i) for i in ids)
+        self.rows += len(ids)
+        if len(self.pending_ids) >= self.checkpoint_rows:
+            self.checkpoint()
+
+    def mark_failed(self, ids):
+        self.pending_failed.extend(int(i) for i in ids)
+
+    # make everything written so far durable: close the open part and sync it and its rename to
+    # disk, then log it, so the log never names a part a crash could leave truncated
+    def checkpoint(self):
+        part = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            part = self.writer_name
+            tmp = os.path.join(self.parts_dir, f"{part}.tmp")
+            fsync_path(tmp)
+            os.replace(tmp, os.path.join(self.parts_dir, part))
+            fsync_path(self.parts_dir)
+            self.parts.append(part)
+        if part is None and not self.pending_failed:
+            return
+        with open(self.progress_path, "a") as f:
+            f.write(json.dumps({"part": part, "done": self.pending_ids, "failed": self.pending_failed}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.update(self.pending_ids)
+        self.failed.update(self.pending_failed)
+        self.pending_ids, self.pending_failed = [], []
+
+    # checkpoint, then merge the parts into the final shard and drop the checkpoint directory
+    def close(self):
+        self.checkpoint()
+        compact_parts([os.path.join(self.parts_dir, p) for p in self.parts], self.path, self.dim, self.codec)
+        shutil.rmtree(self.parts_dir)
+
+# concatenate embedding part files into one shard, one row group at a time; parts written with the
+# shard's codec are copied as they are, others (e.g. float32 parts of a lossy shard) are re-encoded
+def compact_parts(part_paths, out_path, dim, codec=None):
+    with EmbeddingWriter(f"{out_path}.tmp", dim, codec=codec) as writer:
+        for part in part_paths:
+            pf = pq.ParquetFile(part)
+            part_codec = codec_from_schema(pf.schema_arrow)
+            same = part_codec.metadata() == writer.codec.metadata()
+            for i in range(pf.metadata.num_row_groups):
+                table = pf.read_row_group(i)
+                if same:
+                    writer.writer.write_table(table.cast(writer.schema))
+                    writer.rows += table.num_rows
+                    continue
+                for batch in table.to_batches():
+                    writer.write_batch(batch.column("sample_id").to_numpy(), batch.column("url").to_pylist(),
+                                       batch.column("text").to_pylist(), part_codec.decode(batch.select(part_codec.columns)))
+    os.replace(f"{out_path}.tmp", out_path)
+
+# path of the optional memory-mapped sidecar for an embedding parquet file
+def sidecar_path(path, suffix=".npy"):
+    path = str(path)
+    if path.endswith(".parquet"):
+        path = path[:-len(".parquet")]
+    return path + suffix
+
+# embedding dimensionality recorded in the parquet schema (none for variable-length lists)
+def embedding_dim(path):
+    return codec_from_schema(pq.read_schema(path)).dim
+
+# storage codec of an embedding file
+def embedding_codec(path):
+    return codec_from_schema(pq.read_schema(path))
+
+# open a .npy or raw float32 sidecar as a read-only memory map
+def open_sidecar(path, dim=None):
+    if str(path).endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    return np.memmap(path, dtype=np.float32, mode="r").reshape(-1, dim)
+
+# (row group index, first row) of every row group overlapping rows [start, stop)
+def row_groups_in_range(pf, start, stop):
+    groups, offset = [], 0
+    for i in range(pf.metadata.num_row_groups):
+        n = pf.metadata.row_group(i).num_rows
+        if offset < stop and offset + n > start:
+            groups.append((i, offset))
+        offset += n
+    return groups
+
+# read rows [start, stop) of a parquet file, decoding only the row groups that overlap them
+def read_row_range(path, start, stop, columns=None):
+    pf = pq.ParquetFile(path)
+    groups = row_groups_in_range(pf, start, stop)
+    if not groups:
+        return pf.schema_arrow.empty_table().select(columns or pf.schema_arrow.names)
+    table = pf.read_row_groups([i for i, _ in groups], columns=columns)
+    return table.slice(start - groups[0][1], stop - start)
+
+# yield contiguous float32 chunks of at most chunk_rows vectors from a shard
+# reads from a sidecar when given, otherwise decodes the parquet embedding column(s) one chunk at a time
+# rows=(start, stop) restricts reading to that row range
+def iter_embedding_chunks(path, chunk_rows=65536, sidecar=None, rows=None):
+    if sidecar is not None:
+        x = open_sidecar(sidecar, embedding_dim(path) if not str(sidecar).endswith(".npy") else None)
+        first, last = rows or (0, x.shape[0])
+        for start in range(first, last, chunk_rows):
+            yield np.ascontiguousarray(x[start:min(start + chunk_rows, last)], dtype=np.float32)
+        return
+
+    # read whole row groups, grouped up to chunk_rows, so only one chunk is decoded at a time
+    pf = pq.ParquetFile(path)
+    codec = codec_from_schema(pf.schema_arrow)
+    first, last = rows or (0, pf.metadata.num_rows)
+    groups = row_groups_in_range(pf, first, last)
+    group, count = [], 0
+    for j, (i, offset) in enumerate(groups):
+        group.append((i, offset))
+        count += pf.metadata.row_group(i).num_rows
+        if count >= chunk_rows or j == len(groups) - 1:
+            table = pf.read_row_groups([g for g, _ in group], columns=codec.columns)
+            # trim the first and last group to the requested range
+            lo = max(first - group[0][1], 0)
+            hi = min(last - group[0][1], table.num_rows)
+            for batch in table.slice(lo, hi - lo).to_batches():
+                if batch.num_rows:
+                    yield np.ascontiguousarray(codec.decode(batch))
+            group, count = [], 0
+
+# read a whole shard into one preallocated contiguous float32 matrix
+def read_embedding_matrix(path, chunk_rows=65536, sidecar=None):
+    if sidecar is not None:
+        return np.ascontiguousarray(open_sidecar(sidecar, embedding_dim(path)), dtype=np.float32)
+
+    pf = pq.ParquetFile(path)
+    n = pf.metadata.num_rows
+    x = None
+    start = 0
+    for chunk in iter_embedding_chunks(path, chunk_rows):
+        if x is None:
+            x = np.empty((n, chunk.shape[1]), dtype=np.float32)
+        x[start:start + len(chunk)] = chunk
+        start += len(chunk)
+    if x is None:
+        x = np.empty((0, embedding_dim(path) or 0), dtype=np.float32)
+    return x
+
+# read only the metadata columns of a shard, optionally just rows=(start, stop)
+def read_metadata(path, rows=None):
+    if rows is not None:
+        return read_row_range(path, rows[0], rows[1], ["sample_id", "url", "text"]).to_pandas()
+    return pq.read_table(path, columns=["sample_id", "url", "text"]).to_pandas()
+
+# write a .npy sidecar for a shard without holding the whole matrix in memory
+def write_sidecar(path, out_path=None, chunk_rows=65536):
+    out_path = out_path or sidecar_path(path)
+    n = pq.ParquetFile(path).metadata.num_rows
+    x = None
+    start = 0
+    for chunk in iter_embedding_chunks(path, chunk_rows):
+        if x is None:
+            x = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float32, shape=(n, chunk.shape[1]))
+        x[start:start + len(chunk)] = chunk
+        start += len(chunk)
+    if x is not None:
+        x.flush()
+    return out_path
@@ -0,0 +1,259 @@
+import io
+import time
+import logging
+import queue
+import threading
+from collections import deque
+from PIL import Image
+from urllib.parse import urlsplit
+from urllib.request import urlopen, Request
+from pipeline_metrics import counter, histogram
+
+# fetch metrics, exported by whichever stage uses the fetcher
+fetch_seconds = histogram("laion_fetch_seconds", "Image download latency including retries")
+fetch_results = counter("laion_images_total", "Images fetched or failed, by result", ["result"])
+
+# default request headers used for every image download
+headers = {'User-Agent': 'Mozilla/5.0'}
+
+log = logging.getLogger()
+
+# download raw image bytes from url with retry mechanism
+def fetch_bytes(url, timeout=10, retries=2):
+    for _ in range(retries):
+        try:
+            with urlopen(Request(url, headers=headers), timeout=timeout) as r:
+                return r.read()
+        except Exception:
+            continue
+    return None
+
+# decode downloaded bytes and apply the model preprocessing
+def decode_image(img_data, preprocess):
+    try:
+        return preprocess(Image.open(io.BytesIO(img_data)).convert("RGB"))
+    except Exception:
+        return None
+
+# host part of a url, the unit per-host download limits apply to
+def url_host(url):
+    try:
+        return urlsplit(url).netloc.lower()
+    except ValueError:
+        return ""
+
+# hands out (key, url) items so that at most per_host downloads run against one host at a time
+# an item whose host is saturated is deferred to that host's queue and the worker takes the next
+# item instead of blocking, so urls of other hosts never wait behind a slow one; deferred items go
+# out first once their host frees a slot, and past max_deferred of them workers wait for a slot
+# rather than read further ahead
+class HostScheduler:
+    def __init__(self, items, per_host, max_deferred):
+        self.source = iter(items)
+        self.per_host = per_host
+        self.max_deferred = max_deferred
+        self.active = {}
+        self.deferred = {}
+        self.deferred_count = 0
+        self.exhausted = False
+        self.cond = threading.Condition()
+
+    # next (key, url, host) to download, holding one of its host's slots, or none once all were handed out
+    def next(self, stop):
+        with self.cond:
+            while not stop.is_set():
+                for host, waiting in self.deferred.items():
+                    if self.active.get(host, 0) < self.per_host:
+                        key, url = waiting.popleft()
+                        if not waiting:
+                            del self.deferred[host]
+                        self.deferred_count -= 1
+                        return self._take(key, url, host)
+                if not self.exhausted and self.deferred_count < self.max_deferred:
+                    try:
+                        key, url = next(self.source)
+                    except StopIteration:
+                        self.exhausted = True
+                        continue
+                    host = url_host(url)
+                    if host not in self.deferred and self.active.get(host, 0) < self.per_host:
+                        return self._take(key, url, host)
+                    self.deferred.setdefault(host, deque()).append((key, url))
+                    self.deferred_count += 1
+                    continue
+                if self.exhausted and not self.deferred:
+                    return None
+                self.cond.wait(0.1)
+            return None
+
+    def _take(self, key, url, host):
+        self.active[host] = self.active.get(host, 0) + 1
+        return key, url, host
+
+    # give back the slot of a finished download
+    def release(self, host):
+        with self.cond:
+            self.active[host] -= 1
+            if not self.active[host]:
+                del self.active[host]
+            self.cond.notify_all()
+
+# bounded concurrent fetch stage that feeds preprocessed tensors into a queue
+# with a decoder (image_preprocess.DecodePool) images are decoded in its worker processes
+# and come out as uint8 arrays; otherwise preprocess runs on the fetch threads
+# dedup(key, bytes) -> bool, when given, drops downloaded images it returns false for
+# with a cache (local_cache.ImageCache) urls fetched or failed before are not downloaded again
+# downloads are limited to per_host per host through a HostScheduler, deferring up to max_deferred urls
+class ImageFetcher:
+    def __init__(self, preprocess, concurrency=16, per_host=4, queue_depth=256, timeout=10, retries=2,
+                 decoder=None, dedup=None, cache=None, max_deferred=4096):
+        self.preprocess = preprocess
+        self.decoder = decoder
+        self.dedup = dedup
+        self.cache = cache
+        self.concurrency = max(1, concurrency)
+        self.per_host = max(1, per_host)
+        self.queue_depth = max(1, queue_depth)
+        self.timeout = timeout
+        self.retries = retries
+        self.max_deferred = max(1, max_deferred)
+
+        # running counters, read by the consumer for throughput reporting
+        self.fetched = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.count_lock = threading.Lock()
+
+    # raw bytes of one image from the cache or the network, none on failure
+    def fetch(self, url):
+        img_data = self.cache.get(url) if self.cache is not None else None
+        if img_data is None and not (self.cache is not None and self.cache.failed(url)):
+            start = time.perf_counter()
+            img_data = fetch_bytes(url, self.timeout, self.retries)
+            fetch_seconds.observe(time.perf_counter() - start)
+            if self.cache is not None:
+                if img_data is not None:
+                    self.cache.put(url, img_data)
+                else:
+                    self.cache.put_failed(url)
+        return img_data
+
+    # fetch and preprocess one image, returning none on failure or when it is a duplicate
+    def load(self, url, key=None):
+        return self.prepare(self.fetch(url), key)
+
+    # dedup and decode fetched bytes, returning none on failure or when it is a duplicate
+    def prepare(self, img_data, key=None):
+        return self._prepare(img_data, key)[0]
+
+    # (image or none, result) for fetched bytes, result being fetched, failed or duplicate
+    def _prepare(self, img_data, key):
+        if img_data is None:
+            fetch_results.labels(result="failed").inc()
+            return None, "failed"
+        if self.dedup is not None and not self.dedup(key, img_data):
+            fetch_results.labels(result="duplicate").inc()
+            with self.count_lock:
+                self.duplicates += 1
+            return None, "duplicate"
+        if self.decoder is not None:
+            img = self.decoder.decode(img_data)
+        else:
+            img = decode_image(img_data, self.preprocess)
+        result = "fetched" if img is not None else "failed"
+        fetch_results.labels(result=result).inc()
+        return img, result
+
+    # yield (key, tensor or none) pairs in completion order for (key, url) items
+    def stream(self, items):
+        out = queue.Queue(maxsize=self.queue_depth)
+        stop = threading.Event()
+        scheduler = HostScheduler(items, self.per_host, self.max_deferred)
+        done = object()
+
+        # put with backpressure, giving up once the consumer has gone away
+        def put(item):
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        # each worker takes the next url whose host has a free slot until all are handed out
+        # the slot is held for the download only, decoding runs after it is given back
+        # an item whose fetch or decode raises (cache i/o, the dedup claim, a broken decode pool)
+        # counts as failed, and a worker always signals done, so the consumer never waits on it
+        def worker():
+            try:
+                while not stop.is_set():
+                    item = scheduler.next(stop)
+                    if item is None:
+                        break
+                    key, url, host = item
+                    try:
+                        try:
+                            img_data = self.fetch(url)
+                        finally:
+                            scheduler.release(host)
+                        img, result = self._prepare(img_data, key)
+                    except Exception as e:
+                        log.warning(f"Failed to load {url}: {e}")
+                        fetch_results.labels(result="failed").inc()
+                        img, result = None, "failed"
+                    if result != "duplicate":
+                        with self.count_lock:
+                            if img is None:
+                                self.failed += 1
+                            else:
+                                self.fetched += 1
+                    if not put((key, img)):
+                        return
+            finally:
+                put(done)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(self.concurrency)]
+        for t in threads:
+            t.start()
+
+        try:
+            remaining = len(threads)
+            while remaining:
+                item = out.get()
+                if item is done:
+                    remaining -= 1
+                    continue
+                yield item
+        finally:
+            stop.set()
+
+    # group successfully loaded images into full batches of (keys, tensors)
+    # keys of images that could not be fetched or decoded are appended to failed when given
+    def batches(self, items, batch_size, failed=None):
+        batch, batch_keys = [], []
+        for key, img in self.stream(items):
+            if img is None:
+                if failed is not None:
+                    failed.append(key)
+                continue
+            batch.append(img)
+            batch_keys.append(key)
+            if len(batch) >= batch_size:
+                yield batch_keys, batch
+                batch, batch_keys = [], []
+        if batch:
+            yield batch_keys, batch
+
+# simple images/sec meter for progress logging
+class Throughput:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.count = 0
+
+    def add(self, n):
+        self.count += n
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.start
+        return self.count / elapsed if elapsed > 0 else 0.0
@@ -0,0 +1,93 @@
+import io
+import os
+import numpy as np
+import torch
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+
+# clip image preprocessing split into a cpu-heavy decode stage and a cheap batch stage
+#   decode   open at reduced scale (jpeg draft mode decodes at 1/2, 1/4 or 1/8 resolution
+#            straight from the dct, never below size), bicubic resize of the short side to
+#            size, center crop, returned as a (3, size, size) uint8 array
+#   batch    stack the uint8 arrays and normalize them to clip's float input in one op
+# the decode stage runs in a process pool so it neither holds the gil nor shares the
+# inference thread's cores; with draft=False it matches clip's own transform exactly
+
+# clip normalization constants
+clip_mean = (0.48145466, 0.4578275, 0.40821073)
+clip_std = (0.26862954, 0.26130258, 0.27577711)
+
+# open an image from bytes or a path, letting jpeg decode at the smallest scale still >= size
+def open_reduced(src, size=224, draft=True):
+    img = Image.open(io.BytesIO(src) if isinstance(src, (bytes, bytearray)) else src)
+    if draft and img.format == "JPEG":
+        img.draft("RGB", (size, size))
+    return img.convert("RGB")
+
+# resize the short side to size and center crop, with the same rounding as torchvision
+def resize_crop(img, size=224):
+    w, h = img.size
+    short, long = (w, h) if w <= h else (h, w)
+    new_long = int(size * long / short)
+    new_w, new_h = (size, new_long) if w <= h else (new_long, size)
+    if (new_w, new_h) != (w, h):
+        img = img.resize((new_w, new_h), Image.BICUBIC)
+    left = int(round((new_w - size) / 2.0))
+    top = int(round((new_h - size) / 2.0))
+    return img.crop((left, top, left + size, top + size))
+
+# decode stage: bytes or path to a (3, size, size) uint8 array, or none if it cannot be decoded
+def decode_uint8(src, size=224, draft=True):
+    try:
+        img = resize_crop(open_reduced(src, size, draft), size)
+        return np.ascontiguousarray(np.asarray(img, dtype=np.uint8).transpose(2, 0, 1))
+    except Exception:
+        return None
+
+# batch stage: (n, 3, h, w) uint8 tensor to normalized float32 model input
+def normalize_batch(x):
+    x = x.float().div_(255)
+    mean = torch.tensor(clip_mean, dtype=x.dtype).view(1, 3, 1, 1)
+    std = torch.tensor(clip_std, dtype=x.dtype).view(1, 3, 1, 1)
+    return x.sub_(mean).div_(std)
+
+# stack decoded images (uint8 arrays/tensors, or float tensors from a plain transform) into model input
+def to_model_input(images):
+    x = torch.stack([torch.from_numpy(img) if isinstance(img, np.ndarray) else img for img in images])
+    return normalize_batch(x) if x.dtype == torch.uint8 else x
+
+# decode and normalize a single image in the calling process
+def load_tensor(src, size=224, draft=True):
+    img = decode_uint8(src, size, draft)
+    return None if img is None else to_model_input([img])[0]
+
+# process pool running the decode stage; with workers=0 it decodes inline in the caller
+class DecodePool:
+    def __init__(self, workers=None, size=224, draft=True):
+        self.size = size
+        self.draft = draft
+        self.workers = len(os.sched_getaffinity(0)) if workers is None else workers
+        self.pool = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 0 else None
+
+    # decode one image, blocking the calling thread only while a worker process decodes it
+    def decode(self, src):
+        if self.pool is None:
+            return decode_uint8(src, self.size, self.draft)
+        return self.pool.submit(decode_uint8, src, self.size, self.draft).result()
+
+    # decode many images in order
+    def map(self, srcs, chunksize=4):
+        if self.pool is None:
+            return [decode_uint8(s, self.size, self.draft) for s in srcs]
+        n = len(srcs)
+        return list(self.pool.map(decode_uint8, srcs, [self.size] * n, [self.draft] * n, chunksize=chunksize))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+# record of what a merged index holds, written next to it by merge_faiss_shards.py
+# <name>.manifest.json:
+#   version          incremented by every merge that publishes the index
+#   ntotal, dim      vectors in the index (deleted ones included) and their dimension
+#   quantizer        sha1 of the ivf centroids, so shards built on another template are refused
+#   shards           one entry per merged shard: index and metadata file, sizes and sha1s, rows,
+#                    the faiss ids [id_start, id_stop) it occupies and the embedding file it came from
+#   sources          embedding files whose rows are in the index
+#   deleted_sources  embedding files removed with --delete_sources, never merged again
+#   segments         one entry per incremental merge since the last full merge: the version it published,
+#                    its delta index (none when the merged index was rewritten, for hnsw) and metadata
+#                    parquet, e.g. merged.v0003.index and merged_metadata.v0003.parquet next to the merged
+#                    files, and the faiss ids [id_start, id_stop) they hold
+# <name>.deleted.parquet: tombstones, the faiss id and url of every deleted row; searches skip them
+# <name>.vectors.f32: with merge --rerank_vectors, the full-precision (normalized) vector of every faiss
+#   id as raw float32 rows of dim values, memory-mapped by searches that re-rank their candidates;
+#   incremental merges append to it in place, so it may hold rows past ntotal from an unpublished merge
+
+# manifest and tombstone paths next to a merged index
+def manifest_path_for(index_path):
+    return os.path.splitext(str(index_path))[0] + ".manifest.json"
+
+def tombstones_path_for(index_path):
+    return os.path.splitext(str(index_path))[0] + ".deleted.parquet"
+
+def vectors_path_for(index_path):
+    return os.path.splitext(str(index_path))[0] + ".vectors.f32"
+
+# delta file of the segment an incremental merge publishes as version, next to the merged file at path
+def segment_path_for(path, version):
+    base, ext = os.path.splitext(str(path))
+    return f"{base}.v{version:04d}{ext}"
+
+# delta indexes of a manifest's segments, in id order
+def index_parts(index_path, manifest):
+    return [os.path.join(os.path.dirname(str(index_path)), s["index"])
+            for s in (manifest or {}).get("segments", []) if s["index"]]
+
+# (path, first faiss id) of the merged metadata parquet and of its segments' parquet files, in id order
+def metadata_parts(metadata_path, manifest):
+    return [(str(metadata_path), 0)] + [(os.path.join(os.path.dirname(str(metadata_path)), s["metadata"]), s["id_start"])
+                                       for s in (manifest or {}).get("segments", [])]
+
+def file_sha1(path, block=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+# embedding file a shard was built from, recorded by build_faiss_index.py in the parquet schema
+def shard_source(meta_path):
+    md = pq.read_schema(meta_path).metadata or {}
+    source = md.get(b"source")
+    return source.decode("utf-8") if source else None
+
+# manifest entry of one shard whose vectors take the ids from id_start on
+def describe_shard(index_dir, index_file, id_start):
+    meta_file = index_file[:-len(".index")] + ".meta.parquet"
+    index_path, meta_path = os.path.join(index_dir, index_file), os.path.join(index_dir, meta_file)
+    rows = pq.ParquetFile(meta_path).metadata.num_rows
+    st = os.stat(index_path)
+    return {
+        "index": index_file, "meta": meta_file, "source": shard_source(meta_path),
+        "rows": rows, "id_start": id_start, "id_stop": id_start + rows,
+        "size": st.st_size, "mtime": st.st_mtime, "sha1": file_sha1(index_path),
+        "meta_sha1": file_sha1(meta_path),
+    }
+
+# sha1 of the coarse quantizer's centroids, or none for indexes without one
+def quantizer_sha1(index):
+    import faiss
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
+    return hashlib.sha1(ivf.quantizer.reconstruct_n(0, ivf.nlist).tobytes()).hexdigest()
+
+def load_manifest(index_path):
+    path = manifest_path_for(index_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+# write the manifest to a temporary file; the merge renames it into place last
+def write_manifest(index_path, manifest):
+    path = manifest_path_for(index_path)
+    manifest["updated"] = time.time()
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    return f"{path}.tmp"
+
+# embedding files already merged or deleted, which an incremental build leaves out
+def indexed_sources(index_path):
+    manifest = load_manifest(index_path)
+    if manifest is None:
+        return set()
+    return set(manifest["sources"]) | set(manifest.get("deleted_sources", []))
+
+# shard files not yet in the manifest; a merged shard whose files changed since is refused,
+# since its vectors in the index no longer match it. unchanged shards are only stat'ed, not hashed
+def new_shards(index_dir, index_files, manifest):
+    known = {s["index"]: s for s in manifest["shards"]}
+    skipped = set(manifest.get("deleted_sources", []))
+    new = []
+    for f in index_files:
+        entry = known.get(f)
+        if entry is None:
+            if shard_source(os.path.join(index_dir, f[:-len(".index")] + ".meta.parquet")) not in skipped:
+                new.append(f)
+            continue
+        st = os.stat(os.path.join(index_dir, f))
+        if (st.st_size, st.st_mtime) == (entry["size"], entry["mtime"]):
+            continue
+        if file_sha1(os.path.join(index_dir, f)) != entry["sha1"]:
+            raise ValueError(f"{f} changed since it was merged, run a full merge")
+    return new
+
+# faiss ids of every tombstoned row, sorted
+def load_tombstones(index_path):
+    path = tombstones_path_for(index_path)
+    if not os.path.exists(path):
+        return np.empty(0, dtype=np.int64)
+    return np.sort(pq.read_table(path, columns=["id"]).column("id").to_numpy())
+
+# urls of tombstoned rows, to delete again when rows are added or ids are reassigned
+def read_tombstone_urls(index_path):
+    path = tombstones_path_for(index_path)
+    if not os.path.exists(path):
+        return set()
+    return set(pq.read_table(path, columns=["url"]).column("url").drop_null().to_pylist())
+
+# write the tombstones (the old ones unless keep_old is false, plus new (id, url) rows) to a
+# temporary file for the merge to publish; returns its path and the number of tombstones
+def write_tombstones(index_path, ids, urls, keep_old=True):
+    path = tombstones_path_for(index_path)
+    new = pd.DataFrame({"id": np.asarray(ids, dtype=np.int64), "url": pd.Series(list(urls), dtype=object)})
+    if keep_old and os.path.exists(path):
+        new = pd.concat([pd.read_parquet(path), new])
+    df = new.drop_duplicates("id").sort_values("id").astype({"id": np.int64})
+    df.to_parquet(f"{path}.tmp", index=False)
+    return f"{path}.tmp", len(df)
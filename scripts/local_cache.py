@@ -0,0 +1,216 @@
+import os
+import time
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pipeline_metrics import counter
+
+# node-local caches on the workers' scratch disk (/scratch, see infra/ansible/setup/local-scratch.yaml)
+#   FileStager  copies input and shard files from nfs to <scratch>/<hash of dir>/<name>, so siblings
+#               such as .npy sidecars stay siblings; a staged copy keeps the source's size and mtime
+#               and is reused while they match. the next work unit's file is copied in the background
+#   ImageCache  downloaded image bytes, stored once per content and looked up by url:
+#                 blobs/<ab>/<sha1 of content>   the bytes, the same key dedup.py claims
+#                 urls/<ab>/<sha1 of url>        symlink to the blob
+#                 urls/<ab>/<sha1 of url>.failed marker of a url that could not be fetched, trusted for
+#                                                failed_ttl_hours after the failure and then retried, since
+#                                                most failures (timeouts, 5xx) are transient
+#               so re-embedding with another model or transform needs no network
+# both are bounded in size, evicting least recently used files; tasks sharing a node share them
+# and every file is written to a temporary name first, so readers never see a partial file
+
+# cache metrics, exported by whichever stage uses the caches
+cache_results = counter("laion_local_cache_total", "Lookups in the node-local caches, by cache and result",
+                        ["cache", "result"])
+
+# remove the least recently used files until their total is at most target bytes
+# entries are (last use, path, size); returns the bytes left
+def evict(entries, total, target, keep=()):
+    for _, path, size in sorted(entries):
+        if total <= target:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    return total
+
+class FileStager:
+    def __init__(self, scratch_dir, max_mb=50000, log=print):
+        self.scratch_dir = scratch_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.log = log
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(scratch_dir, exist_ok=True)
+
+    def local_path(self, path):
+        path = os.path.abspath(str(path))
+        digest = hashlib.sha1(os.path.dirname(path).encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.scratch_dir, digest, os.path.basename(path))
+
+    # local copy of a file, staging it unless an up-to-date copy exists; the original path when
+    # staging fails (e.g. scratch is full), so callers still read it over nfs
+    def stage(self, path):
+        with self.lock:
+            future = self.pending.pop(str(path), None)
+        if future is not None:
+            return future.result()
+        return self._stage(path)
+
+    # start staging a file in the background, for the work unit after the current one
+    def prefetch(self, path):
+        with self.lock:
+            if str(path) not in self.pending:
+                self.pending[str(path)] = self.pool.submit(self._stage, path)
+
+    def _stage(self, path):
+        local = self.local_path(path)
+        try:
+            st = os.stat(path)
+            try:
+                lst = os.stat(local)
+                if (lst.st_size, lst.st_mtime) == (st.st_size, st.st_mtime):
+                    # atime records the last use for eviction, mtime stays the source's
+                    os.utime(local, (time.time(), st.st_mtime))
+                    cache_results.labels(cache="stage", result="hit").inc()
+                    return local
+            except FileNotFoundError:
+                pass
+            cache_results.labels(cache="stage", result="miss").inc()
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            self._make_room(st.st_size, keep={local})
+            start = time.perf_counter()
+            tmp = f"{local}.{os.getpid()}.{threading.get_ident()}.tmp"
+            shutil.copy2(path, tmp)
+            os.replace(tmp, local)
+            os.utime(local, (time.time(), st.st_mtime))
+            self.log(f"Staged {path} ({st.st_size / 2**20:.1f} MB) in {time.perf_counter() - start:.1f}s")
+            return local
+        except OSError as e:
+            self.log(f"Could not stage {path}, reading it in place: {e}")
+            return str(path)
+
+    # evict staged files until a new one of size bytes fits
+    def _make_room(self, size, keep=()):
+        entries = []
+        for root, _, files in os.walk(self.scratch_dir):
+            for f in files:
+                if not f.endswith(".tmp"):
+                    st = os.stat(os.path.join(root, f))
+                    entries.append((st.st_atime, os.path.join(root, f), st.st_size))
+        total = sum(s for _, _, s in entries)
+        if total + size > self.max_bytes:
+            evict(entries, total, self.max_bytes - size, keep)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+class ImageCache:
+    def __init__(self, cache_dir, max_mb=100000, refetch_failed=False, failed_ttl_hours=24):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.refetch_failed = refetch_failed
+        self.failed_ttl = failed_ttl_hours * 3600
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "urls"), exist_ok=True)
+        self.disk_bytes = sum(size for _, _, size in self._blobs())
+
+    def _url_path(self, url):
+        h = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "urls", h[:2], h)
+
+    def _blob_path(self, data):
+        h = hashlib.sha1(data).hexdigest()
+        return os.path.join(self.cache_dir, "blobs", h[:2], h)
+
+    # (mtime, path, size) of every blob; reads touch a blob, so mtime is its last use
+    def _blobs(self):
+        entries = []
+        blobs = os.path.join(self.cache_dir, "blobs")
+        for sub in os.listdir(blobs):
+            for e in os.scandir(os.path.join(blobs, sub)):
+                if not e.name.endswith(".tmp"):
+                    st = e.stat()
+                    entries.append((st.st_mtime, e.path, st.st_size))
+        return entries
+
+    # cached bytes of a url, or none
+    def get(self, url):
+        path = self._url_path(url)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            cache_results.labels(cache="image", result="hit").inc()
+            return data
+        except FileNotFoundError:
+            # a link whose blob was evicted
+            if os.path.islink(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        except OSError:
+            pass
+        cache_results.labels(cache="image", result="miss").inc()
+        return None
+
+    # whether an earlier fetch of the url failed less than failed_ttl ago (ignored with refetch_failed)
+    def failed(self, url):
+        if self.refetch_failed:
+            return False
+        try:
+            failed_at = os.stat(f"{self._url_path(url)}.failed").st_mtime
+        except OSError:
+            return False
+        if time.time() - failed_at > self.failed_ttl:
+            cache_results.labels(cache="image", result="failed_expired").inc()
+            return False
+        cache_results.labels(cache="image", result="failed").inc()
+        return True
+
+    def put(self, url, data):
+        try:
+            blob, link = self._blob_path(data), self._url_path(url)
+            tmp = f".{os.getpid()}.{threading.get_ident()}.tmp"
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                with open(blob + tmp, "wb") as f:
+                    f.write(data)
+                os.replace(blob + tmp, blob)
+                with self.lock:
+                    self.disk_bytes += len(data)
+            os.makedirs(os.path.dirname(link), exist_ok=True)
+            os.symlink(os.path.relpath(blob, os.path.dirname(link)), link + tmp)
+            os.replace(link + tmp, link)
+            if os.path.exists(f"{link}.failed"):
+                os.remove(f"{link}.failed")
+        except OSError:
+            return
+        if self.disk_bytes > self.max_bytes:
+            self._evict()
+
+    def put_failed(self, url):
+        path = f"{self._url_path(url)}.failed"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "a").close()
+            # a failed retry restarts the ttl
+            os.utime(path)
+        except OSError:
+            pass
+
+    # evict down to 90% of the limit, so a full cache is not rescanned on every put
+    def _evict(self):
+        with self.lock:
+            if self.disk_bytes <= self.max_bytes:
+                return
+            entries = self._blobs()
+            self.disk_bytes = evict(entries, sum(s for _, _, s in entries), int(self.max_bytes * 0.9))
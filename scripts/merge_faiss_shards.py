@@ -1,9 +1,32 @@
 import os
 import faiss
+import shutil
 import logging
 import argparse
-import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from datetime import datetime
+from faiss.contrib.ondisk import merge_ondisk
+from embedding_store import shard_metadata_schema, conform_metadata
+from metadata_store import MetadataStoreWriter, MetadataStore
+from metadata_filter import FilterIndexWriter, FilterIndex, filters_path_for
+from index_manifest import (load_manifest, write_manifest, manifest_path_for, tombstones_path_for, vectors_path_for,
+                            describe_shard, shard_source, quantizer_sha1, new_shards, read_tombstone_urls, write_tombstones,
+                            segment_path_for, index_parts, metadata_parts)
+from pipeline_metrics import gauge, timed, start_textfile, default_textfile_dir
+
+# merge progress metrics, exported through the node exporter textfile collector
+shards_total = gauge("laion_merge_shards_total", "Index shards to merge")
+shards_merged = gauge("laion_merge_shards_merged", "Index shards merged so far")
+vectors_merged = gauge("laion_merge_vectors", "Vectors in the merged index so far")
+metadata_rows = gauge("laion_merge_metadata_rows", "Metadata rows merged so far")
+
+# update merge progress after each shard
+def report_progress(done, merged):
+    shards_merged.set(done)
+    vectors_merged.set(merged.ntotal)
 
 # setup logging to both file and stdout with timestamped filename
 def setup_logging(log_dir):
@@ -35,90 +58,541 @@ def parse_args():
     # flag to normalize vectors before merging     
     parser.add_argument("--normalize", action="store_true")    
      
+    # path for the compact metadata store used by search (skipped when omitted)
+    parser.add_argument("--output_store", type=str, default=None)
+
+    # store the vectors of merged flat shards with a codec: float16 and int8 scalar quantizers, or
+    # pq with --pq_m bytes per vector (int8 and pq are trained on the first shards' vectors)
+    parser.add_argument("--codec", type=str, default=None, choices=sorted(merge_codecs))
+    parser.add_argument("--pq_m", type=int, default=64)
+    parser.add_argument("--codec_train_samples", type=int, default=100000)
+
+    # also write every merged row's full-precision vector next to the index for search --rerank;
+    # shards holding lossy codes (pq, sq8) need vector files from build_faiss_index.py --rerank_vectors
+    parser.add_argument("--rerank_vectors", action="store_true")
+
+    # merge ivf shards into on-disk inverted lists stored at this path (full merges only)
+    parser.add_argument("--ondisk_ivf", type=str, default=None)
+
+    # add only shards missing from the manifest next to --output_index, as a delta segment of index
+    # and metadata published beside the merged files, instead of rebuilding them (falls back to a
+    # full merge without a manifest; a full merge folds the segments back in)
+    parser.add_argument("--incremental", action="store_true")
+
+    # tombstone every row of these embedding files (e.g. clip_embeddings_003.parquet)
+    parser.add_argument("--delete_sources", type=str, nargs="*", default=None)
+
+    # tombstone every row whose url is listed in this file (one url per line, or a parquet url column)
+    parser.add_argument("--delete_urls", type=str, default=None)
+
     # directory for log files             
     parser.add_argument("--log_dir", type=str, default="/home/almalinux/nfs/logs/merge")  
+
+    # node exporter textfile collector directory for prometheus metrics
+    parser.add_argument("--metrics_dir", type=str, default=default_textfile_dir)
     
     return parser.parse_args()
 
-# merge all .index shards into one faiss index
-def merge_indexes(index_dir, normalize):
-    index_files = sorted([f for f in os.listdir(index_dir) if f.endswith(".index")])
+# list shard files with a given suffix in sorted (id) order
+def list_shards(index_dir, suffix):
+    return sorted([f for f in os.listdir(index_dir) if f.endswith(suffix)])
+
+# ivf-family index (possibly wrapped, e.g. opq) or none
+def extract_ivf(index):
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
+
+# view the vectors stored in a flat shard without copying
+def flat_vectors(index):
+    return faiss.rev_swig_ptr(index.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
+
+# empty index with the trained codec of a flat, scalar or product quantized index, built from
+# the codec's parameters so that none of the index's codes are copied
+def empty_codec_like(index):
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        empty = faiss.IndexScalarQuantizer(index.d, index.sq.qtype, index.metric_type)
+        empty.sq = index.sq
+    elif isinstance(index, faiss.IndexPQ):
+        empty = faiss.IndexPQ(index.d, index.pq.M, index.pq.nbits, index.metric_type)
+        empty.pq = index.pq
+    else:
+        return faiss.IndexFlatIP(index.d)
+    empty.is_trained = True
+    return empty
+
+# empty index of the same kind as a non-ivf shard; scalar and product quantized shards keep
+# their (trained) codec
+def empty_like(index):
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.IndexHNSWFlat(index.d, index.hnsw.nb_neighbors(1), index.metric_type)
+    return empty_codec_like(index)
+
+# faiss factory strings of the --codec choices for merged flat shards
+merge_codecs = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8", "pq": "PQ{pq_m}"}
+
+# empty merged index storing vectors with a codec
+def codec_index(dim, codec, pq_m=64):
+    return faiss.index_factory(dim, merge_codecs[codec].format(pq_m=pq_m), faiss.METRIC_INNER_PRODUCT)
+
+# vectors of a flat (view) or other non-ivf shard (reconstructed), normalized when asked
+def shard_vectors(idx, normalize):
+    # flat shards expose their vectors directly, others are reconstructed
+    if isinstance(idx, faiss.IndexFlat):
+        xb = flat_vectors(idx)
+    else:
+        xb = idx.reconstruct_n(0, idx.ntotal)
+
+    if normalize:
+        faiss.normalize_L2(xb)
+    return xb
+
+# whether a shard's own vectors are full precision: flat, hnsw over flat storage, ivf-flat
+def stores_exact_vectors(idx):
+    if isinstance(idx, faiss.IndexHNSW):
+        return isinstance(faiss.downcast_index(idx.storage), faiss.IndexFlat)
+    return isinstance(idx, (faiss.IndexFlat, faiss.IndexIVFFlat))
+
+# full-precision vectors of a shard for re-ranking: its <shard>.vectors.f32 file from
+# build_faiss_index.py --rerank_vectors when there is one, otherwise the shard's own vectors
+def exact_vectors(index_dir, fname, dim, normalize, idx=None):
+    side = os.path.join(index_dir, fname[:-len(".index")] + ".vectors.f32")
+    if os.path.exists(side):
+        xb = np.fromfile(side, dtype=np.float32).reshape(-1, dim)
+    else:
+        idx = idx if idx is not None else faiss.read_index(os.path.join(index_dir, fname))
+        if not stores_exact_vectors(idx):
+            raise ValueError(f"{fname} holds lossy codes and no vector file, rebuild it with --rerank_vectors")
+        if isinstance(idx, faiss.IndexIVFFlat):
+            idx.make_direct_map()
+        xb = flat_vectors(idx) if isinstance(idx, faiss.IndexFlat) else idx.reconstruct_n(0, idx.ntotal)
+    if normalize:
+        xb = np.array(xb)
+        faiss.normalize_L2(xb)
+    return xb
+
+# append the full-precision vectors of shards to an open vector file, in merge order
+def append_vectors(index_dir, index_files, dim, normalize, vectors):
+    for fname in index_files:
+        vectors.write(np.ascontiguousarray(exact_vectors(index_dir, fname, dim, normalize), dtype=np.float32).tobytes())
+
+# train a codec index on up to samples vectors from the first shards
+def train_codec(index, index_dir, index_files, normalize, samples):
+    parts, n = [], 0
+    for fname in index_files:
+        xb = shard_vectors(faiss.read_index(os.path.join(index_dir, fname)), normalize)
+        parts.append(np.array(xb[:samples - n]))
+        n += len(parts[-1])
+        if n >= samples:
+            break
+    index.train(np.concatenate(parts))
+    logging.info(f"Trained the merged index codec on {n} vectors")
+
+# merge flat (or hnsw) shards one at a time, freeing each shard before loading the next
+# appends to merged when given, e.g. an existing merged index, or else to an empty index of
+# the shards' kind, or of codec (see merge_codecs) when given; the full-precision vectors go to
+# the open vector file vectors when given
+def merge_flat_shards(index_dir, index_files, normalize, dim, merged=None, codec=None, pq_m=64,
+                      train_samples=100000, vectors=None):
+    if merged is None and codec is not None:
+        merged = codec_index(dim, codec, pq_m)
+        if not merged.is_trained:
+            train_codec(merged, index_dir, index_files, normalize, train_samples)
+    for i, fname in enumerate(index_files):
+        idx = faiss.read_index(os.path.join(index_dir, fname))
+        if idx.d != dim:
+            logging.error(f"Dimension mismatch in {fname}")
+            raise ValueError(f"Index dimension mismatch in {fname}")
+        if merged is None:
+            merged = empty_like(idx)
+
+        xb = shard_vectors(idx, normalize)
+        if vectors is not None:
+            exact = xb if isinstance(idx, faiss.IndexFlat) else exact_vectors(index_dir, fname, dim, normalize, idx)
+            vectors.write(np.ascontiguousarray(exact, dtype=np.float32).tobytes())
+
+        merged.add(xb)
+        del xb, idx
+        report_progress(i + 1, merged)
+        logging.info(f"Merged shard {i+1}/{len(index_files)} ({merged.ntotal} vectors)")
+
+    return merged
+
+# merge ivf shards that share a trained quantizer by moving their inverted lists, numbering the
+# vectors from id_start on (past the published ids, for an incremental merge's delta index) and
+# refusing shards whose quantizer does not hash to quantizer
+def merge_ivf_shards(index_dir, index_files, dim, quantizer=None, id_start=0):
+    merged = faiss.read_index(os.path.join(index_dir, index_files[0]))
+    first = 0
+    if id_start:
+        # a delta starts from the first shard emptied, and takes that shard's lists renumbered
+        merged.reset()
+    else:
+        first = 1
+        report_progress(1, merged)
+        logging.info(f"Merged shard 1/{len(index_files)} ({merged.ntotal} vectors)")
+    merged_ivf = extract_ivf(merged)
+
+    for i, fname in enumerate(index_files[first:], start=first + 1):
+        idx = faiss.read_index(os.path.join(index_dir, fname))
+        if idx.d != dim:
+            logging.error(f"Dimension mismatch in {fname}")
+            raise ValueError(f"Index dimension mismatch in {fname}")
+        if quantizer is not None and quantizer_sha1(idx) != quantizer:
+            raise ValueError(f"{fname} was built on a different template than the merged index, run a full merge")
+
+        # shift ids so they stay sequential across shards, matching the metadata order
+        ivf = extract_ivf(idx)
+        merged_ivf.merge_from(ivf, id_start + merged_ivf.ntotal)
+        merged.ntotal = merged_ivf.ntotal
+        del ivf, idx
+        report_progress(i, merged)
+        logging.info(f"Merged shard {i}/{len(index_files)} ({merged.ntotal} vectors)")
+
+    return merged
+
+# merge ivf shards into on-disk inverted lists, memory-mapping each shard instead of loading it
+def merge_ivf_shards_ondisk(index_dir, index_files, ivfdata_path):
+    # the first shard with its lists cleared provides the trained, empty quantizer
+    merged = faiss.read_index(os.path.join(index_dir, index_files[0]))
+    merged.reset()
+    paths = [os.path.join(index_dir, f) for f in index_files]
+    merge_ondisk(merged, paths, ivfdata_path, shift_ids=True)
+    report_progress(len(index_files), merged)
+    logging.info(f"Merged {len(index_files)} shards into on-disk lists at {ivfdata_path} ({merged.ntotal} vectors)")
+    return merged
+
+# merge the .index shards (all of them by default) into one faiss index, one shard in memory at a time
+def merge_indexes(index_dir, normalize, ivfdata_path=None, index_files=None, codec=None, pq_m=64,
+                  train_samples=100000, vectors=None):
+    if index_files is None:
+        index_files = list_shards(index_dir, ".index")
     if not index_files:
         logging.error("No .index files found to merge")
         raise RuntimeError("No .index files found")
 
     logging.info(f"Found {len(index_files)} index files")
+    shards_total.set(len(index_files))
 
-    # read the first index as base and get dimensionality
+    # read the first index to get dimensionality and the index type
     base_index = faiss.read_index(os.path.join(index_dir, index_files[0]))
     dim = base_index.d
-    all_indexes = [base_index]
+    is_ivf = extract_ivf(base_index) is not None
+    del base_index
 
-    # load remaining indexes and check dimension consistency
-    for fname in index_files[1:]:
-        path = os.path.join(index_dir, fname)
-        idx = faiss.read_index(path)
-        
-        if idx.d != dim:
-            logging.error(f"Dimension mismatch in {fname}")
-            raise ValueError(f"Index dimension mismatch in {fname}")
-        
-        all_indexes.append(idx)
-
-    # initialize a new flat inner product index for merging
-    merged = faiss.IndexFlatIP(dim)
-
-    # add all vectors from shards to merged index
-    for i, idx in enumerate(all_indexes):
-        # get back raw vectors
-        xb = idx.reconstruct_n(0, idx.ntotal)    
-            
-        if normalize:
-            faiss.normalize_L2(xb)
-            
-        merged.add(xb)
-        logging.info(f"Merged shard {i+1}/{len(all_indexes)}")
+    if not is_ivf:
+        return merge_flat_shards(index_dir, index_files, normalize, dim, codec=codec, pq_m=pq_m,
+                                 train_samples=train_samples, vectors=vectors)
 
-    return merged
+    # ivf codes are already quantized, so vectors cannot be renormalized or re-encoded here
+    if normalize:
+        logging.warning("Ignoring --normalize for IVF shards (normalize at build time)")
+    if codec:
+        logging.warning("Ignoring --codec for IVF shards (pick the codec with the index type)")
+    if vectors is not None:
+        append_vectors(index_dir, index_files, dim, normalize, vectors)
+    if ivfdata_path:
+        return merge_ivf_shards_ondisk(index_dir, index_files, ivfdata_path)
+    return merge_ivf_shards(index_dir, index_files, dim)
 
-# merge all metadata parquet files into a single dataframe
-def merge_metadata(index_dir):
-    meta_files = sorted([f for f in os.listdir(index_dir) if f.endswith(".meta.parquet")])
+# stream metadata parquet files (all shards by default) into a single output file, one row group
+# at a time, and optionally into a memory-mapped metadata store keyed by faiss id, whose column
+# index for filtered search gets a segment with the shard rows
+#   id_start       faiss id of the first row (the published ntotal when appending to the store)
+#   deleted_urls   arrow array of urls; returns the (faiss id, url) of every shard row that has one
+# returns (rows, hits, staged): the store's new row count and the filter segment listing are only
+# staged, as (tmp, path) renames for the caller to publish once the rows check out; a shard that cannot be read fails the merge
+# and leaves the store as it was
+def merge_metadata(index_dir, output_path, store_path=None, meta_files=None, id_start=0, append=False,
+                   deleted_urls=None):
+    if meta_files is None:
+        meta_files = list_shards(index_dir, ".meta.parquet")
     if not meta_files:
         logging.error("No .meta.parquet files found")
         raise RuntimeError("No metadata files found")
 
     logging.info(f"found {len(meta_files)} metadata files")
-    dfs = []
+    writer = pq.ParquetWriter(output_path, shard_metadata_schema())
+    store = MetadataStoreWriter(store_path, append=append) if store_path else None
+    filters = FilterIndexWriter(filters_path_for(store_path)) if store_path else None
+    rows = 0
+    hits = []
+
+    # copy each file's row groups into the merged file without holding it all in memory
+    try:
+        for f in meta_files:
+            pf = pq.ParquetFile(os.path.join(index_dir, f))
+            for i in range(pf.metadata.num_row_groups):
+                table = conform_metadata(pf.read_row_group(i))
+                writer.write_table(table)
+                if store is not None:
+                    store.write_table(table)
+                    filters.write_table(table, id_start + rows)
+                if deleted_urls is not None and len(deleted_urls):
+                    urls = table.column("url")
+                    for r in np.flatnonzero(pc.is_in(urls, value_set=deleted_urls).to_numpy(zero_copy_only=False)):
+                        hits.append((id_start + rows + int(r), urls[int(r)].as_py()))
+                rows += table.num_rows
+            metadata_rows.set(rows)
+            logging.info(f"Loaded metadata: {f} with {pf.metadata.num_rows} rows")
+        writer.close()
+        staged = [r for r in (store.finish(), filters.finish()) if r is not None] if store is not None else []
+    except BaseException:
+        writer.close()
+        if store is not None:
+            store.abort()
+            filters.abort()
+        raise
 
-    # read and collect all metadata files
-    for f in meta_files:
-        try:
-            df = pd.read_parquet(os.path.join(index_dir, f))
-            dfs.append(df)
-            logging.info(f"Loaded metadata: {f} with {len(df)} rows")
-        except Exception as e:
-            logging.warning(f"Failed to read {f}: {e}")
+    return rows, hits, staged
 
-    if not dfs:
-        raise RuntimeError("No metadata loaded successfully")
+# (faiss id, url) of every published row whose url is in the arrow array urls
+# with the metadata store at store_path this is a lookup in its column index's url hashes, whose
+# candidates' urls are then read from the store, so it costs about the same at any index size;
+# without a store, or with column index segments written before url hashes, every row of the merged
+# metadata (and the manifest's metadata segments) is scanned instead
+def find_urls(metadata_path, urls, manifest=None, store_path=None):
+    if store_path and os.path.isdir(filters_path_for(store_path)):
+        ids = FilterIndex(filters_path_for(store_path)).url_ids(urls)
+        if ids is not None:
+            if manifest is not None:
+                ids = ids[:np.searchsorted(ids, manifest["ntotal"])]
+            wanted = set(urls.to_pylist())
+            return [(int(i), u) for i, u in zip(ids, MetadataStore(store_path).column("url", ids)) if u in wanted]
+        logging.info("The column index predates url hashes, scanning the merged metadata for the urls")
+    hits = []
+    for path, start in metadata_parts(metadata_path, manifest):
+        for batch in pq.ParquetFile(path).iter_batches(columns=["url"]):
+            col = batch.column(0)
+            for r in np.flatnonzero(pc.is_in(col, value_set=urls).to_numpy(zero_copy_only=False)):
+                hits.append((start + int(r), col[int(r)].as_py()))
+            start += batch.num_rows
+    return hits
 
-    return pd.concat(dfs, ignore_index=True)
+# urls to delete, from a text file with one url per line or a parquet file with a url column
+def read_url_list(path):
+    if path.endswith(".parquet"):
+        return set(pq.read_table(path, columns=["url"]).column("url").drop_null().to_pylist())
+    with open(path) as f:
+        return {line.strip() for line in f if line.strip()}
+
+# rename the new files into place: metadata first, so no reader sees index ids without metadata rows,
+# then the tombstones and the index, and the manifest last as the record of the published version.
+# processes that already loaded the old files keep using them until they reload
+def publish(renames):
+    for tmp, path in renames:
+        if tmp is not None:
+            os.replace(tmp, path)
+
+# swap a freshly built directory into place, deleting the old one once nothing points to it
+def replace_dir(tmp, path):
+    old = f"{path}.old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+# manifest entries for shards merged in order after the ids taken so far
+def describe_shards(index_dir, index_files, id_start):
+    entries = []
+    for f in index_files:
+        entries.append(describe_shard(index_dir, f, id_start))
+        id_start = entries[-1]["id_stop"]
+    return entries
 
 # main orchestration logic
 def main():
     args = parse_args()
     setup_logging(args.log_dir)
+    metrics = start_textfile("merge", None, args.metrics_dir)
+    ok = False
+    try:
+        merge(args)
+        ok = True
+    finally:
+        if metrics is not None:
+            metrics.stop(ok)
+
+# merge the index shards, then their metadata; incrementally when asked and a manifest exists
+def merge(args):
+    manifest = load_manifest(args.output_index)
+    if args.incremental and manifest is not None:
+        return merge_incremental(args, manifest)
+    if args.incremental:
+        logging.info(f"No manifest at {manifest_path_for(args.output_index)}, running a full merge")
+    merge_full(args, manifest)
+
+# rebuild the merged index from every shard, leaving out sources deleted before and tombstoning
+# urls deleted before in the new id space
+def merge_full(args, previous=None):
+    deleted_sources = set(previous.get("deleted_sources", [])) if previous else set()
+    deleted_sources |= set(args.delete_sources or [])
+    deleted_urls = read_tombstone_urls(args.output_index) if previous else set()
+    if args.delete_urls:
+        deleted_urls |= read_url_list(args.delete_urls)
+    index_files = [f for f in list_shards(args.index_dir, ".index")
+                   if shard_source(os.path.join(args.index_dir, f[:-len(".index")] + ".meta.parquet"))
+                   not in deleted_sources]
 
     logging.info("Starting FAISS index merge process")
-    merged_index = merge_indexes(args.index_dir, args.normalize)
-    faiss.write_index(merged_index, args.output_index)
-    logging.info(f"Saved merged index to {args.output_index}")
+    vectors_tmp = f"{vectors_path_for(args.output_index)}.tmp" if args.rerank_vectors else None
+    with timed("merge_index"), open(vectors_tmp or os.devnull, "wb") as vectors:
+        merged_index = merge_indexes(args.index_dir, args.normalize, args.ondisk_ivf, index_files, args.codec,
+                                     args.pq_m, args.codec_train_samples, vectors if vectors_tmp else None)
+    with timed("write_index"):
+        faiss.write_index(merged_index, f"{args.output_index}.tmp")
+    ntotal, dim, quantizer = merged_index.ntotal, merged_index.d, quantizer_sha1(merged_index)
+    if vectors_tmp and os.path.getsize(vectors_tmp) != ntotal * dim * 4:
+        raise RuntimeError(f"Merged {ntotal} vectors but {os.path.getsize(vectors_tmp) // (dim * 4)} full-precision rows")
+    del merged_index
 
     logging.info("Starting metadata merge")
-    merged_meta = merge_metadata(args.index_dir)
-    merged_meta.to_parquet(args.output_metadata, index=False)
-    logging.info(f"Saved merged metadata to {args.output_metadata}")
+    meta_files = [f[:-len(".index")] + ".meta.parquet" for f in index_files]
+    store_tmp = f"{args.output_store}.tmp" if args.output_store else None
+    if store_tmp:
+        shutil.rmtree(store_tmp, ignore_errors=True)
+    with timed("merge_metadata"):
+        rows, hits, staged = merge_metadata(args.index_dir, f"{args.output_metadata}.tmp", store_tmp, meta_files,
+                                            deleted_urls=pa.array(sorted(deleted_urls), pa.string()))
+    if rows != ntotal:
+        raise RuntimeError(f"Merged {ntotal} vectors but {rows} metadata rows")
+    tombstones, deleted = write_tombstones(args.output_index, [h[0] for h in hits], [h[1] for h in hits],
+                                           keep_old=False)
+
+    shards = describe_shards(args.index_dir, index_files, 0)
+    manifest = {
+        "version": previous["version"] + 1 if previous else 1, "ntotal": ntotal, "dim": dim,
+        "quantizer": quantizer, "shards": shards, "deleted": deleted,
+        "sources": sorted({s["source"] for s in shards if s["source"]}), "deleted_sources": sorted(deleted_sources),
+        "vectors": bool(args.rerank_vectors), "segments": [],
+    }
+    publish([(f"{args.output_metadata}.tmp", args.output_metadata)])
+    if vectors_tmp:
+        publish([(vectors_tmp, vectors_path_for(args.output_index))])
+    if store_tmp:
+        publish(staged)
+        replace_dir(store_tmp, args.output_store)
+    publish([(tombstones, tombstones_path_for(args.output_index)),
+             (f"{args.output_index}.tmp", args.output_index),
+             (write_manifest(args.output_index, manifest), manifest_path_for(args.output_index))])
+    logging.info(f"Saved merged index to {args.output_index}")
+    logging.info(f"Saved merged metadata ({rows} rows, {deleted} deleted) to {args.output_metadata}")
+    if args.output_store:
+        logging.info(f"Saved metadata store to {args.output_store}")
+
+    # the rebuilt index holds the rows of every segment, so their files go once nothing lists them
+    if previous:
+        for path in index_parts(args.output_index, previous) + [p for p, _ in metadata_parts(args.output_metadata, previous)[1:]]:
+            if os.path.exists(path):
+                os.remove(path)
+        logging.info(f"Removed {len(previous.get('segments', []))} incremental segments folded into the rebuild")
+
+# add the shards missing from the manifest as a new segment, and add tombstones, without reading or
+# rewriting what is published, so the work grows with the new data only:
+#   ivf          the new shards' lists go into a delta index numbered from the published ntotal on,
+#                which searches stack onto the merged index's lists (search_faiss_index.load_index)
+#   flat codes   the new vectors are encoded with the merged index's codec (whatever --codec says)
+#                into a delta index, which searches append to the merged codes as they load
+#   hnsw         the exception: the graph is one structure, so the merged index is read, extended
+#                and rewritten
+# the new metadata rows go to a parquet segment of their own; the store, its column index and the
+# vector file are append-only and grow in place. the manifest lists the segments, in id order
+def merge_incremental(args, manifest):
+    if args.ondisk_ivf:
+        logging.warning("Ignoring --ondisk_ivf for an incremental merge (the delta index keeps its lists in memory)")
+    if args.rerank_vectors and not manifest.get("vectors"):
+        raise ValueError("The merged index has no vector file to append to, run a full merge with --rerank_vectors")
+    delete_sources = set(args.delete_sources or []) - set(manifest.get("deleted_sources", []))
+    new_urls = read_url_list(args.delete_urls) if args.delete_urls else set()
+    new_files = [f for f in new_shards(args.index_dir, list_shards(args.index_dir, ".index"), manifest)
+                 if shard_source(os.path.join(args.index_dir, f[:-len(".index")] + ".meta.parquet"))
+                 not in delete_sources]
+    if not new_files and not delete_sources and not new_urls:
+        logging.info(f"Merged index is up to date (version {manifest['version']}, {manifest['ntotal']} vectors)")
+        return
+    logging.info(f"Incremental merge onto version {manifest['version']}: {len(new_files)} new shards, "
+                 f"{len(delete_sources)} sources and {len(new_urls)} urls to delete")
+    shards_total.set(len(new_files))
+
+    # rows already merged: by source from the manifest id ranges, by url through the store's column index
+    hits = [(i, None) for s in manifest["shards"] if s["source"] in delete_sources
+            for i in range(s["id_start"], s["id_stop"])]
+    if new_urls:
+        with timed("find_urls"):
+            hits += find_urls(args.output_metadata, pa.array(sorted(new_urls), pa.string()), manifest,
+                              args.output_store)
+
+    version, dim, id_start = manifest["version"] + 1, manifest["dim"], manifest["ntotal"]
+    ntotal, renames, shards, staged = id_start, [], [], []
+    segments = list(manifest.get("segments", []))
+    if new_files:
+        index_path = segment_path_for(args.output_index, version)
+        with timed("merge_index"):
+            if manifest["quantizer"] is not None:
+                delta = merge_ivf_shards(args.index_dir, new_files, dim, manifest["quantizer"], id_start)
+                added = delta.ntotal
+            else:
+                # codes are memory-mapped, only the codec (or the index kind) is read
+                base = faiss.read_index(args.output_index, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+                if base.d != dim:
+                    raise ValueError(f"{args.output_index} does not match its manifest")
+                if isinstance(base, faiss.IndexHNSW):
+                    del base
+                    index_path = args.output_index
+                    delta = merge_flat_shards(args.index_dir, new_files, args.normalize, dim,
+                                              faiss.read_index(args.output_index))
+                    added = delta.ntotal - id_start
+                else:
+                    empty = empty_codec_like(base)
+                    del base
+                    delta = merge_flat_shards(args.index_dir, new_files, args.normalize, dim, empty)
+                    added = delta.ntotal
+        ntotal = id_start + added
+        if manifest.get("vectors"):
+            # appended in place past the published rows, dropping any left by a merge that never published
+            with timed("append_vectors"), open(vectors_path_for(args.output_index), "r+b") as vectors:
+                vectors.truncate(id_start * dim * 4)
+                vectors.seek(0, os.SEEK_END)
+                append_vectors(args.index_dir, new_files, dim, args.normalize, vectors)
+                if vectors.tell() != ntotal * dim * 4:
+                    raise RuntimeError(f"Merged {ntotal} vectors but {vectors.tell() // (dim * 4)} full-precision rows")
+        with timed("write_index"):
+            faiss.write_index(delta, f"{index_path}.tmp")
+        del delta
+
+        # new rows whose url was deleted before are tombstoned as they arrive
+        deleted_urls = pa.array(sorted(read_tombstone_urls(args.output_index) | new_urls), pa.string())
+        # the store is appended in place: its readers see the new rows once store.json is published
+        if args.output_store and not os.path.isdir(args.output_store):
+            raise RuntimeError(f"No metadata store at {args.output_store} to append to, run a full merge")
+        metadata_path = segment_path_for(args.output_metadata, version)
+        with timed("merge_metadata"):
+            rows, new_hits, staged = merge_metadata(args.index_dir, f"{metadata_path}.tmp", args.output_store,
+                                                    [f[:-len(".index")] + ".meta.parquet" for f in new_files],
+                                                    id_start, append=True, deleted_urls=deleted_urls)
+        if rows != added:
+            raise RuntimeError(f"Merged {added} vectors but {rows} metadata rows")
+        hits += new_hits
+        shards = describe_shards(args.index_dir, new_files, id_start)
+        segments.append({"version": version, "metadata": os.path.basename(metadata_path),
+                         "index": os.path.basename(index_path) if index_path != args.output_index else None,
+                         "id_start": id_start, "id_stop": ntotal})
+        renames = [(f"{metadata_path}.tmp", metadata_path), (f"{index_path}.tmp", index_path)]
+
+    tombstones, deleted = write_tombstones(args.output_index, [h[0] for h in hits], [h[1] for h in hits])
+    manifest = dict(manifest, version=version, ntotal=ntotal, deleted=deleted,
+                    shards=manifest["shards"] + shards, segments=segments)
+    manifest["sources"] = sorted((set(manifest["sources"]) | {s["source"] for s in shards if s["source"]})
+                                 - delete_sources)
+    manifest["deleted_sources"] = sorted(set(manifest.get("deleted_sources", [])) | delete_sources)
+
+    # nothing lists the segment files before the manifest does, so they publish with the metadata
+    publish(staged + renames + [(tombstones, tombstones_path_for(args.output_index)),
+                                (write_manifest(args.output_index, manifest), manifest_path_for(args.output_index))])
+    logging.info(f"Published version {manifest['version']}: {ntotal} vectors, {len(shards)} shards added, "
+                 f"{deleted} deleted, {len(segments)} segments since the last full merge")
 
 # run main 
 if __name__ == "__main__":
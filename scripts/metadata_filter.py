@@ -0,0 +1,345 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# column index for filtered search, built by merge_faiss_shards.py into <store>/filters/
+# every merge adds one segment covering the faiss ids it wrote (a full merge writes one, an
+# incremental merge appends one), listed in segments.json:
+#   seg_<id_start>/vocab.parquet     caption tokens in sorted order
+#   seg_<id_start>/offsets.i64       start of each token's postings, tokens + 1 entries
+#   seg_<id_start>/postings.i64      sorted faiss ids of the rows whose caption has the token
+#   seg_<id_start>/sample_id.values  sample ids in sorted order, for range predicates
+#   seg_<id_start>/sample_id.ids     the faiss id of each sorted sample id
+#   seg_<id_start>/url.values        64-bit hashes of the urls in sorted order, for deletes by url
+#   seg_<id_start>/url.ids           the faiss id of each sorted url hash
+#
+# filter expressions, ANDed together:
+#   text:<words>            caption contains every word (case-insensitive, whole words)
+#   any:<w1>,<w2>           caption contains at least one of the words
+#   source:<f1>,<f2>        rows from these embedding files, by the manifest's id ranges
+#   id:<start>-<stop>       faiss ids in [start, stop)
+#   sample_id:<lo>-<hi>     sample ids in [lo, hi]
+
+# lowercase word tokens of an arrow string array, as (large_string tokens, row of each token)
+def caption_tokens(texts):
+    texts = pc.cast(pc.fill_null(texts, ""), pa.large_string())
+    words = pc.split_pattern_regex(pc.utf8_lower(texts), r"\W+")
+    rows = pc.list_parent_indices(words).to_numpy()
+    tokens = pc.list_flatten(words)
+    keep = pc.greater(pc.utf8_length(tokens), 0)
+    return tokens.filter(keep), rows[keep.to_numpy(zero_copy_only=False)]
+
+def query_tokens(text):
+    tokens, _ = caption_tokens(pa.array([text], pa.string()))
+    return sorted(set(tokens.to_pylist()))
+
+# 64-bit hashes of an arrow string array of urls, as stored in url.values
+def hash_urls(urls):
+    return pd.util.hash_pandas_object(urls.to_pandas(), index=False).to_numpy().view(np.int64)
+
+# write values in sorted order with the faiss id of each to seg/<name>.values and seg/<name>.ids
+def write_sorted(seg, name, values, ids):
+    order = np.argsort(values, kind="stable")
+    values[order].astype(np.int64).tofile(os.path.join(seg, f"{name}.values"))
+    ids[order].astype(np.int64).tofile(os.path.join(seg, f"{name}.ids"))
+
+# sort (token, id) pairs and sample ids of buffered rows and write them to seg in the segment layout
+def write_segment(seg, tokens, token_ids, sample_ids, url_hashes, ids):
+    os.makedirs(seg, exist_ok=True)
+
+    # sort (token, id) pairs by token rank then id, dropping words repeated within a caption
+    enc = pa.chunked_array(tokens, pa.large_string()).combine_chunks().dictionary_encode()
+    order = pc.sort_indices(enc.dictionary).to_numpy()
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    token_rank = rank[enc.indices.to_numpy()] if len(enc) else np.empty(0, dtype=np.int64)
+    ids_of_tokens = np.concatenate(token_ids) if token_ids else np.empty(0, dtype=np.int64)
+    sort = np.lexsort((ids_of_tokens, token_rank))
+    token_rank, ids_of_tokens = token_rank[sort], ids_of_tokens[sort]
+    keep = np.ones(len(ids_of_tokens), dtype=bool)
+    keep[1:] = (np.diff(token_rank) != 0) | (np.diff(ids_of_tokens) != 0)
+    token_rank, ids_of_tokens = token_rank[keep], ids_of_tokens[keep]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(token_rank, minlength=len(order)))]).astype(np.int64)
+
+    pq.write_table(pa.table({"token": enc.dictionary.take(pa.array(order))}), os.path.join(seg, "vocab.parquet"))
+    offsets.tofile(os.path.join(seg, "offsets.i64"))
+    ids_of_tokens.astype(np.int64).tofile(os.path.join(seg, "postings.i64"))
+
+    row_ids = np.concatenate(ids)
+    write_sorted(seg, "sample_id", np.concatenate(sample_ids), row_ids)
+    write_sorted(seg, "url", np.concatenate(url_hashes), row_ids)
+
+# k-way merge of runs (segments over consecutive id ranges, in id order) into one segment at seg
+# a token's postings are its postings in each run one after the other, which keeps them sorted; they,
+# the sample ids and the url hashes are merged a block of about block_rows entries at a time, so
+# only the merged vocabulary is held whole
+def merge_segments(runs, seg, block_rows=1 << 22):
+    os.makedirs(seg, exist_ok=True)
+    runs = [FilterSegment(r) for r in runs]
+    vocab = pc.unique(pa.concat_arrays([r.vocab for r in runs]))
+    vocab = vocab.take(pc.sort_indices(vocab))
+    pq.write_table(pa.table({"token": vocab}), os.path.join(seg, "vocab.parquet"))
+
+    # merged position of each run token, and the merged offsets from every run's posting counts
+    positions = [pc.index_in(r.vocab, value_set=vocab).to_numpy().astype(np.int64) for r in runs]
+    counts = np.zeros(len(vocab), dtype=np.int64)
+    for r, pos in zip(runs, positions):
+        counts += np.bincount(pos, weights=np.diff(r.offsets), minlength=len(vocab)).astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    offsets.tofile(os.path.join(seg, "offsets.i64"))
+
+    # postings of merged tokens [t0, t1) at a time: gathered run by run, then stably sorted by token
+    bounds = np.unique(np.concatenate([
+        np.searchsorted(offsets, np.arange(0, offsets[-1], block_rows), side="right") - 1, [len(vocab)]]))
+    with open(os.path.join(seg, "postings.i64"), "wb") as f:
+        for t0, t1 in zip(bounds[:-1], bounds[1:]):
+            tokens, ids = [], []
+            for r, pos in zip(runs, positions):
+                i0, i1 = np.searchsorted(pos, [t0, t1])
+                lengths = np.diff(r.offsets[i0:i1 + 1])
+                tokens.append(np.repeat(pos[i0:i1], lengths))
+                ids.append(np.asarray(r.postings[r.offsets[i0]:r.offsets[i1]]))
+            order = np.argsort(np.concatenate(tokens), kind="stable")
+            f.write(np.concatenate(ids)[order].astype(np.int64).tobytes())
+
+    merge_sorted(seg, "sample_id", [(r.sample_values, r.sample_ids) for r in runs], block_rows)
+    merge_sorted(seg, "url", [(r.url_values, r.url_ids) for r in runs], block_rows)
+
+# merge the sorted (values, ids) columns of runs into seg/<name>.values and seg/<name>.ids; each step
+# takes every value up to the smallest of the runs' next block_rows-th values
+def merge_sorted(seg, name, columns, block_rows):
+    cursors = [0] * len(columns)
+    with open(os.path.join(seg, f"{name}.values"), "wb") as fv, open(os.path.join(seg, f"{name}.ids"), "wb") as fi:
+        while True:
+            ahead = [v[min(c + block_rows, len(v)) - 1] for (v, _), c in zip(columns, cursors) if c < len(v)]
+            if not ahead:
+                break
+            boundary = min(ahead)
+            values, ids = [], []
+            for k, (v, i) in enumerate(columns):
+                stop = np.searchsorted(v, boundary, side="right")
+                values.append(np.asarray(v[cursors[k]:stop]))
+                ids.append(np.asarray(i[cursors[k]:stop]))
+                cursors[k] = max(cursors[k], stop)
+            order = np.argsort(np.concatenate(values), kind="stable")
+            fv.write(np.concatenate(values)[order].astype(np.int64).tobytes())
+            fi.write(np.concatenate(ids)[order].astype(np.int64).tobytes())
+
+# collects the rows of one merge and writes them as a new segment on finish
+# rows are buffered up to run_rows, then sorted and spilled as a run (a segment of their own) under
+# runs_<id_start>/; finish() k-way merges the runs (merge_segments) so memory stays bounded by one run
+# finish() stages the listing with the new segment as segments.json.tmp and returns the (tmp, path)
+# rename, which the merge publishes with the rest of its outputs; close() publishes it at once
+class FilterIndexWriter:
+    def __init__(self, path, run_rows=1 << 20):
+        self.path = path
+        self.run_rows = run_rows
+        self.id_start = None
+        self.id_stop = None
+        self.runs = []
+        self._reset()
+
+    def _reset(self):
+        self.tokens, self.token_ids, self.sample_ids, self.url_hashes, self.ids = [], [], [], [], []
+        self.buffered = 0
+
+    # directory holding this merge's runs until close()
+    def _runs_dir(self):
+        return os.path.join(self.path, f"runs_{self.id_start:012d}")
+
+    # add an arrow table of metadata rows whose faiss ids start at id_start
+    def write_table(self, table, id_start):
+        if self.id_start is None:
+            self.id_start = id_start
+            shutil.rmtree(self._runs_dir(), ignore_errors=True)
+        tokens, rows = caption_tokens(table.column("text"))
+        self.tokens.append(tokens)
+        self.token_ids.append(rows + id_start)
+        self.sample_ids.append(pc.fill_null(table.column("sample_id"), -1).to_numpy())
+        self.url_hashes.append(hash_urls(table.column("url")))
+        self.ids.append(np.arange(id_start, id_start + table.num_rows, dtype=np.int64))
+        self.id_stop = id_start + table.num_rows
+        self.buffered += table.num_rows
+        if self.buffered >= self.run_rows:
+            self._spill()
+
+    # sort the buffered rows into the next run
+    def _spill(self):
+        if not self.buffered:
+            return
+        run = os.path.join(self._runs_dir(), f"run_{len(self.runs):06d}")
+        write_segment(run, self.tokens, self.token_ids, self.sample_ids, self.url_hashes, self.ids)
+        self.runs.append(run)
+        self._reset()
+
+    # drop the runs of a merge that failed; the listing never saw them
+    def abort(self):
+        if self.id_start is not None:
+            shutil.rmtree(self._runs_dir(), ignore_errors=True)
+
+    def finish(self):
+        if self.id_start is None:
+            return None
+        seg = os.path.join(self.path, f"seg_{self.id_start:012d}")
+        shutil.rmtree(seg, ignore_errors=True)
+        if not self.runs:
+            write_segment(seg, self.tokens, self.token_ids, self.sample_ids, self.url_hashes, self.ids)
+        else:
+            self._spill()
+            if len(self.runs) == 1:
+                os.replace(self.runs[0], seg)
+            else:
+                merge_segments(self.runs, seg)
+        shutil.rmtree(self._runs_dir(), ignore_errors=True)
+
+        # list the segment; searches opened before keep their segment list until they reload
+        listing = os.path.join(self.path, "segments.json")
+        segments = []
+        if os.path.exists(listing):
+            with open(listing) as f:
+                segments = json.load(f)["segments"]
+        segments = [s for s in segments if s["id_start"] < self.id_start]
+        segments.append({"dir": os.path.basename(seg), "id_start": self.id_start, "id_stop": self.id_stop})
+        with open(f"{listing}.tmp", "w") as f:
+            json.dump({"segments": segments}, f)
+        return f"{listing}.tmp", listing
+
+    def close(self):
+        staged = self.finish()
+        if staged is not None:
+            os.replace(*staged)
+
+# memory-mapped segment files; url_values is none for segments written before url hashes were added
+class FilterSegment:
+    def __init__(self, path):
+        self.vocab = pq.read_table(os.path.join(path, "vocab.parquet")).column("token").combine_chunks()
+        self.offsets = self._map(path, "offsets.i64")
+        self.postings = self._map(path, "postings.i64")
+        self.sample_values = self._map(path, "sample_id.values")
+        self.sample_ids = self._map(path, "sample_id.ids")
+        self.url_values, self.url_ids = None, None
+        if os.path.exists(os.path.join(path, "url.values")):
+            self.url_values = self._map(path, "url.values")
+            self.url_ids = self._map(path, "url.ids")
+
+    @staticmethod
+    def _map(path, name):
+        path = os.path.join(path, name)
+        if os.path.getsize(path) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.memmap(path, dtype=np.int64, mode="r")
+
+    # binary search of the sorted vocabulary
+    def find(self, token):
+        lo, hi = 0, len(self.vocab)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.vocab[mid].as_py() < token:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self.vocab) and self.vocab[lo].as_py() == token else None
+
+    def token_ids(self, token):
+        i = self.find(token)
+        if i is None:
+            return np.empty(0, dtype=np.int64)
+        return np.asarray(self.postings[self.offsets[i]:self.offsets[i + 1]])
+
+    def sample_id_range(self, lo, hi):
+        a = np.searchsorted(self.sample_values, lo, side="left")
+        b = np.searchsorted(self.sample_values, hi, side="right")
+        return np.sort(np.asarray(self.sample_ids[a:b]))
+
+    # faiss ids of the rows whose url hash is one of hashes
+    def url_hash_ids(self, hashes):
+        a = np.searchsorted(self.url_values, hashes, side="left")
+        b = np.searchsorted(self.url_values, hashes, side="right")
+        return np.concatenate([np.asarray(self.url_ids[i:j]) for i, j in zip(a, b)] or [np.empty(0, dtype=np.int64)])
+
+# parse "field:value" filter expressions into (field, value) pairs
+def parse_filters(exprs):
+    filters = []
+    for expr in exprs or []:
+        field, sep, value = expr.partition(":")
+        field = field.strip().lower()
+        if not sep or field not in ("text", "any", "source", "id", "sample_id"):
+            raise ValueError(f"Invalid filter {expr!r}, expected text:, any:, source:, id: or sample_id:")
+        if field in ("id", "sample_id"):
+            lo, _, hi = value.partition("-")
+            value = (int(lo), int(hi))
+        elif field in ("any", "source"):
+            value = [v.strip() for v in value.split(",") if v.strip()]
+        filters.append((field, value))
+    return filters
+
+# evaluates filters against every segment of a store's column index; manifest gives the id ranges
+# of source files and deleted (sorted tombstoned ids) are never selected
+class FilterIndex:
+    def __init__(self, path, manifest=None, deleted=None):
+        with open(os.path.join(path, "segments.json")) as f:
+            self.segments = [FilterSegment(os.path.join(path, s["dir"])) for s in json.load(f)["segments"]]
+        self.manifest = manifest
+        self.deleted = deleted if deleted is not None else np.empty(0, dtype=np.int64)
+
+    # sorted faiss ids whose caption has the token, across segments (which are in id order)
+    def token_ids(self, token):
+        parts = [s.token_ids(token) for s in self.segments]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    # sorted faiss ids of the rows that may have one of the urls (an arrow string array): a binary
+    # search per url in each segment, so the cost grows with the urls and not the index. hashes can
+    # collide, so callers compare the rows' urls. none when a segment predates url hashes
+    def url_ids(self, urls):
+        if any(s.url_values is None for s in self.segments):
+            return None
+        hashes = np.unique(hash_urls(urls))
+        return np.unique(np.concatenate([s.url_hash_ids(hashes) for s in self.segments]
+                                        or [np.empty(0, dtype=np.int64)]))
+
+    # sorted faiss ids matching every filter, below ntotal (a listing published ahead of the index
+    # it belongs to can hold rows the index does not have yet)
+    def select(self, filters, ntotal):
+        ids = self._select(filters, ntotal)
+        ids = ids[:np.searchsorted(ids, ntotal)]
+        return ids[~np.isin(ids, self.deleted)] if len(self.deleted) else ids
+
+    def _select(self, filters, ntotal):
+        ids = None
+
+        def narrow(found):
+            return found if ids is None else np.intersect1d(ids, found, assume_unique=True)
+
+        # cheapest first: id ranges bound the rest, then the shortest posting lists
+        for field, value in sorted(filters, key=lambda f: f[0] not in ("id", "source")):
+            if field == "id":
+                found = np.arange(max(value[0], 0), min(value[1], ntotal), dtype=np.int64)
+            elif field == "source":
+                if self.manifest is None:
+                    raise ValueError("source: filters need the index manifest")
+                ranges = [np.arange(s["id_start"], s["id_stop"], dtype=np.int64)
+                          for s in self.manifest["shards"] if s["source"] in value]
+                found = np.concatenate(ranges) if ranges else np.empty(0, dtype=np.int64)
+            elif field == "sample_id":
+                found = np.sort(np.concatenate([s.sample_id_range(*value) for s in self.segments]))
+            elif field == "any":
+                found = np.unique(np.concatenate([self.token_ids(t) for w in value for t in query_tokens(w)]
+                                                 or [np.empty(0, dtype=np.int64)]))
+            else:
+                postings = sorted((self.token_ids(t) for t in query_tokens(value)), key=len)
+                found = postings[0] if postings else np.arange(ntotal, dtype=np.int64)
+                for p in postings[1:]:
+                    found = np.intersect1d(found, p, assume_unique=True)
+            ids = narrow(found)
+            if not len(ids):
+                break
+        return ids if ids is not None else np.arange(ntotal, dtype=np.int64)
+
+# path of the column index inside a metadata store
+def filters_path_for(store_path):
+    return os.path.join(str(store_path), "filters")
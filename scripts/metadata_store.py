@@ -0,0 +1,144 @@
+import os
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# compact metadata store keyed by faiss id, read through memory maps
+# layout of <name>.store/:
+#   store.json            row count and column names
+#   <col>.i64             fixed-width int64 values (e.g. sample_id)
+#   <col>.offsets         int64 offsets into the heap, rows + 1 entries
+#   <col>.heap            concatenated utf-8 bytes of every string value
+
+# default store location next to a merged metadata parquet file
+def store_path_for(metadata_path):
+    path = str(metadata_path)
+    if path.endswith(".parquet"):
+        path = path[:-len(".parquet")]
+    return path + ".store"
+
+# append-only writer that builds the store from arrow tables in id order
+# with append=True it adds rows to an existing store; readers keep seeing the old row count
+# until store.json is replaced, and bytes left by an append that never committed are cut off
+# close() commits the new row count at once; finish() only stages it as store.json.tmp and returns
+# the (tmp, path) rename for the caller to publish, and abort() leaves store.json as it was
+class MetadataStoreWriter:
+    def __init__(self, path, int_columns=("sample_id",), string_columns=("url", "text"), append=False):
+        self.path = path
+        self.int_columns = list(int_columns)
+        self.string_columns = list(string_columns)
+        self.rows = 0
+        os.makedirs(path, exist_ok=True)
+
+        if append:
+            with open(os.path.join(path, "store.json")) as f:
+                info = json.load(f)
+            self.int_columns, self.string_columns = info["int_columns"], info["string_columns"]
+            self.rows = info["rows"]
+        mode = "ab" if append else "wb"
+
+        self.files = {}
+        for col in self.int_columns:
+            self.files[col] = self._open(f"{col}.i64", mode, self.rows * 8)
+        self.heap_pos = {}
+        for col in self.string_columns:
+            if append:
+                offsets = np.fromfile(os.path.join(path, f"{col}.offsets"), dtype=np.int64, count=self.rows + 1)
+                self.heap_pos[col] = int(offsets[-1])
+            else:
+                self.heap_pos[col] = 0
+            self.files[col + ".offsets"] = self._open(f"{col}.offsets", mode, (self.rows + 1) * 8)
+            self.files[col + ".heap"] = self._open(f"{col}.heap", mode, self.heap_pos[col])
+            if not append:
+                self.files[col + ".offsets"].write(np.zeros(1, dtype=np.int64).tobytes())
+
+    # open a column file, truncated to its committed length when appending
+    def _open(self, name, mode, committed):
+        f = open(os.path.join(self.path, name), mode)
+        if mode == "ab":
+            f.truncate(committed)
+        return f
+
+    # append the rows of an arrow table, copying whole buffers rather than per-row values
+    def write_table(self, table):
+        for col in self.int_columns:
+            values = pc.fill_null(table.column(col), -1).cast(pa.int64()).to_numpy()
+            self.files[col].write(np.ascontiguousarray(values).tobytes())
+
+        for col in self.string_columns:
+            arr = pc.fill_null(table.column(col), "").cast(pa.large_string()).combine_chunks()
+            offsets = np.frombuffer(arr.buffers()[1], dtype=np.int64)[arr.offset:arr.offset + len(arr) + 1]
+            data = arr.buffers()[2]
+            start, end = int(offsets[0]), int(offsets[-1])
+            if end > start:
+                self.files[col + ".heap"].write(memoryview(data)[start:end])
+            self.files[col + ".offsets"].write((offsets[1:] - start + self.heap_pos[col]).tobytes())
+            self.heap_pos[col] += end - start
+
+        self.rows += table.num_rows
+
+    def finish(self):
+        for f in self.files.values():
+            f.close()
+        info_path = os.path.join(self.path, "store.json")
+        with open(f"{info_path}.tmp", "w") as f:
+            json.dump({"rows": self.rows, "int_columns": self.int_columns,
+                       "string_columns": self.string_columns}, f)
+        return f"{info_path}.tmp", info_path
+
+    def abort(self):
+        for f in self.files.values():
+            f.close()
+
+    def close(self):
+        os.replace(*self.finish())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+# reader that fetches only the requested rows from the memory-mapped files
+class MetadataStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "store.json")) as f:
+            info = json.load(f)
+        self.rows = info["rows"]
+        self.int_columns = info["int_columns"]
+        self.string_columns = info["string_columns"]
+
+        self.ints = {col: self._map(f"{col}.i64", np.int64) for col in self.int_columns}
+        self.offsets = {col: self._map(f"{col}.offsets", np.int64) for col in self.string_columns}
+        self.heaps = {col: self._map(f"{col}.heap", np.uint8) for col in self.string_columns}
+
+    # memory-map one column file (empty files cannot be mapped)
+    def _map(self, name, dtype):
+        path = os.path.join(self.path, name)
+        if os.path.getsize(path) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r")
+
+    def __len__(self):
+        return self.rows
+
+    # values of one column for the given ids; ids outside the store give none
+    def column(self, col, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        valid = (ids >= 0) & (ids < self.rows)
+        if col in self.ints:
+            return [int(self.ints[col][i]) if ok else None for i, ok in zip(ids, valid)]
+        offsets, heap = self.offsets[col], self.heaps[col]
+        return [bytes(heap[offsets[i]:offsets[i + 1]]).decode("utf-8") if ok else None
+                for i, ok in zip(ids, valid)]
+
+    # full rows (as dicts) for the given ids, skipping ids that are not in the store
+    def take(self, ids):
+        ids = [int(i) for i in ids if 0 <= i < self.rows]
+        cols = {col: self.column(col, ids) for col in self.int_columns + self.string_columns}
+        return [{col: cols[col][j] for col in cols} for j in range(len(ids))]
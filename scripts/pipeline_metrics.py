@@ -0,0 +1,238 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# minimal prometheus instrumentation shared by every pipeline script
+# batch jobs write the text exposition format into the node exporter textfile collector
+# directory; the long-running search server serves the same text on /metrics
+# updates are a dict lookup and a short lock, so they can sit inside the hot loops
+
+# default textfile collector directory configured in infra/ansible/monitoring
+default_textfile_dir = "/var/lib/node_exporter/textfile_collector"
+
+# latency buckets in seconds, from sub-millisecond searches to slow image downloads
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    body = ",".join(f'{k}="{escape(v)}"' for k, v in labels.items())
+    return "{" + body + "}"
+
+def format_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+# a metric family; each distinct set of label values gets its own child
+class Metric:
+    kind = None
+
+    def __init__(self, registry, name, doc, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values, **kw):
+        key = tuple(str(kw[n]) for n in self.labelnames) if kw else tuple(str(v) for v in values)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.new_child())
+        return child
+
+    # children of unlabelled metrics are addressed by the empty key
+    def default(self):
+        return self.labels()
+
+    def samples(self):
+        base = self.registry.labels
+        for key, child in list(self.children.items()):
+            labels = {**base, **dict(zip(self.labelnames, key))}
+            yield from child.samples(self.name, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return lines
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, n=1):
+        self.default().inc(n)
+
+class GaugeChild:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, v):
+        self.value = v
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def new_child(self):
+        return GaugeChild()
+
+    def set(self, v):
+        self.default().set(v)
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, v):
+        i = bisect.bisect_left(self.buckets, v)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += v
+
+    # time the enclosed block and observe its duration
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + [float("inf")], counts):
+            cumulative += count
+            yield f"{name}_bucket", {**labels, "le": format_value(float(bound))}, cumulative
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, cumulative
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, doc, labelnames=(), buckets=default_buckets):
+        super().__init__(registry, name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, v):
+        self.default().observe(v)
+
+    def time(self):
+        return self.default().time()
+
+# holds every metric of the process plus labels (e.g. stage and task) added to all of them
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.labels = {}
+        self.lock = threading.Lock()
+
+    # get or create a metric, so modules can declare the same metric independently
+    def get(self, cls, name, doc, labelnames=(), **kw):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(self, name, doc, labelnames, **kw)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    # write atomically so the collector never reads a half-written file
+    def write_textfile(self, path):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+registry = Registry()
+
+def counter(name, doc, labelnames=()):
+    return registry.get(Counter, name, doc, labelnames)
+
+def gauge(name, doc, labelnames=()):
+    return registry.get(Gauge, name, doc, labelnames)
+
+def histogram(name, doc, labelnames=(), buckets=default_buckets):
+    return registry.get(Histogram, name, doc, labelnames, buckets=buckets)
+
+stage_seconds = gauge("laion_stage_seconds", "Wall time of each completed pipeline step", ["step"])
+stage_last_success = gauge("laion_stage_last_success_timestamp_seconds", "Unix time the job last finished successfully")
+
+# record the wall time of one step of a stage, e.g. with timed("load_model"):
+@contextmanager
+def timed(step):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.labels(step=step).set(round(time.perf_counter() - start, 6))
+
+# periodically rewrite the textfile while a batch job runs, and once more at the end
+class TextfileWriter:
+    def __init__(self, path, interval=15):
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        try:
+            registry.write_textfile(self.path)
+        except OSError:
+            pass
+
+    def stop(self, success=True):
+        self.stop_event.set()
+        self.thread.join()
+        if success:
+            stage_last_success.set(int(time.time()))
+        self.flush()
+
+# label every metric with the stage and task, and start exporting to the textfile collector
+# returns none (metrics stay in memory only) when the directory is missing or not writable
+def start_textfile(stage, task=None, textfile_dir=default_textfile_dir, interval=15):
+    registry.labels = {"stage": stage} if task is None else {"stage": stage, "task": str(task)}
+    if not textfile_dir or not os.access(textfile_dir, os.W_OK):
+        return None
+    name = stage if task is None else f"{stage}_task{task}"
+    return TextfileWriter(os.path.join(textfile_dir, f"laion_{name}.prom"), interval)
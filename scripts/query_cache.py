@@ -0,0 +1,118 @@
+import os
+import re
+import hashlib
+import numpy as np
+from collections import OrderedDict
+
+# cache of query embeddings keyed by normalized prompt text or image content hash
+# recent entries live in an in-memory lru; with a cache_dir they are also kept on disk
+# as <key>.npy files, evicted oldest-first once the directory exceeds max_disk_mb
+
+# lowercase and collapse whitespace and surrounding punctuation so near-identical prompts share a key
+def normalize_text(text):
+    text = re.sub(r"\s+", " ", str(text).lower()).strip()
+    return text.strip(" .,;:!?\"'")
+
+# cache key for a text prompt
+def text_key(text, namespace="ViT-B/32"):
+    return hashlib.sha1(f"{namespace}|text|{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+# cache key for raw image bytes
+def image_key(data, namespace="ViT-B/32"):
+    h = hashlib.sha1(f"{namespace}|image|".encode("utf-8"))
+    h.update(data)
+    return h.hexdigest()
+
+# cache key for an image file, hashing its content rather than its path
+def image_file_key(path, namespace="ViT-B/32"):
+    try:
+        with open(path, "rb") as f:
+            return image_key(f.read(), namespace)
+    except OSError:
+        return None
+
+class QueryCache:
+    def __init__(self, max_items=1024, cache_dir=None, max_disk_mb=256):
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = int(max_disk_mb * 1024 * 1024)
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.disk_bytes = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.disk_bytes = sum(size for _, _, size in self._disk_entries())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    # (mtime, path, size) of every cached file on disk
+    def _disk_entries(self):
+        entries = []
+        for f in os.listdir(self.cache_dir):
+            if f.endswith(".npy"):
+                st = os.stat(os.path.join(self.cache_dir, f))
+                entries.append((st.st_mtime, os.path.join(self.cache_dir, f), st.st_size))
+        return entries
+
+    def _remember(self, key, vec):
+        self.memory[key] = vec
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    # embedding for a key, or none; disk hits are promoted into memory
+    def get(self, key):
+        if key is None:
+            self.misses += 1
+            return None
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+        if self.cache_dir:
+            path = self._path(key)
+            try:
+                vec = np.load(path)
+                # touch on read so eviction drops the least recently used files
+                os.utime(path)
+                self._remember(key, vec)
+                self.hits += 1
+                return vec
+            except (OSError, ValueError):
+                pass
+        self.misses += 1
+        return None
+
+    def put(self, key, vec):
+        if key is None:
+            return
+        vec = np.asarray(vec, dtype=np.float32)
+        self._remember(key, vec)
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, vec)
+        os.replace(tmp, path)
+        self.disk_bytes += os.path.getsize(path)
+        if self.disk_bytes > self.max_disk_bytes:
+            self._evict_disk()
+
+    # remove the least recently used files until the directory is back under its limit
+    def _evict_disk(self):
+        entries = sorted(self._disk_entries())
+        self.disk_bytes = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self.disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                self.disk_bytes -= size
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len(self.memory)
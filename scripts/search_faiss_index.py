@@ -1,14 +1,29 @@
 import os
+import re
 import clip
 import faiss
 import torch
+import numpy as np
 import pandas as pd
 from PIL import Image
 from torchvision import transforms
+from concurrent.futures import ThreadPoolExecutor
+from metadata_store import MetadataStore, store_path_for
+from index_manifest import load_tombstones, load_manifest, vectors_path_for, index_parts, metadata_parts
+from metadata_filter import FilterIndex, filters_path_for, parse_filters
+from image_preprocess import DecodePool, load_tensor, to_model_input
+from query_cache import QueryCache, text_key, image_file_key, normalize_text
+from pipeline_metrics import counter, histogram, start_textfile
 
 # detect and set device
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+# search metrics, served on /metrics by search_server or written to a textfile in batch mode
+search_seconds = histogram("laion_search_seconds", "index.search time per call")
+lookup_seconds = histogram("laion_search_lookup_seconds", "Metadata lookup time per query")
+queries_searched = counter("laion_queries_total", "Query vectors searched")
+rerank_seconds = histogram("laion_search_rerank_seconds", "Exact re-ranking time per call")
+
 # default paths
 default_index = "/home/almalinux/laion-distributed-pipeline/faiss_index/merged.index"
 default_metadata = "/home/almalinux/laion-distributed-pipeline/faiss_index/merged_metadata.parquet"
@@ -24,45 +39,367 @@ preprocess = transforms.Compose([
                          std=(0.26862954, 0.26130258, 0.27577711))
 ])
 
-# load and preprocess image
+# load and preprocess image, decoding jpegs at reduced scale
 def load_image(path):
-    try:
-        return preprocess(Image.open(path).convert("RGB"))
-    except Exception as e:
-        print(f"Failed to load {path}: {e}")
-        return None
+    img = load_tensor(path)
+    if img is None:
+        print(f"Failed to load {path}")
+    return img
 
-# embed image
-def embed_image(path, model):
+# embed image, reusing a cached embedding of identical image content when available
+def embed_image(path, model, cache=None):
+    key = image_file_key(path) if cache is not None else None
+    if cache is not None:
+        z = cache.get(key)
+        if z is not None:
+            return z
     img = load_image(path)
     if img is None:
         return None
     with torch.no_grad():
-        z = model.encode_image(img.unsqueeze(0).to(device)).cpu().squeeze(0).numpy()
+        z = model.encode_image(img.unsqueeze(0).to(device)).float().cpu().squeeze(0).numpy()
+    if cache is not None:
+        cache.put(key, z)
     return z.astype("float32")
 
-# search faiss index
-def search(index_path, metadata_path, query_vec, top_k):
-    index = faiss.read_index(index_path)
-    faiss.normalize_L2(query_vec.reshape(1, -1))
-    scores, ids = index.search(query_vec.reshape(1, -1), top_k)
-    metadata = pd.read_parquet(metadata_path)
+# collect query image paths from a directory or a file with one path per line
+def list_query_images(query_dir=None, query_list=None):
+    if query_list:
+        with open(query_list) as f:
+            return [line.strip() for line in f if line.strip()]
+    files = sorted(f for f in os.listdir(query_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+    return [os.path.join(query_dir, f) for f in files]
+
+# decode and preprocess images in a process pool, embedding them in batches
+# cached images (matched by content hash) skip decoding and the model entirely
+# returns the paths that loaded successfully and their (n, d) embedding matrix
+def embed_images(paths, model, batch_size=64, workers=8, cache=None):
+    with ThreadPoolExecutor(max_workers=workers) as pool, DecodePool(workers) as decoder:
+        keys = list(pool.map(image_file_key, paths)) if cache is not None else [None] * len(paths)
+        found = [cache.get(k) for k in keys] if cache is not None else [None] * len(paths)
+        todo = [i for i, z in enumerate(found) if z is None]
+        if cache is not None:
+            print(f"{len(paths) - len(todo)}/{len(paths)} query images found in cache")
+
+        for start in range(0, len(todo), batch_size):
+            batch_idx = todo[start:start + batch_size]
+            imgs = decoder.map([paths[i] for i in batch_idx])
+            keep = [(i, img) for i, img in zip(batch_idx, imgs) if img is not None]
+            for i, img in zip(batch_idx, imgs):
+                if img is None:
+                    print(f"Failed to load {paths[i]}")
+            if not keep:
+                continue
+            x = to_model_input([img for _, img in keep]).to(device)
+            with torch.no_grad():
+                z = model.encode_image(x).float().cpu().numpy()
+            for (i, _), vec in zip(keep, z):
+                found[i] = vec
+                if cache is not None:
+                    cache.put(keys[i], vec)
+            print(f"Embedded {min(start + batch_size, len(todo))}/{len(todo)} uncached query images")
+
+    loaded = [p for p, z in zip(paths, found) if z is not None]
+    if not loaded:
+        return loaded, None
+    return loaded, np.stack([z for z in found if z is not None]).astype("float32")
+
+# tokenize and encode text prompts in batches, returning a (n, d) embedding matrix
+# prompts that normalize to the same text are encoded once, cached ones not at all
+def embed_texts(prompts, model, batch_size=256, cache=None):
+    keys = [text_key(p) for p in prompts]
+    found = {}
+    for key in keys:
+        if key not in found:
+            found[key] = cache.get(key) if cache is not None else None
+    todo = [(key, p) for key, p in dict(zip(keys, prompts)).items() if found[key] is None]
+    if cache is not None:
+        pending = {key for key, _ in todo}
+        print(f"{sum(k not in pending for k in keys)}/{len(prompts)} text queries found in cache")
+
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        tokens = clip.tokenize([p for _, p in batch], truncate=True).to(device)
+        with torch.no_grad():
+            z = model.encode_text(tokens).float().cpu().numpy()
+        for (key, _), vec in zip(batch, z):
+            found[key] = vec
+            if cache is not None:
+                cache.put(key, vec)
+        print(f"Embedded {min(start + batch_size, len(todo))}/{len(todo)} uncached text queries")
+
+    return np.stack([found[k] for k in keys]).astype("float32")
+
+# read text prompts from --text arguments and/or a file with one prompt per line
+def list_text_queries(texts=None, text_list=None):
+    prompts = list(texts or [])
+    if text_list:
+        with open(text_list) as f:
+            prompts.extend(line.strip() for line in f if line.strip())
+    return prompts
+
+# write one row per (query, rank) hit with its score and sample id
+def save_batch_results(out_path, query_ids, scores, ids, metadata):
+    sample_ids = sample_id_array(metadata)
+    valid = ids >= 0
+    df = pd.DataFrame({
+        "query_id": np.repeat(np.asarray(query_ids, dtype=object), ids.shape[1]),
+        "rank": np.tile(np.arange(1, ids.shape[1] + 1), ids.shape[0]),
+        "score": scores.ravel(),
+        "sample_id": np.where(valid, sample_ids[np.where(valid, ids, 0)], -1).ravel(),
+    })
+    df = df[valid.ravel()]
+    df.to_parquet(out_path, index=False)
+    return len(df)
+
+# load faiss index once, optionally memory-mapped instead of read into ram, with the delta
+# segments incremental merges published after it
+def load_index(index_path, mmap=False, search_params=None):
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+    index = attach_segments(faiss.read_index(index_path, flags), index_path, flags)
+    # e.g. nprobe=16 for ivf indexes or efSearch=64 for hnsw
+    if search_params:
+        faiss.ParameterSpace().set_index_parameters(index, search_params)
+    return index
+
+# add the delta indexes listed in the manifest next to index_path (see merge_faiss_shards.py) to the
+# loaded merged index: flat codes are appended to the merged index's codes, and ivf lists are stacked
+# through HStackInvertedLists, which reads the merged index's and every segment's lists in place
+def attach_segments(index, index_path, flags=0):
+    paths = index_parts(index_path, load_manifest(index_path))
+    if not paths:
+        return index
+    parts = [faiss.read_index(p, flags) for p in paths]
+    try:
+        base_ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        for part in parts:
+            index.merge_from(part)
+        return index
+
+    # the stacked lists are searched through an emptied copy of a segment (the same quantizer and
+    # codec); the merged index and the segments stay alive with it and keep owning their lists
+    lists = faiss.InvertedListsPtrVector()
+    for part in [index] + parts:
+        lists.push_back(faiss.extract_index_ivf(part).invlists)
+    stacked = faiss.HStackInvertedLists(lists.size(), lists.data())
+    merged = faiss.read_index(paths[0])
+    merged.reset()
+    ivf = faiss.extract_index_ivf(merged)
+    ivf.replace_invlists(stacked, False)
+    ivf.nprobe = base_ivf.nprobe
+    ivf.ntotal = merged.ntotal = index.ntotal + sum(p.ntotal for p in parts)
+    merged.referenced_objects = [stacked, index] + parts
+    return merged
+
+# per-call search parameters that restrict a search to an id selector; they carry over the
+# index's nprobe / efSearch, which per-call parameters replace
+def selector_params(index, sel):
+    try:
+        ivf = faiss.extract_index_ivf(index)
+        return faiss.SearchParametersIVF(sel=sel, nprobe=ivf.nprobe)
+    except RuntimeError:
+        pass
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=index.hnsw.efSearch)
+    return faiss.SearchParameters(sel=sel)
+
+# search parameters that skip the ids tombstoned by merge_faiss_shards.py, or none when nothing is deleted
+def deleted_params(index, index_path):
+    deleted = load_tombstones(index_path)
+    if not len(deleted):
+        return None
+    return selector_params(index, faiss.IDSelectorNot(faiss.IDSelectorBatch(deleted)))
+
+# column index for filtered search from the store next to the merged metadata (none without one),
+# with the manifest for source: filters and the tombstones it leaves out
+def load_filter_index(index_path, metadata_path):
+    store = metadata_path if os.path.isdir(metadata_path) else store_path_for(metadata_path)
+    path = filters_path_for(store)
+    if not os.path.exists(os.path.join(path, "segments.json")):
+        return None
+    return FilterIndex(path, load_manifest(index_path), load_tombstones(index_path))
+
+# open merged metadata once, preferring the memory-mapped store written next to the parquet file;
+# without one the parquet is read with the metadata segments listed in index_path's manifest
+def load_metadata(metadata_path, index_path=None):
+    if os.path.isdir(metadata_path):
+        return MetadataStore(metadata_path)
+    if os.path.isdir(store_path_for(metadata_path)):
+        return MetadataStore(store_path_for(metadata_path))
+    manifest = load_manifest(index_path) if index_path else None
+    return pd.concat([pd.read_parquet(p, columns=["sample_id", "url", "text"])
+                      for p, _ in metadata_parts(metadata_path, manifest)], ignore_index=True)
+
+# sample id of every faiss id, as an array indexable by id
+def sample_id_array(metadata):
+    if isinstance(metadata, MetadataStore):
+        return metadata.ints["sample_id"]
+    return metadata["sample_id"].to_numpy()
+
+# fetch only the hit rows (sample_id, url, text) and attach each hit's score
+def lookup_hits(metadata, ids, scores):
+    keep = [(int(i), float(s)) for i, s in zip(ids, scores) if 0 <= i < len(metadata)]
+    if isinstance(metadata, MetadataStore):
+        rows = metadata.take([i for i, _ in keep])
+    else:
+        rows = metadata.iloc[[i for i, _ in keep]].to_dict("records")
+    for row, (_, score) in zip(rows, keep):
+        row["sample_id"] = int(row["sample_id"])
+        row["score"] = score
+    return rows
+
+# normalize a (n, d) query matrix and run a single index.search for all of it
+# params are per-call faiss search parameters, e.g. from deleted_params
+def search_vectors(index, query_mat, top_k, params=None):
+    query_mat = np.ascontiguousarray(query_mat, dtype="float32")
+    faiss.normalize_L2(query_mat)
+    queries_searched.inc(len(query_mat))
+    with search_seconds.time():
+        return index.search(query_mat, top_k, params=params)
+
+# search only the allowed faiss ids (sorted, e.g. from FilterIndex.select): the filter is applied inside
+# the scan as a bitmap selector, so every query still gets its true top-k among them. candidate sets
+# up to exact_max are scored exactly when the index can return their vectors. ivf and hnsw indexes
+# search more widely the fewer ids are allowed: enough lists to expect oversample * top_k matches,
+# or efSearch divided by the fraction allowed, then again with more for queries left short of top_k
+def search_filtered(index, query_mat, top_k, allowed, exact_max=4096, oversample=8, max_ef=4096):
+    query_mat = np.ascontiguousarray(query_mat, dtype="float32")
+    faiss.normalize_L2(query_mat)
+    queries_searched.inc(len(query_mat))
+    scores = np.full((len(query_mat), top_k), -np.inf, dtype=np.float32)
+    ids = np.full((len(query_mat), top_k), -1, dtype=np.int64)
+    if not len(allowed):
+        return scores, ids
+
+    with search_seconds.time():
+        xb = None
+        if len(allowed) <= exact_max:
+            try:
+                xb = index.reconstruct_batch(allowed)
+            except RuntimeError:
+                pass
+        if xb is not None:
+            sims = query_mat @ xb.T
+            k = min(top_k, len(allowed))
+            top = np.argsort(-sims, axis=1, kind="stable")[:, :k]
+            scores[:, :k] = np.take_along_axis(sims, top, axis=1)
+            ids[:, :k] = allowed[top]
+            return scores, ids
+
+        mask = np.zeros(index.ntotal, dtype=bool)
+        mask[allowed] = True
+        params = selector_params(index, faiss.IDSelectorBitmap(np.packbits(mask, bitorder="little")))
+        fraction = len(allowed) / index.ntotal
+        if isinstance(params, faiss.SearchParametersIVF):
+            limit = faiss.extract_index_ivf(index).nlist
+            params.nprobe = min(limit, max(params.nprobe, int(np.ceil(limit * oversample * top_k / len(allowed)))))
+        elif isinstance(params, faiss.SearchParametersHNSW):
+            limit = max(max_ef, params.efSearch)
+            params.efSearch = min(limit, int(np.ceil(params.efSearch / fraction)))
+        scores, ids = index.search(query_mat, top_k, params=params)
+
+        # widen the search for queries whose probed lists or graph walk held fewer than top_k matches
+        want = min(top_k, len(allowed))
+        field = {faiss.SearchParametersIVF: "nprobe", faiss.SearchParametersHNSW: "efSearch"}.get(type(params))
+        while field is not None and getattr(params, field) < limit:
+            short = np.flatnonzero((ids >= 0).sum(axis=1) < want)
+            if not len(short):
+                break
+            setattr(params, field, min(limit, getattr(params, field) * 4))
+            scores[short], ids[short] = index.search(query_mat[short], top_k, params=params)
+    return scores, ids
+
+# full-precision vectors of a merged index (merge_faiss_shards.py --rerank_vectors), memory-mapped as an
+# (ntotal, d) float32 matrix so only the rows of re-ranked candidates are ever read
+def load_rerank_vectors(index_path, index):
+    path = vectors_path_for(index_path)
+    if not os.path.exists(path):
+        raise RuntimeError(f"No vector file at {path}, merge with --rerank_vectors to re-rank")
+    rows = os.path.getsize(path) // (4 * index.d)
+    if rows < index.ntotal:
+        raise RuntimeError(f"{path} holds {rows} vectors but {index_path} holds {index.ntotal}")
+    # rows past ntotal belong to an incremental merge that has not published yet
+    return np.memmap(path, dtype=np.float32, mode="r", shape=(index.ntotal, index.d))
+
+# re-rank candidate ids (n, N) by the exact inner product of the normalized queries with their
+# full-precision vectors, keeping the best top_k of each row. the candidates of all queries are
+# gathered from the memory-mapped file once, in id order, then scored query by query
+def rerank(query_mat, ids, vectors, top_k):
+    query_mat = np.array(query_mat, dtype="float32")
+    faiss.normalize_L2(query_mat)
+    with rerank_seconds.time():
+        valid = ids >= 0
+        unique, inverse = np.unique(ids[valid], return_inverse=True)
+        xb = np.asarray(vectors[unique])
+        sims = np.full(ids.shape, -np.inf, dtype=np.float32)
+        start = 0
+        for q, (row, keep) in enumerate(zip(sims, valid)):
+            n = int(keep.sum())
+            row[keep] = xb[inverse[start:start + n]] @ query_mat[q]
+            start += n
+        k = min(top_k, ids.shape[1])
+        top = np.argsort(-sims, axis=1, kind="stable")[:, :k]
+        scores = np.take_along_axis(sims, top, axis=1)
+        return scores, np.where(np.isfinite(scores), np.take_along_axis(ids, top, axis=1), -1)
+
+# top_k scores and faiss ids for a (n, d) query matrix: restricted to allowed ids when given (see
+# search_filtered), and with vectors (from load_rerank_vectors) two-stage: the compressed index
+# returns the best candidates per query, which are re-ranked exactly from the full-precision vectors
+def search_ids(index, query_mat, top_k, params=None, allowed=None, vectors=None, candidates=100):
+    k = max(top_k, candidates) if vectors is not None else top_k
+    if allowed is not None:
+        scores, ids = search_filtered(index, query_mat, k, allowed)
+    else:
+        scores, ids = search_vectors(index, query_mat, k, params)
+    if vectors is None:
+        return scores, ids
+    return rerank(query_mat, ids, vectors, top_k)
+
+# search a loaded index with a (n, d) query matrix, returning scored metadata rows per query
+# allowed restricts the search to those faiss ids, vectors re-ranks candidates (see search_ids)
+def search_batch(index, metadata, query_mat, top_k, params=None, allowed=None, vectors=None, candidates=100):
+    scores, ids = search_ids(index, query_mat, top_k, params, allowed, vectors, candidates)
     results = []
-    for i in ids[0]:
-        if i < len(metadata):
-            row = metadata.iloc[i]
-            results.append((row["url"], row["text"]))
+    for row_ids, row_scores in zip(ids, scores):
+        with lookup_seconds.time():
+            results.append(lookup_hits(metadata, row_ids, row_scores))
     return results
 
-# print results
-def print_results(image_path, results):
-    print(f"\nQuery image: {os.path.basename(image_path)}")
+# faiss ids matching filter expressions, or none when there are no filters
+def filter_ids(index_path, metadata_path, filters, ntotal):
+    if not filters:
+        return None
+    filter_index = load_filter_index(index_path, metadata_path)
+    if filter_index is None:
+        raise RuntimeError(f"No column index next to {metadata_path}, merge with --output_store to build it")
+    allowed = filter_index.select(parse_filters(filters), ntotal)
+    print(f"{len(allowed)} of {ntotal} vectors match the filters")
+    return allowed
+
+# search faiss index, re-ranking the top rerank candidates exactly when rerank is set
+def search(index_path, metadata_path, query_vec, top_k, search_params=None, filters=None, rerank=0):
+    index = load_index(index_path, search_params=search_params)
+    metadata = load_metadata(metadata_path, index_path)
+    allowed = filter_ids(index_path, metadata_path, filters, index.ntotal)
+    vectors = load_rerank_vectors(index_path, index) if rerank else None
+    return search_batch(index, metadata, query_vec.reshape(1, -1), top_k, deleted_params(index, index_path),
+                        allowed, vectors, rerank)[0]
+
+# print results for an image path or a text prompt
+def print_results(query, results, kind="image"):
+    label = os.path.basename(query) if kind == "image" else query
+    print(f"\nQuery {kind}: {label}")
     print("-" * 70)
-    for i, (url, text) in enumerate(results):
-        print(f"{i+1:02d}. URL: {url}")
-        print(f"    Text: {text[:100]}...\n")
+    for i, hit in enumerate(results):
+        print(f"{i+1:02d}. URL: {hit['url']} (score {hit['score']:.4f})")
+        print(f"    Text: {hit['text'][:100]}...\n")
     print("-" * 70)
 
+# filename-safe stem for a text prompt
+def text_stem(prompt):
+    return re.sub(r"[^a-z0-9]+", "_", normalize_text(prompt)).strip("_")[:60] or "query"
+
 # resolve output filename
 def resolve_output_filename(out_dir, image_path):
     base = os.path.splitext(os.path.basename(image_path))[0]
@@ -99,10 +436,83 @@ if __name__ == "__main__":
     parser.add_argument("--metadata_path", type=str, default=default_metadata)
     parser.add_argument("--query_dir", type=str, default=default_query_dir)
     parser.add_argument("--output_dir", type=str, default=default_output_dir)
+    parser.add_argument("--search_params", type=str, default=None, help="faiss search parameters, e.g. nprobe=16")
+    parser.add_argument("--batch", action="store_true", help="non-interactive mode over all query images")
+    parser.add_argument("--query_list", type=str, default=None, help="file with one query image path per line (batch mode)")
+    parser.add_argument("--batch_size", type=int, default=64, help="images per encode_image call (batch mode)")
+    parser.add_argument("--workers", type=int, default=8, help="parallel image decode workers (batch mode)")
+    parser.add_argument("--batch_output", type=str, default=None, help="parquet results path (batch mode)")
+    parser.add_argument("--text", type=str, action="append", default=None, help="text query (repeatable)")
+    parser.add_argument("--text_list", type=str, default=None, help="file with one text query per line")
+    parser.add_argument("--cache_dir", type=str, default=None, help="directory for cached query embeddings")
+    parser.add_argument("--cache_items", type=int, default=1024, help="query embeddings kept in memory")
+    parser.add_argument("--cache_max_mb", type=float, default=256, help="size limit of the on-disk cache")
+    parser.add_argument("--metrics_dir", type=str, default=None, help="node exporter textfile directory (batch mode)")
+    parser.add_argument("--filter", type=str, action="append", default=None,
+                        help="metadata filter (repeatable, ANDed), e.g. text:red car, any:dog,cat, "
+                             "source:clip_embeddings_003.parquet, id:0-1000000, sample_id:100-200")
+    parser.add_argument("--rerank", type=int, default=0,
+                        help="re-rank this many candidates per query exactly from the vector file (0: off)")
     args = parser.parse_args()
 
     # prepare output directory
     os.makedirs(args.output_dir, exist_ok=True)
+    cache = QueryCache(args.cache_items, args.cache_dir, args.cache_max_mb) if args.cache_dir else None
+    metrics = start_textfile("search", None, args.metrics_dir) if args.batch and args.metrics_dir else None
+
+    # text mode: encode all prompts in batches and search once
+    prompts = list_text_queries(args.text, args.text_list)
+    if prompts:
+        model, _ = clip.load("ViT-B/32", device=device)
+        query_mat = embed_texts(prompts, model, cache=cache)
+        index = load_index(args.index_path, search_params=args.search_params)
+        metadata = load_metadata(args.metadata_path, args.index_path)
+        params = deleted_params(index, args.index_path)
+        allowed = filter_ids(args.index_path, args.metadata_path, args.filter, index.ntotal)
+        vectors = load_rerank_vectors(args.index_path, index) if args.rerank else None
+
+        if args.batch:
+            scores, ids = search_ids(index, query_mat, args.top_k, params, allowed, vectors, args.rerank)
+            out_path = args.batch_output or os.path.join(args.output_dir, "batch_results.parquet")
+            rows = save_batch_results(out_path, prompts, scores, ids, metadata)
+            print(f"Searched {len(prompts)} text queries, {rows} results saved to: {out_path}")
+            if metrics is not None:
+                metrics.stop()
+            exit(0)
+
+        for prompt, results in zip(prompts, search_batch(index, metadata, query_mat, args.top_k, params, allowed,
+                                                     vectors, args.rerank)):
+            print_results(prompt, results, kind="text")
+            out_path = resolve_output_filename(args.output_dir, text_stem(prompt))
+            pd.DataFrame(results, columns=["url", "text", "score", "sample_id"]).to_csv(out_path, index=False)
+            print(f"Results saved to: {out_path}")
+        exit(0)
+
+    # batch mode: embed every query image, search once, write a single parquet file
+    if args.batch:
+        paths = list_query_images(args.query_dir, args.query_list)
+        if not paths:
+            print("No query images found.")
+            exit(1)
+
+        model, _ = clip.load("ViT-B/32", device=device)
+        loaded, query_mat = embed_images(paths, model, args.batch_size, args.workers, cache)
+        if query_mat is None:
+            exit(1)
+
+        index = load_index(args.index_path, search_params=args.search_params)
+        metadata = load_metadata(args.metadata_path, args.index_path)
+        allowed = filter_ids(args.index_path, args.metadata_path, args.filter, index.ntotal)
+        vectors = load_rerank_vectors(args.index_path, index) if args.rerank else None
+        scores, ids = search_ids(index, query_mat, args.top_k, deleted_params(index, args.index_path), allowed,
+                                 vectors, args.rerank)
+
+        out_path = args.batch_output or os.path.join(args.output_dir, "batch_results.parquet")
+        rows = save_batch_results(out_path, loaded, scores, ids, metadata)
+        print(f"Searched {len(loaded)} queries ({len(paths) - len(loaded)} failed to load), {rows} results saved to: {out_path}")
+        if metrics is not None:
+            metrics.stop()
+        exit(0)
 
     # select query image
     query_image = select_query_image(args.query_dir)
@@ -112,16 +522,17 @@ if __name__ == "__main__":
     model, _ = clip.load("ViT-B/32", device=device)
 
     # embed image
-    query_vec = embed_image(image_path, model)
+    query_vec = embed_image(image_path, model, cache)
     if query_vec is None:
         exit(1)
 
     # search and display results
-    results = search(args.index_path, args.metadata_path, query_vec, args.top_k)
+    results = search(args.index_path, args.metadata_path, query_vec, args.top_k, args.search_params, args.filter,
+                     args.rerank)
     print_results(image_path, results)
 
     # save results
     out_path = resolve_output_filename(args.output_dir, image_path)
-    df = pd.DataFrame(results, columns=["url", "text"])
+    df = pd.DataFrame(results, columns=["url", "text", "score", "sample_id"])
     df.to_csv(out_path, index=False)
     print(f"Results saved to: {out_path}")
\ No newline at end of file
@@ -0,0 +1,297 @@
+import json
+import time
+import clip
+import queue
+import torch
+import argparse
+import threading
+import numpy as np
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from image_preprocess import load_tensor
+from search_faiss_index import (device, default_index, default_metadata,
+                                load_index, load_metadata, search_batch, deleted_params, load_filter_index,
+                                load_rerank_vectors)
+from metadata_filter import parse_filters
+from index_manifest import load_manifest
+from shard_search import ScatterGather, read_registry
+from pipeline_metrics import registry, histogram, start_textfile
+
+# server metrics, served on /metrics alongside the search metrics
+request_seconds = histogram("laion_search_request_seconds", "End-to-end latency of queued search requests")
+batch_size_hist = histogram("laion_search_batch_size", "Queries per micro-batch",
+                            buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+encode_seconds = histogram("laion_search_encode_seconds", "encode_image time per micro-batch")
+
+# one pending query waiting for its micro-batch to be searched; filters are its filter expressions
+class PendingQuery:
+    def __init__(self, tensor, top_k, filters=()):
+        self.tensor = tensor
+        self.top_k = top_k
+        self.filters = filters
+        self.start = time.perf_counter()
+        self.done = threading.Event()
+        self.results = None
+        self.status = None
+        self.error = None
+
+# rolling latency window used for p50/p99 and qps reporting
+class LatencyStats:
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.finished = deque(maxlen=window)
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.finished.append(time.perf_counter())
+
+    def summary(self):
+        with self.lock:
+            lat = np.array(self.latencies) * 1000
+            finished = list(self.finished)
+            batches = self.batches
+        if len(lat) == 0:
+            return {"queries": 0, "batches": batches}
+        span = finished[-1] - finished[0]
+        return {
+            "queries": len(lat),
+            "batches": batches,
+            "p50_ms": round(float(np.percentile(lat, 50)), 2),
+            "p99_ms": round(float(np.percentile(lat, 99)), 2),
+            "qps": round((len(finished) - 1) / span, 1) if span > 0 else None,
+        }
+
+# groups concurrent queries into one encode_image and one index.search call
+# index may be a ScatterGather over shard workers, whose hits already carry their metadata
+# queries with filters are searched in one call per distinct filter, against the column index
+# with vectors (the merged index's vector file) the top candidates of each query are re-ranked exactly
+class MicroBatcher:
+    def __init__(self, model, index, metadata, batch_window_ms=5, max_batch=64, params=None, filter_index=None,
+                 vectors=None, candidates=100):
+        self.model = model
+        self.current = (index, metadata, params, filter_index, vectors)
+        self.candidates = candidates
+        self.window = batch_window_ms / 1000
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.stats = LatencyStats()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # switch to a newly published index; batches already running finish on the old one
+    def swap(self, index, metadata, params=None, filter_index=None, vectors=None):
+        self.current = (index, metadata, params, filter_index, vectors)
+
+    # submit one preprocessed image and block until its results (and shard status, if sharded) are ready
+    def submit(self, tensor, top_k, filters=()):
+        q = PendingQuery(tensor, top_k, tuple(filters))
+        self.queue.put(q)
+        q.done.wait()
+        if q.error is not None:
+            raise q.error
+        return q.results, q.status
+
+    # collect queries that arrive within the batch window after the first one
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            try:
+                batch_size_hist.observe(len(batch))
+                x = torch.stack([q.tensor for q in batch]).to(device)
+                with encode_seconds.time(), torch.no_grad():
+                    z = self.model.encode_image(x).float().cpu().numpy()
+                top_k = max(q.top_k for q in batch)
+                index, metadata, params, filter_index, vectors = self.current
+                if isinstance(index, ScatterGather):
+                    results, status = index.search(z, top_k)
+                else:
+                    results, status = [None] * len(batch), None
+                    groups = {}
+                    for i, q in enumerate(batch):
+                        groups.setdefault(q.filters, []).append(i)
+                    for filters, rows in groups.items():
+                        allowed = filter_index.select(parse_filters(filters), index.ntotal) if filters else None
+                        hits_rows = search_batch(index, metadata, z[rows], top_k, params, allowed, vectors,
+                                                 self.candidates)
+                        for i, hits in zip(rows, hits_rows):
+                            results[i] = hits
+                for q, hits in zip(batch, results):
+                    q.results = hits[:q.top_k]
+                    q.status = status
+            except Exception as e:
+                for q in batch:
+                    q.error = e
+            with self.stats.lock:
+                self.stats.batches += 1
+            for q in batch:
+                if q.error is None:
+                    latency = time.perf_counter() - q.start
+                    self.stats.record(latency)
+                    request_seconds.observe(latency)
+                q.done.set()
+
+# http handler: POST /search with raw image bytes (optionally ?top_k=N, 1 to max_top_k, and
+# ?filter=text:dog, repeatable), GET /stats for latency and qps, GET /metrics for prometheus
+def make_handler(batcher, default_top_k, max_top_k=1000):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlsplit(self.path).path
+            if path == "/stats":
+                self.send_json(200, batcher.stats.summary())
+            elif path == "/metrics":
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            parts = urlsplit(self.path)
+            if parts.path != "/search":
+                self.send_json(404, {"error": "not found"})
+                return
+            query = parse_qs(parts.query)
+            try:
+                top_k = int(query.get("top_k", [default_top_k])[0])
+            except ValueError:
+                top_k = 0
+            if not 1 <= top_k <= max_top_k:
+                self.send_json(400, {"error": f"top_k must be an integer from 1 to {max_top_k}"})
+                return
+            filters = query.get("filter", [])
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if filters:
+                index, _, _, filter_index, _ = batcher.current
+                if isinstance(index, ScatterGather) or filter_index is None:
+                    self.send_json(400, {"error": "filters need a merged index with a column index"})
+                    return
+                try:
+                    parse_filters(filters)
+                except ValueError as e:
+                    self.send_json(400, {"error": str(e)})
+                    return
+
+            # decode (at reduced jpeg scale) on the request thread so only encode and search are batched
+            img = load_tensor(data)
+            if img is None:
+                self.send_json(400, {"error": "invalid image"})
+                return
+            try:
+                hits, status = batcher.submit(img, top_k, filters)
+            except Exception as e:
+                self.send_json(500, {"error": str(e)})
+                return
+            payload = {"results": hits}
+            if status is not None:
+                payload["shards"] = status
+            self.send_json(200, payload)
+
+        # keep per-request logging off the hot path
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+# load the merged index, its metadata, the search parameters that skip deleted ids and the column
+# index for filtered queries, and with --rerank the memory-mapped vectors candidates are re-ranked from
+def load_searcher(args):
+    index = load_index(args.index_path, args.mmap, args.search_params)
+    metadata = load_metadata(args.metadata_path, args.index_path)
+    return (index, metadata, deleted_params(index, args.index_path),
+            load_filter_index(args.index_path, args.metadata_path),
+            load_rerank_vectors(args.index_path, index) if args.rerank else None)
+
+# poll the manifest next to the index and swap in each newly published version, loading it in the
+# background while the old one keeps serving
+def watch_manifest(batcher, args, version):
+    while True:
+        time.sleep(args.reload_seconds)
+        try:
+            manifest = load_manifest(args.index_path)
+            if manifest is None or manifest["version"] == version:
+                continue
+            batcher.swap(*load_searcher(args))
+            version = manifest["version"]
+            print(f"Reloaded index version {version} ({manifest['ntotal']} vectors, {manifest['deleted']} deleted)")
+        except Exception as e:
+            print(f"Index reload failed, still serving version {version}: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index_path", type=str, default=default_index)
+    parser.add_argument("--metadata_path", type=str, default=default_metadata)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--top_k", type=int, default=5, help="default number of results per query")
+    parser.add_argument("--max_top_k", type=int, default=1000, help="largest top_k a request may ask for")
+    parser.add_argument("--mmap", action="store_true", help="memory-map the index instead of reading it into ram")
+    parser.add_argument("--search_params", type=str, default=None, help="faiss search parameters, e.g. nprobe=16")
+    parser.add_argument("--batch_window_ms", type=float, default=5, help="time to wait for more queries to batch")
+    parser.add_argument("--max_batch", type=int, default=64)
+    parser.add_argument("--shard_registry", type=str, default=None,
+                        help="search shard workers registered in this directory instead of a merged index")
+    parser.add_argument("--shard_workers", type=str, nargs="*", default=None, help="shard worker urls")
+    parser.add_argument("--shard_timeout", type=float, default=2.0, help="seconds to wait for shard workers")
+    parser.add_argument("--reload_seconds", type=float, default=0,
+                        help="check the index manifest this often and serve newly published versions")
+    parser.add_argument("--rerank", type=int, default=0,
+                        help="re-rank this many candidates per query exactly from the vector file (0: off)")
+    args = parser.parse_args()
+
+    # label metrics as the search stage; they are scraped from /metrics rather than a textfile
+    start_textfile("search", textfile_dir=None)
+
+    # load model, index and metadata once for the lifetime of the server
+    model, _ = clip.load("ViT-B/32", device=device)
+    if args.shard_registry or args.shard_workers:
+        workers = args.shard_workers or read_registry(args.shard_registry)
+        index, metadata, params, filter_index, vectors = ScatterGather(workers, args.shard_timeout), None, None, None, None
+        print(f"Searching {len(workers)} shard workers (timeout {args.shard_timeout}s)")
+    else:
+        manifest = load_manifest(args.index_path)
+        index, metadata, params, filter_index, vectors = load_searcher(args)
+        print(f"Loaded index with {index.ntotal} vectors and {len(metadata)} metadata rows")
+        if vectors is not None:
+            print(f"Re-ranking the top {args.rerank} candidates per query from full-precision vectors")
+
+    batcher = MicroBatcher(model, index, metadata, args.batch_window_ms, args.max_batch, params, filter_index,
+                           vectors, args.rerank)
+    if args.reload_seconds > 0 and not (args.shard_registry or args.shard_workers):
+        version = manifest["version"] if manifest else None
+        threading.Thread(target=watch_manifest, args=(batcher, args, version), daemon=True).start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, args.top_k, args.max_top_k))
+    server.daemon_threads = True
+    print(f"Serving search on http://{args.host}:{args.port} (POST /search, GET /stats, GET /metrics)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(batcher.stats.summary()))
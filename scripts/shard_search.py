@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import faiss
+import socket
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from urllib.parse import urlsplit, parse_qs, urlencode
+from urllib.request import urlopen, Request
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from merge_faiss_shards import list_shards
+from search_faiss_index import load_index, search_seconds, queries_searched
+from pipeline_metrics import registry, counter, histogram, start_textfile
+
+# scatter-gather search over the per-task shards written by build_faiss_index.py, with no merged index
+#   worker       serves a group of shards from the index directory over http (one per node, or
+#                several local processes); its hits carry global ids and their metadata rows
+#   coordinator  ScatterGather fans each normalized query batch out to every worker and merges the
+#                per-worker top-k by score; search_server.py --shard_registry serves it over http
+# global ids follow sorted shard order, the order merge_faiss_shards.py would give them, so results
+# match the merged index. workers that fail or miss the deadline are left out of a partial result
+#
+# workers announce themselves in <registry_dir>/worker_<id>.json on the nfs share
+
+# coordinator metrics, served on /metrics by search_server
+worker_requests = counter("laion_shard_requests_total", "Requests to shard workers, by worker and result",
+                          ["worker", "result"])
+worker_seconds = histogram("laion_shard_request_seconds", "Round trip time of shard worker requests")
+
+# index files of one worker: every num_workers-th shard in sorted order
+def assign_shards(index_dir, worker_id, num_workers):
+    return list_shards(index_dir, ".index")[worker_id::num_workers]
+
+def meta_path_for(index_dir, index_file):
+    return os.path.join(index_dir, index_file[:-len(".index")] + ".meta.parquet")
+
+# global id of the first vector of every shard, from the row counts of the metadata files
+def shard_offsets(index_dir):
+    offsets, total = {}, 0
+    for f in list_shards(index_dir, ".index"):
+        offsets[f] = total
+        total += pq.ParquetFile(meta_path_for(index_dir, f)).metadata.num_rows
+    return offsets
+
+# load a group of shards as one index: each shard is loaded as search_faiss_index.py does (memory-mapped
+# with mmap) and searched in turn through an IndexShards, which numbers their ids one after the other
+# and merges their hits; nothing is copied or merged, so the merge's progress metrics stay untouched
+def load_shard_group(index_dir, files, mmap=False, search_params=None):
+    shards = [load_index(os.path.join(index_dir, f), mmap, search_params) for f in files]
+    if len(shards) == 1:
+        return shards[0]
+    index = faiss.IndexShards(shards[0].d, False, True)
+    for shard in shards:
+        index.add_shard(shard)
+    return index
+
+# the shards of one worker: a single index plus each local id's global id and metadata row
+class ShardWorker:
+    def __init__(self, index_dir, files, mmap=False, search_params=None, delay_ms=0):
+        if not files:
+            raise ValueError(f"No shards assigned in {index_dir}")
+        self.files = files
+        self.delay = delay_ms / 1000
+        self.index = load_shard_group(index_dir, files, mmap, search_params)
+        offsets = shard_offsets(index_dir)
+
+        metas = [pd.read_parquet(meta_path_for(index_dir, f), columns=["sample_id", "url", "text"]) for f in files]
+        self.global_ids = np.concatenate([offsets[f] + np.arange(len(m), dtype=np.int64)
+                                          for f, m in zip(files, metas)])
+        self.metadata = pd.concat(metas, ignore_index=True)
+        if len(self.metadata) != self.index.ntotal:
+            raise ValueError(f"{self.index.ntotal} vectors but {len(self.metadata)} metadata rows in {files}")
+
+    # search already-normalized queries, returning per query a list of hit dicts
+    def search(self, query_mat, top_k):
+        if self.delay:
+            time.sleep(self.delay)
+        queries_searched.inc(len(query_mat))
+        with search_seconds.time():
+            scores, ids = self.index.search(query_mat, top_k)
+        results = []
+        for row_ids, row_scores in zip(ids, scores):
+            keep = row_ids >= 0
+            rows = self.metadata.iloc[row_ids[keep]]
+            results.append([{"id": int(self.global_ids[i]), "score": float(s), "sample_id": int(sid),
+                             "url": url, "text": text}
+                            for i, s, sid, url, text in zip(row_ids[keep], row_scores[keep], rows["sample_id"],
+                                                            rows["url"], rows["text"])])
+        return results
+
+# http handler of a worker: POST /search with a float32 query matrix, GET /info and GET /metrics
+def make_worker_handler(worker):
+    class Handler(BaseHTTPRequestHandler):
+        def send_body(self, code, body, content_type="application/json"):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlsplit(self.path).path
+            if path == "/info":
+                info = {"files": worker.files, "ntotal": int(worker.index.ntotal), "d": int(worker.index.d)}
+                self.send_body(200, json.dumps(info).encode("utf-8"))
+            elif path == "/metrics":
+                self.send_body(200, registry.render().encode("utf-8"), "text/plain; version=0.0.4")
+            else:
+                self.send_body(404, b'{"error": "not found"}')
+
+        def do_POST(self):
+            parts = urlsplit(self.path)
+            if parts.path != "/search":
+                self.send_body(404, b'{"error": "not found"}')
+                return
+            top_k = int(parse_qs(parts.query).get("top_k", [10])[0])
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                query_mat = np.frombuffer(data, dtype=np.float32).reshape(-1, worker.index.d)
+                results = worker.search(query_mat, top_k)
+            except Exception as e:
+                self.send_body(500, json.dumps({"error": str(e)}).encode("utf-8"))
+                return
+            self.send_body(200, json.dumps({"results": results}).encode("utf-8"))
+
+        # keep per-request logging off the hot path
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+# announce a worker in the registry directory, written atomically
+def register_worker(registry_dir, worker_id, url, files):
+    os.makedirs(registry_dir, exist_ok=True)
+    path = os.path.join(registry_dir, f"worker_{worker_id}.json")
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({"url": url, "files": files, "started": time.time()}, f)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+# urls of every worker registered in the directory
+def read_registry(registry_dir):
+    urls = []
+    for f in sorted(os.listdir(registry_dir)):
+        if f.startswith("worker_") and f.endswith(".json"):
+            with open(os.path.join(registry_dir, f)) as fh:
+                urls.append(json.load(fh)["url"])
+    return urls
+
+# merge per-worker hit lists of one query into the global top-k by score
+def merge_hits(hit_lists, top_k):
+    hits = [h for hits in hit_lists for h in hits]
+    hits.sort(key=lambda h: -h["score"])
+    return hits[:top_k]
+
+# coordinator: fan a query batch out to every worker and merge what comes back before the deadline
+# a worker that failed is skipped for retry_seconds instead of being waited on again
+class ScatterGather:
+    def __init__(self, worker_urls, timeout=2.0, retry_seconds=10):
+        if not worker_urls:
+            raise ValueError("No shard workers to search")
+        self.worker_urls = list(worker_urls)
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self.down_until = {}
+        self.pool = ThreadPoolExecutor(max_workers=4 * len(self.worker_urls))
+
+    # one worker round trip; the http timeout stops threads of stuck workers piling up
+    def query_worker(self, url, body, top_k):
+        start = time.perf_counter()
+        req = Request(f"{url}/search?{urlencode({'top_k': top_k})}", data=body,
+                      headers={"Content-Type": "application/octet-stream"})
+        with urlopen(req, timeout=self.timeout) as r:
+            results = json.loads(r.read())["results"]
+        worker_seconds.observe(time.perf_counter() - start)
+        return results
+
+    # search a (n, d) query matrix; returns per-query hits and which workers answered
+    def search(self, query_mat, top_k):
+        query_mat = np.ascontiguousarray(query_mat, dtype="float32")
+        faiss.normalize_L2(query_mat)
+        body = query_mat.tobytes()
+
+        now = time.time()
+        live = [u for u in self.worker_urls if self.down_until.get(u, 0) <= now]
+        skipped = [u for u in self.worker_urls if u not in live]
+        futures = {self.pool.submit(self.query_worker, u, body, top_k): u for u in live}
+        done, not_done = wait(futures, timeout=self.timeout)
+
+        answered, failed = [], list(skipped)
+        per_worker = []
+        for fut in done:
+            url = futures[fut]
+            try:
+                per_worker.append(fut.result())
+                answered.append(url)
+                worker_requests.labels(worker=url, result="ok").inc()
+            except Exception:
+                failed.append(url)
+                self.down_until[url] = time.time() + self.retry_seconds
+                worker_requests.labels(worker=url, result="error").inc()
+        timed_out = [futures[fut] for fut in not_done]
+        for url in timed_out:
+            worker_requests.labels(worker=url, result="timeout").inc()
+
+        results = [merge_hits([w[q] for w in per_worker], top_k) for q in range(len(query_mat))]
+        status = {"workers": len(self.worker_urls), "answered": len(answered),
+                  "failed": sorted(failed), "timed_out": sorted(timed_out),
+                  "partial": len(answered) < len(self.worker_urls)}
+        return results, status
+
+    # same shape as search_faiss_index.search_batch: per-query hit lists
+    def search_batch(self, query_mat, top_k):
+        return self.search(query_mat, top_k)[0]
+
+# run one worker: load its shards, announce it, then serve until interrupted
+def serve_worker(index_dir, worker_id, num_workers, host, port, registry_dir, mmap, search_params, delay_ms):
+    files = assign_shards(index_dir, worker_id, num_workers)
+    worker = ShardWorker(index_dir, files, mmap, search_params, delay_ms)
+    start_textfile("shard_search", worker_id, textfile_dir=None)
+
+    server = ThreadingHTTPServer((host, port), make_worker_handler(worker))
+    server.daemon_threads = True
+    url = f"http://{socket.gethostname() if host == '0.0.0.0' else host}:{server.server_address[1]}"
+    path = register_worker(registry_dir, worker_id, url, files) if registry_dir else None
+    print(f"Worker {worker_id} serving {len(files)} shards ({worker.index.ntotal} vectors) on {url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    # directory with the index and metadata shards from build_faiss_index.py
+    parser.add_argument("--index_dir", type=str, required=True)
+
+    # this worker's id and the number of workers the shards are split between
+    parser.add_argument("--worker_id", type=int, default=int(os.environ.get("SLURM_ARRAY_TASK_ID", 0)))
+    parser.add_argument("--num_workers", type=int, default=int(os.environ.get("SLURM_ARRAY_TASK_COUNT", 1)))
+
+    # address to serve on (port 0 picks a free port)
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=0)
+
+    # directory on the shared filesystem where workers announce their address
+    parser.add_argument("--registry_dir", type=str, default=None)
+
+    # memory-map the shards instead of reading them, and faiss search parameters, e.g. nprobe=16
+    parser.add_argument("--mmap", action="store_true")
+    parser.add_argument("--search_params", type=str, default=None)
+
+    # artificial delay per search, for testing coordinator timeouts
+    parser.add_argument("--delay_ms", type=float, default=0)
+
+    args = parser.parse_args()
+
+    serve_worker(args.index_dir, args.worker_id, args.num_workers, args.host, args.port,
+                 args.registry_dir, args.mmap, args.search_params, args.delay_ms)
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import socket
+import threading
+import numpy as np
+import pyarrow.parquet as pq
+from pathlib import Path
+
+# shared work queue of parquet row ranges, coordinated through files on the nfs share
+# a fixed pool of workers (slurm array tasks) lease units until none are left, so large
+# or slow input files no longer keep one node busy while the others sit idle
+#
+# layout of <queue_dir>/:
+#   units.json          the plan: every unit's id, path and [start, stop) row range
+#   leases/<id>         held by the worker processing the unit, mtime renewed as a heartbeat
+#   done/<id>           written once the unit's output is complete
+#   failed/<id>         error message of a unit that raised, so it is not retried forever
+#
+# creation relies on O_EXCL, link and rename, which are atomic on nfs; leases whose
+# heartbeat is older than lease_seconds belong to crashed workers and are re-leased.
+# in rare races a unit can be processed twice, so outputs must be written atomically
+
+# split files into row ranges of about unit_rows rows, cut at row-group boundaries
+# row groups larger than unit_rows are split evenly; max_rows caps the rows used per file
+def plan_units(files, unit_rows=65536, max_rows=None):
+    units = []
+    for path in files:
+        md = pq.ParquetFile(path).metadata
+        n = md.num_rows if not max_rows else min(md.num_rows, max_rows)
+        ranges, start, offset = [], 0, 0
+        for i in range(md.num_row_groups):
+            if offset >= n:
+                break
+            end = min(offset + md.row_group(i).num_rows, n)
+            if end - offset > unit_rows:
+                if offset > start:
+                    ranges.append((start, offset))
+                cuts = np.linspace(offset, end, -(-(end - offset) // unit_rows) + 1).astype(int)
+                ranges.extend(zip(cuts[:-1], cuts[1:]))
+                start = end
+            elif end - start >= unit_rows:
+                ranges.append((start, end))
+                start = end
+            offset = end
+        if start < n:
+            ranges.append((start, n))
+        units.extend({"id": f"{Path(path).stem}_r{int(a):010d}", "path": str(path), "start": int(a), "stop": int(b)}
+                     for a, b in ranges)
+    return units
+
+class WorkQueue:
+    def __init__(self, queue_dir, worker=None, lease_seconds=600):
+        self.queue_dir = queue_dir
+        self.worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.units = None
+        for sub in ("leases", "done", "failed"):
+            os.makedirs(os.path.join(queue_dir, sub), exist_ok=True)
+
+    def _path(self, sub, unit_id):
+        return os.path.join(self.queue_dir, sub, unit_id)
+
+    # publish the plan unless another worker already has; every worker then reads the same plan
+    def init(self, units):
+        plan = os.path.join(self.queue_dir, "units.json")
+        if not os.path.exists(plan):
+            tmp = f"{plan}.{socket.gethostname()}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(units, f)
+            try:
+                os.link(tmp, plan)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp)
+        with open(plan) as f:
+            self.units = json.load(f)
+        return self.units
+
+    # try to take a lease on one unit with an exclusive create
+    def _try_lease(self, unit_id):
+        try:
+            fd = os.open(self._path("leases", unit_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": self.worker, "leased_at": time.time()}, f)
+        self.renew(unit_id)
+        return True
+
+    # break a lease whose heartbeat expired; the rename lets only one worker break it
+    def _break_stale(self, unit_id):
+        path = self._path("leases", unit_id)
+        try:
+            if time.time() - os.stat(path).st_mtime < self.lease_seconds:
+                return False
+            broken = f"{path}.{socket.gethostname()}.{os.getpid()}.broken"
+            os.rename(path, broken)
+            os.remove(broken)
+            return True
+        except FileNotFoundError:
+            return True
+
+    # lease the next pending unit, or none when every unit is done, failed or actively leased
+    def lease(self):
+        finished = set(os.listdir(os.path.join(self.queue_dir, "done")))
+        finished |= set(os.listdir(os.path.join(self.queue_dir, "failed")))
+        leased = set(os.listdir(os.path.join(self.queue_dir, "leases")))
+        pending = [u for u in self.units if u["id"] not in finished]
+
+        for unit in pending:
+            if unit["id"] not in leased and self._try_lease(unit["id"]):
+                return unit
+        # only then take over units whose worker stopped renewing its lease
+        for unit in pending:
+            if unit["id"] in leased and self._break_stale(unit["id"]) and self._try_lease(unit["id"]):
+                return unit
+        return None
+
+    # the unit lease() would most likely return next, without leasing it: a hint for prefetching
+    # its input while the current unit runs; another worker may still take it first
+    def peek(self):
+        finished = set(os.listdir(os.path.join(self.queue_dir, "done")))
+        finished |= set(os.listdir(os.path.join(self.queue_dir, "failed")))
+        finished |= set(os.listdir(os.path.join(self.queue_dir, "leases")))
+        return next((u for u in self.units if u["id"] not in finished), None)
+
+    # heartbeat: client clock times, so expiry is judged against the same clocks (ntp-synced nodes)
+    def renew(self, unit_id):
+        now = time.time()
+        os.utime(self._path("leases", unit_id), (now, now))
+
+    def complete(self, unit_id):
+        with open(self._path("done", unit_id), "w") as f:
+            f.write(self.worker)
+        self._release(unit_id)
+
+    def fail(self, unit_id, error):
+        with open(self._path("failed", unit_id), "w") as f:
+            f.write(f"{self.worker}: {error}")
+        self._release(unit_id)
+
+    def _release(self, unit_id):
+        try:
+            os.remove(self._path("leases", unit_id))
+        except FileNotFoundError:
+            pass
+
+    # lease and process units until none are left, renewing the lease in the background
+    # while other workers still hold leases, keep polling so units of crashed workers are recovered
+    # returns (done, failed) counts for this worker
+    def run(self, process, log=print):
+        done = failed = 0
+        while True:
+            unit = self.lease()
+            if unit is None:
+                if self.status()["leased"] == 0:
+                    return done, failed
+                time.sleep(min(self.lease_seconds / 3, 10))
+                continue
+            stop = threading.Event()
+            beat = threading.Thread(target=self._heartbeat, args=(unit["id"], stop), daemon=True)
+            beat.start()
+            try:
+                start = time.perf_counter()
+                process(unit)
+                stop.set()
+                beat.join()
+                self.complete(unit["id"])
+                done += 1
+                log(f"[{self.worker}] finished {unit['id']} ({unit['stop'] - unit['start']} rows) in {time.perf_counter() - start:.1f}s")
+            except Exception as e:
+                stop.set()
+                beat.join()
+                self.fail(unit["id"], e)
+                failed += 1
+                log(f"[{self.worker}] failed {unit['id']}: {e}")
+
+    def _heartbeat(self, unit_id, stop):
+        while not stop.wait(self.lease_seconds / 3):
+            try:
+                self.renew(unit_id)
+            except OSError:
+                pass
+
+    # counts of units by state
+    def status(self):
+        done = set(os.listdir(os.path.join(self.queue_dir, "done")))
+        failed = set(os.listdir(os.path.join(self.queue_dir, "failed")))
+        leased = set(os.listdir(os.path.join(self.queue_dir, "leases"))) - done - failed
+        total = len(self.units or [])
+        return {"total": total, "done": len(done), "failed": len(failed), "leased": len(leased),
+                "pending": total - len(done) - len(failed) - len(leased)}
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("queue_dir", type=str, help="queue directory to report on")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue_dir)
+    with open(os.path.join(args.queue_dir, "units.json")) as f:
+        queue.units = json.load(f)
+    print(json.dumps(queue.status()))